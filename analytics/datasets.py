@@ -0,0 +1,60 @@
+"""Reading the processed dataset written by bucket_raw_data and writing the tables derived from it."""
+from typing import List, Optional
+import datetime
+import logging
+
+import boto3
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from lambdas.bucket_raw_data.bucket_raw_data import S3MultipartUploadStream, get_manifest_key, load_manifest, \
+    read_parquet_object
+
+logger = logging.getLogger('cta-train-analytics-analytics')
+
+ANALYTICS_PREFIX = 'analytics/'
+# Matches the lifecycle rule expiring the processed/ prefix in main.tf
+PROCESSED_RETENTION_DAYS = 3
+
+
+def get_processed_day_keys(s3_client: boto3.client, bucket_name: str, load_date: datetime.date) -> List[str]:
+    """Returns the keys of the processed Parquet objects of a load date, across every train line and hour
+        partition. The keys come from the compaction manifest, so objects left by a failed compaction run are not
+        read. A ValueError is raised if the load date has no processed objects, since processed objects and their
+        manifest expire after PROCESSED_RETENTION_DAYS."""
+    manifest = load_manifest(s3_client=s3_client, bucket_name=bucket_name, key=get_manifest_key(load_date))
+    if not manifest['parts']:
+        raise ValueError(
+            f'No processed objects for load date {load_date}. Processed objects expire after '
+            f'{PROCESSED_RETENTION_DAYS} days, so only recent load dates can be read.'
+        )
+    return sorted(manifest['parts'])
+
+
+def read_processed_day(s3_client: boto3.client, bucket_name: str, load_date: datetime.date,
+                       columns: Optional[List[str]] = None) -> pa.Table:
+    """Reads every processed Parquet object of a load date into a single PROCESSED_SCHEMA table, or only the given
+        columns of it."""
+    tables = [
+        read_parquet_object(s3_client=s3_client, bucket_name=bucket_name, key=key, columns=columns)
+        for key in get_processed_day_keys(s3_client=s3_client, bucket_name=bucket_name, load_date=load_date)
+    ]
+    table = pa.concat_tables(tables)
+    logger.info('Read %d processed rows from %d objects for load date %s', table.num_rows, len(tables), load_date)
+    return table
+
+
+def get_analytics_table_key(name: str, load_date: datetime.date) -> str:
+    """Returns the key of a derived table for a load date. The key is fixed, so re-running an analysis replaces
+        its previous output."""
+    return f'{ANALYTICS_PREFIX}{name}/load_date={load_date.isoformat()}/{name}.parquet'
+
+
+def write_analytics_table(table: pa.Table, s3_client: boto3.client, bucket_name: str, name: str,
+                          load_date: datetime.date) -> str:
+    """Uploads a derived table for a load date as a single Parquet object straight from memory. Returns its key."""
+    key = get_analytics_table_key(name=name, load_date=load_date)
+    with S3MultipartUploadStream(s3_client=s3_client, bucket_name=bucket_name, key=key) as sink:
+        pq.write_table(table, sink)
+    logger.info('Wrote %d rows to s3://%s/%s', table.num_rows, bucket_name, key)
+    return key
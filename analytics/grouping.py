@@ -0,0 +1,22 @@
+"""Vectorized group-by helpers over NumPy arrays sorted by their group keys."""
+import numpy as np
+
+
+def get_group_starts(*codes: np.ndarray) -> np.ndarray:
+    """Returns a boolean array marking the rows of sorted code arrays where any of the codes differs from the previous
+        row, so the first row of each group is True."""
+    group_starts = np.zeros(len(codes[0]), dtype=bool)
+    group_starts[0] = True
+    for code in codes:
+        group_starts[1:] |= code[1:] != code[:-1]
+    return group_starts
+
+
+def get_sorted_percentiles(sorted_values: np.ndarray, group_starts: np.ndarray, group_counts: np.ndarray,
+                           percentile: float) -> np.ndarray:
+    """Returns the linearly interpolated percentile of each group of values, where the values are sorted by group and
+        then by value and each group is given by its start index and count."""
+    position = group_starts + (group_counts - 1) * percentile / 100
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
@@ -0,0 +1,168 @@
+"""Computes headways, the time between consecutive trains arriving at a station, from the trip events of a day and
+rolls them up into hourly percentiles per station, train line and direction.
+
+The events are sorted once by train line, direction, station and arrival time, so each headway is the difference to
+the previous row within the same partition. Headways below the bunching threshold are flagged as bunching and
+headways above the gap threshold as gaps. Each headway is attributed to the hour of the later arrival.
+
+Run from the repository root, after the setup in the Analytics section of the README, with:
+    python -m analytics.headways --bucket <bucket name> --load-date YYYY-MM-DD
+"""
+from typing import Sequence
+import argparse
+import datetime
+import logging
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from analytics.datasets import read_processed_day, write_analytics_table
+from analytics.grouping import get_group_starts, get_sorted_percentiles
+from analytics.trip_events import TIMESTAMP_TYPE, derive_trip_events, to_codes, to_microseconds
+from lambdas.bucket_raw_data.bucket_raw_data import create_s3_client
+
+logger = logging.getLogger('cta-train-analytics-analytics')
+
+BUNCHING_THRESHOLD_SECONDS = 120
+GAP_THRESHOLD_SECONDS = 1200
+HEADWAY_PERCENTILES = (50, 90, 95)
+PARTITION_COLUMNS = ['train_line', 'direction', 'station']
+HEADWAYS_SCHEMA = pa.schema(
+    [
+        ('train_line', pa.dictionary(pa.int8(), pa.string())),
+        ('direction', pa.dictionary(pa.int8(), pa.string())),
+        ('station', pa.dictionary(pa.int32(), pa.string())),
+        ('train_id', pa.string()),
+        ('previous_train_id', pa.string()),
+        ('arrival_time', TIMESTAMP_TYPE),
+        ('hour', TIMESTAMP_TYPE),
+        ('headway_seconds', pa.float64()),
+        ('is_bunched', pa.bool_()),
+        ('is_gap', pa.bool_())
+    ]
+)
+
+
+def get_headway_rollup_schema(percentiles: Sequence[int] = HEADWAY_PERCENTILES) -> pa.Schema:
+    """Returns the schema of the hourly headway rollup, with one column per percentile."""
+    return pa.schema(
+        [
+            ('train_line', pa.dictionary(pa.int8(), pa.string())),
+            ('direction', pa.dictionary(pa.int8(), pa.string())),
+            ('station', pa.dictionary(pa.int32(), pa.string())),
+            ('hour', TIMESTAMP_TYPE),
+            ('headway_count', pa.int64()),
+            ('bunched_count', pa.int64()),
+            ('gap_count', pa.int64()),
+            ('min_headway_seconds', pa.float64()),
+            ('mean_headway_seconds', pa.float64()),
+            ('max_headway_seconds', pa.float64())
+        ] + [(f'p{percentile}_headway_seconds', pa.float64()) for percentile in percentiles]
+    )
+
+
+def compute_headways(events: pa.Table, bunching_threshold_seconds: float = BUNCHING_THRESHOLD_SECONDS,
+                     gap_threshold_seconds: float = GAP_THRESHOLD_SECONDS) -> pa.Table:
+    """Computes a HEADWAYS_SCHEMA table from a table of trip events, with one row per arrival that follows another
+        arrival at the same station, train line and direction."""
+    events = events.filter(pc.is_valid(events['arrival_time']))
+    if events.num_rows == 0:
+        return HEADWAYS_SCHEMA.empty_table()
+
+    partition_codes = [to_codes(events[column]).indices.to_numpy() for column in PARTITION_COLUMNS]
+    arrival_times = to_microseconds(events['arrival_time'])
+    order = np.lexsort([arrival_times] + partition_codes[::-1])
+    partition_codes = [code[order] for code in partition_codes]
+    arrival_times = arrival_times[order]
+
+    has_previous = ~get_group_starts(*partition_codes)
+    rows = np.flatnonzero(has_previous)
+    headway_seconds = (arrival_times[rows] - arrival_times[rows - 1]) / 1e6
+    sorted_events = events.take(pa.array(order))
+    arrival_time = sorted_events['arrival_time'].take(pa.array(rows))
+    headways = pa.table(
+        {
+            'train_line': sorted_events['train_line'].take(pa.array(rows)),
+            'direction': sorted_events['direction'].take(pa.array(rows)),
+            'station': sorted_events['station'].take(pa.array(rows)),
+            'train_id': sorted_events['train_id'].take(pa.array(rows)),
+            'previous_train_id': sorted_events['train_id'].take(pa.array(rows - 1)),
+            'arrival_time': arrival_time,
+            'hour': pc.floor_temporal(arrival_time, unit='hour'),
+            'headway_seconds': pa.array(headway_seconds, type=pa.float64()),
+            'is_bunched': pa.array(headway_seconds < bunching_threshold_seconds, type=pa.bool_()),
+            'is_gap': pa.array(headway_seconds > gap_threshold_seconds, type=pa.bool_())
+        }
+    )
+    logger.info('Computed %d headways from %d trip events', headways.num_rows, events.num_rows)
+    return headways.cast(HEADWAYS_SCHEMA)
+
+
+def rollup_headways(headways: pa.Table, percentiles: Sequence[int] = HEADWAY_PERCENTILES) -> pa.Table:
+    """Aggregates a HEADWAYS_SCHEMA table, sorted as returned by compute_headways, into one row per station, train
+        line, direction and hour with counts and exact (linearly interpolated) headway percentiles."""
+    schema = get_headway_rollup_schema(percentiles)
+    if headways.num_rows == 0:
+        return schema.empty_table()
+
+    group_codes = [to_codes(headways[column]).indices.to_numpy() for column in PARTITION_COLUMNS]
+    group_codes.append(to_microseconds(headways['hour']))
+    group_ids = np.cumsum(get_group_starts(*group_codes)) - 1
+    group_starts = np.flatnonzero(np.diff(group_ids, prepend=-1))
+    group_counts = np.diff(np.append(group_starts, headways.num_rows))
+
+    headway_seconds = headways['headway_seconds'].to_numpy()
+    order = np.lexsort([headway_seconds, group_ids])
+    sorted_headways = headway_seconds[order]
+    columns = {
+        'train_line': headways['train_line'].take(pa.array(group_starts)),
+        'direction': headways['direction'].take(pa.array(group_starts)),
+        'station': headways['station'].take(pa.array(group_starts)),
+        'hour': headways['hour'].take(pa.array(group_starts)),
+        'headway_count': pa.array(group_counts, type=pa.int64()),
+        'bunched_count': pa.array(np.add.reduceat(headways['is_bunched'].to_numpy().astype(np.int64), group_starts)),
+        'gap_count': pa.array(np.add.reduceat(headways['is_gap'].to_numpy().astype(np.int64), group_starts)),
+        'min_headway_seconds': pa.array(sorted_headways[group_starts]),
+        'mean_headway_seconds': pa.array(np.add.reduceat(sorted_headways, group_starts) / group_counts),
+        'max_headway_seconds': pa.array(sorted_headways[group_starts + group_counts - 1])
+    }
+    for percentile in percentiles:
+        columns[f'p{percentile}_headway_seconds'] = pa.array(
+            get_sorted_percentiles(sorted_headways, group_starts, group_counts, percentile)
+        )
+    rollup = pa.table(columns)
+    logger.info('Rolled up %d headways into %d hourly rows', headways.num_rows, rollup.num_rows)
+    return rollup.cast(schema)
+
+
+def main():
+    """Computes the hourly headway rollup of a load date from the processed dataset and writes it as its own
+        table."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bucket', required=True, help='Bucket holding the processed dataset')
+    parser.add_argument('--load-date', required=True, type=datetime.date.fromisoformat, help='Load date to process')
+    parser.add_argument('--bunching-threshold-seconds', type=float, default=BUNCHING_THRESHOLD_SECONDS,
+                        help='Headways below this are flagged as bunching')
+    parser.add_argument('--gap-threshold-seconds', type=float, default=GAP_THRESHOLD_SECONDS,
+                        help='Headways above this are flagged as gaps')
+    args = parser.parse_args()
+
+    s3_client = create_s3_client()
+    snapshots = read_processed_day(s3_client=s3_client, bucket_name=args.bucket, load_date=args.load_date)
+    headways = compute_headways(
+        events=derive_trip_events(snapshots),
+        bunching_threshold_seconds=args.bunching_threshold_seconds,
+        gap_threshold_seconds=args.gap_threshold_seconds
+    )
+    write_analytics_table(
+        table=rollup_headways(headways),
+        s3_client=s3_client,
+        bucket_name=args.bucket,
+        name='headway_rollup',
+        load_date=args.load_date
+    )
+
+
+if __name__ == '__main__':
+    main()
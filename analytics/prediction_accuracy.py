@@ -0,0 +1,235 @@
+"""Measures the accuracy of the next_station_arrival_time predictions in the processed snapshots by joining each
+prediction to the arrival later observed for the same train and station.
+
+The join is an as-of join done as a sort-merge: predictions and arrivals are concatenated, sorted once by train and
+station and then by time, and each prediction is matched to the first arrival at or after the time the prediction was
+generated, provided it is within the match window. Errors are then summarized by train line, station and prediction
+horizon.
+
+Run from the repository root, after the setup in the Analytics section of the README, with:
+    python -m analytics.prediction_accuracy --bucket <bucket name> --load-date YYYY-MM-DD [--days 3]
+
+Processed objects expire after PROCESSED_RETENTION_DAYS, so --days cannot reach further back than that and a load
+date whose processed objects have expired raises an error.
+"""
+from typing import Sequence
+import argparse
+import datetime
+import logging
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from analytics.datasets import PROCESSED_RETENTION_DAYS, read_processed_day, write_analytics_table
+from analytics.grouping import get_group_starts, get_sorted_percentiles
+from analytics.trip_events import SNAPSHOT_COLUMNS, TIMESTAMP_TYPE, derive_trip_events, split_train_ids, to_codes, \
+    to_microseconds
+from lambdas.bucket_raw_data.bucket_raw_data import create_s3_client
+
+logger = logging.getLogger('cta-train-analytics-analytics')
+
+MAX_MATCH_SECONDS = 3600
+ERROR_PERCENTILES = (10, 50, 90)
+HORIZON_BUCKET_EDGES_SECONDS = (60, 120, 300, 600, 1200)
+HORIZON_BUCKET_LABELS = ('0-1m', '1-2m', '2-5m', '5-10m', '10-20m', '20m+')
+PREDICTION_COLUMNS = ['train_id', 'next_station', 'prediction_generated_timestamp', 'next_station_arrival_time',
+                      'record_type']
+PREDICTIONS_SCHEMA = pa.schema(
+    [
+        ('train_id', pa.string()),
+        ('station', pa.dictionary(pa.int32(), pa.string())),
+        ('prediction_generated_time', TIMESTAMP_TYPE),
+        ('predicted_arrival_time', TIMESTAMP_TYPE)
+    ]
+)
+PREDICTION_ERRORS_SCHEMA = pa.schema(
+    [
+        ('train_id', pa.string()),
+        ('train_line', pa.dictionary(pa.int8(), pa.string())),
+        ('station', pa.dictionary(pa.int32(), pa.string())),
+        ('prediction_generated_time', TIMESTAMP_TYPE),
+        ('predicted_arrival_time', TIMESTAMP_TYPE),
+        ('observed_arrival_time', TIMESTAMP_TYPE),
+        ('horizon_seconds', pa.float64()),
+        ('horizon_bucket', pa.dictionary(pa.int8(), pa.string())),
+        ('error_seconds', pa.float64())
+    ]
+)
+
+
+def get_prediction_accuracy_schema(percentiles: Sequence[int] = ERROR_PERCENTILES) -> pa.Schema:
+    """Returns the schema of the prediction accuracy summary, with one column per error percentile."""
+    return pa.schema(
+        [
+            ('train_line', pa.dictionary(pa.int8(), pa.string())),
+            ('station', pa.dictionary(pa.int32(), pa.string())),
+            ('horizon_bucket', pa.dictionary(pa.int8(), pa.string())),
+            ('prediction_count', pa.int64()),
+            ('mean_error_seconds', pa.float64()),
+            ('mean_absolute_error_seconds', pa.float64())
+        ] + [(f'p{percentile}_error_seconds', pa.float64()) for percentile in percentiles]
+    )
+
+
+def get_predictions(snapshots: pa.Table) -> pa.Table:
+    """Returns a PREDICTIONS_SCHEMA table of the next station predictions in a table of processed snapshots. Rows
+        filled in from delta records repeat an earlier prediction and are skipped."""
+    is_prediction = pc.and_(
+        pc.and_(pc.is_valid(snapshots['next_station']), pc.is_valid(snapshots['next_station_arrival_time'])),
+        pc.is_valid(snapshots['prediction_generated_timestamp'])
+    )
+    is_filled = pc.fill_null(pc.equal(snapshots['record_type'].cast(pa.string()), 'filled'), False)
+    predictions = snapshots.filter(pc.and_(is_prediction, pc.invert(is_filled)))
+    return pa.table(
+        {
+            'train_id': predictions['train_id'],
+            'station': predictions['next_station'],
+            'prediction_generated_time': predictions['prediction_generated_timestamp'],
+            'predicted_arrival_time': predictions['next_station_arrival_time']
+        }
+    ).cast(PREDICTIONS_SCHEMA)
+
+
+def get_horizon_buckets(horizon_seconds: np.ndarray) -> pa.DictionaryArray:
+    """Returns the HORIZON_BUCKET_LABELS label of each prediction horizon."""
+    indices = np.digitize(horizon_seconds, HORIZON_BUCKET_EDGES_SECONDS).astype(np.int8)
+    return pa.DictionaryArray.from_arrays(pa.array(indices), pa.array(HORIZON_BUCKET_LABELS))
+
+
+def match_predictions_to_arrivals(predictions: pa.Table, events: pa.Table,
+                                  max_match_seconds: float = MAX_MATCH_SECONDS) -> pa.Table:
+    """Joins each prediction to the first arrival of the same train at the same station at or after the time the
+        prediction was generated and within max_match_seconds of it. Returns a PREDICTION_ERRORS_SCHEMA table of the
+        matched predictions, where a positive error means the train arrived later than predicted."""
+    events = events.filter(pc.is_valid(events['arrival_time']))
+    prediction_count = predictions.num_rows
+    if prediction_count == 0 or events.num_rows == 0:
+        return PREDICTION_ERRORS_SCHEMA.empty_table()
+
+    # Encode the train and station of both sides with shared dictionaries so they can be compared as integers
+    train_codes = to_codes(pa.chunked_array(predictions['train_id'].chunks + events['train_id'].chunks))
+    station_codes = to_codes(
+        pa.chunked_array(
+            predictions['station'].cast(pa.string()).chunks + events['station'].cast(pa.string()).chunks
+        )
+    )
+    keys = train_codes.indices.to_numpy().astype(np.int64) * len(station_codes.dictionary) + \
+        station_codes.indices.to_numpy()
+    times = np.concatenate(
+        [to_microseconds(predictions['prediction_generated_time']), to_microseconds(events['arrival_time'])]
+    )
+    is_event = np.arange(len(keys)) >= prediction_count
+
+    # Sort by key and time, with predictions before arrivals at the same time, then carry the position of the next
+    # arrival backwards to every row before it
+    order = np.lexsort([is_event, times, keys])
+    sorted_keys, sorted_times = keys[order], times[order]
+    event_positions = np.where(is_event[order], np.arange(len(order)), len(order))
+    next_event_positions = np.minimum.accumulate(event_positions[::-1])[::-1]
+    prediction_positions = np.flatnonzero(~is_event[order])
+    match_positions = next_event_positions[prediction_positions]
+    has_match = match_positions < len(order)
+    match_positions = np.where(has_match, match_positions, 0)
+    has_match &= sorted_keys[match_positions] == sorted_keys[prediction_positions]
+    has_match &= sorted_times[match_positions] - sorted_times[prediction_positions] <= max_match_seconds * 1e6
+
+    prediction_rows = order[prediction_positions[has_match]]
+    event_rows = order[match_positions[has_match]] - prediction_count
+    matched = predictions.take(pa.array(prediction_rows))
+    observed_arrival_time = events['arrival_time'].take(pa.array(event_rows))
+    predicted = to_microseconds(matched['predicted_arrival_time'])
+    horizon_seconds = (predicted - to_microseconds(matched['prediction_generated_time'])) / 1e6
+    errors = pa.table(
+        {
+            'train_id': matched['train_id'],
+            'train_line': split_train_ids(matched['train_id'].combine_chunks())['train_line'],
+            'station': matched['station'],
+            'prediction_generated_time': matched['prediction_generated_time'],
+            'predicted_arrival_time': matched['predicted_arrival_time'],
+            'observed_arrival_time': observed_arrival_time,
+            'horizon_seconds': pa.array(horizon_seconds),
+            'horizon_bucket': get_horizon_buckets(horizon_seconds),
+            'error_seconds': pa.array((to_microseconds(observed_arrival_time) - predicted) / 1e6)
+        }
+    )
+    logger.info('Matched %d of %d predictions to an observed arrival', errors.num_rows, prediction_count)
+    return errors.cast(PREDICTION_ERRORS_SCHEMA)
+
+
+def summarize_prediction_errors(errors: pa.Table, percentiles: Sequence[int] = ERROR_PERCENTILES) -> pa.Table:
+    """Aggregates a PREDICTION_ERRORS_SCHEMA table into one row per train line, station and horizon bucket with the
+        mean error, mean absolute error and exact (linearly interpolated) error percentiles."""
+    schema = get_prediction_accuracy_schema(percentiles)
+    if errors.num_rows == 0:
+        return schema.empty_table()
+
+    line_codes = to_codes(errors['train_line']).indices.to_numpy()
+    station_codes = to_codes(errors['station']).indices.to_numpy()
+    bucket_codes = errors['horizon_bucket'].combine_chunks().indices.to_numpy()
+    error_seconds = errors['error_seconds'].to_numpy()
+    order = np.lexsort([error_seconds, bucket_codes, station_codes, line_codes])
+    group_starts = np.flatnonzero(get_group_starts(line_codes[order], station_codes[order], bucket_codes[order]))
+    group_counts = np.diff(np.append(group_starts, errors.num_rows))
+    sorted_errors = error_seconds[order]
+    first_rows = pa.array(order[group_starts])
+
+    columns = {
+        'train_line': errors['train_line'].take(first_rows),
+        'station': errors['station'].take(first_rows),
+        'horizon_bucket': errors['horizon_bucket'].take(first_rows),
+        'prediction_count': pa.array(group_counts, type=pa.int64()),
+        'mean_error_seconds': pa.array(np.add.reduceat(sorted_errors, group_starts) / group_counts),
+        'mean_absolute_error_seconds': pa.array(np.add.reduceat(np.abs(sorted_errors), group_starts) / group_counts)
+    }
+    for percentile in percentiles:
+        columns[f'p{percentile}_error_seconds'] = pa.array(
+            get_sorted_percentiles(sorted_errors, group_starts, group_counts, percentile)
+        )
+    summary = pa.table(columns)
+    logger.info('Summarized %d prediction errors into %d rows', errors.num_rows, summary.num_rows)
+    return summary.cast(schema)
+
+
+def main():
+    """Summarizes the prediction errors of the days ending on a load date and writes the summary as its own table
+        under that load date."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bucket', required=True, help='Bucket holding the processed dataset')
+    parser.add_argument('--load-date', required=True, type=datetime.date.fromisoformat, help='Last load date')
+    parser.add_argument('--days', type=int, default=1,
+                        help=f'Number of load dates, ending on --load-date, at most {PROCESSED_RETENTION_DAYS} since '
+                             'older processed objects have expired')
+    parser.add_argument('--max-match-seconds', type=float, default=MAX_MATCH_SECONDS,
+                        help='Latest an arrival can follow a prediction and still be matched to it')
+    args = parser.parse_args()
+
+    s3_client = create_s3_client()
+    predictions = []
+    events = []
+    for day in range(args.days - 1, -1, -1):
+        load_date = args.load_date - datetime.timedelta(days=day)
+        snapshots = read_processed_day(
+            s3_client=s3_client,
+            bucket_name=args.bucket,
+            load_date=load_date,
+            columns=list(dict.fromkeys(SNAPSHOT_COLUMNS + PREDICTION_COLUMNS))
+        )
+        predictions.append(get_predictions(snapshots))
+        events.append(derive_trip_events(snapshots).select(['train_id', 'station', 'arrival_time']))
+    errors = match_predictions_to_arrivals(
+        predictions=pa.concat_tables(predictions).unify_dictionaries().combine_chunks(),
+        events=pa.concat_tables(events).unify_dictionaries().combine_chunks(),
+        max_match_seconds=args.max_match_seconds
+    )
+    write_analytics_table(
+        table=summarize_prediction_errors(errors),
+        s3_client=s3_client,
+        bucket_name=args.bucket,
+        name='prediction_accuracy',
+        load_date=args.load_date
+    )
+
+
+if __name__ == '__main__':
+    main()
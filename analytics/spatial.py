@@ -0,0 +1,398 @@
+"""Builds a spatial layer over the train positions in the processed snapshots: station locations, the track segments
+between consecutive stations, a uniform grid index of those segments, and per-segment travel speeds.
+
+A station is located at the median midpoint of the positions just before and just after runs passed it, and a
+segment joins two stations a run was seen heading to one after the other. Segments are undirected, so both directions
+of a track share the same segment. Each segment is registered in every grid cell within the snapping distance of it,
+so snapping a position only checks the segments of its own cell. Speeds are the distance between consecutive
+positions of a run divided by the time between them, attributed to the segment the midpoint of the two positions
+snaps to. Everything is done with Arrow compute kernels and NumPy operations over a whole day at once.
+
+Run from the repository root, after the setup in the Analytics section of the README, with:
+    python -m analytics.spatial --bucket <bucket name> --load-date YYYY-MM-DD
+"""
+from typing import Sequence, Tuple
+import argparse
+import datetime
+import logging
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from analytics.datasets import read_processed_day, write_analytics_table
+from analytics.grouping import get_group_starts, get_sorted_percentiles
+from analytics.trip_events import TIMESTAMP_TYPE, split_train_ids, to_codes, to_microseconds
+from lambdas.bucket_raw_data.bucket_raw_data import create_s3_client
+
+logger = logging.getLogger('cta-train-analytics-analytics')
+
+EARTH_RADIUS_METERS = 6371008.8
+GRID_CELL_METERS = 250
+GRID_KEY_OFFSET = 2 ** 20
+MAX_SNAP_DISTANCE_METERS = 150
+MAX_PAIR_GAP_SECONDS = 180
+SPEED_PERCENTILES = (10, 50, 90)
+POSITION_COLUMNS = ['train_id', 'current_timestamp', 'next_station', 'next_station_id', 'latitude', 'longitude',
+                    'record_type']
+STATIONS_SCHEMA = pa.schema(
+    [
+        ('station_id', pa.string()),
+        ('station', pa.string()),
+        ('latitude', pa.float64()),
+        ('longitude', pa.float64()),
+        ('observation_count', pa.int64())
+    ]
+)
+SEGMENTS_SCHEMA = pa.schema(
+    [
+        ('segment_id', pa.int32()),
+        ('from_station_id', pa.string()),
+        ('to_station_id', pa.string()),
+        ('from_station', pa.string()),
+        ('to_station', pa.string()),
+        ('from_latitude', pa.float64()),
+        ('from_longitude', pa.float64()),
+        ('to_latitude', pa.float64()),
+        ('to_longitude', pa.float64()),
+        ('length_meters', pa.float64())
+    ]
+)
+SEGMENT_OBSERVATIONS_SCHEMA = pa.schema(
+    [
+        ('segment_id', pa.int32()),
+        ('train_id', pa.string()),
+        ('train_line', pa.dictionary(pa.int8(), pa.string())),
+        ('direction', pa.dictionary(pa.int8(), pa.string())),
+        ('start_time', TIMESTAMP_TYPE),
+        ('hour', TIMESTAMP_TYPE),
+        ('elapsed_seconds', pa.float64()),
+        ('distance_meters', pa.float64()),
+        ('speed_meters_per_second', pa.float64())
+    ]
+)
+
+
+def get_segment_speeds_schema(percentiles: Sequence[int] = SPEED_PERCENTILES) -> pa.Schema:
+    """Returns the schema of the hourly segment speed summary, with one column per speed percentile."""
+    return pa.schema(
+        [
+            ('segment_id', pa.int32()),
+            ('train_line', pa.dictionary(pa.int8(), pa.string())),
+            ('direction', pa.dictionary(pa.int8(), pa.string())),
+            ('hour', TIMESTAMP_TYPE),
+            ('observation_count', pa.int64()),
+            ('mean_speed_meters_per_second', pa.float64())
+        ] + [(f'p{percentile}_speed_meters_per_second', pa.float64()) for percentile in percentiles]
+    )
+
+
+def to_local_meters(latitude: np.ndarray, longitude: np.ndarray,
+                    origin: Tuple[float, float]) -> Tuple[np.ndarray, np.ndarray]:
+    """Projects coordinates onto a plane in meters east and north of the origin (latitude, longitude). The
+        equirectangular projection is accurate to well under a meter across a city."""
+    x = EARTH_RADIUS_METERS * np.radians(longitude - origin[1]) * np.cos(np.radians(origin[0]))
+    y = EARTH_RADIUS_METERS * np.radians(latitude - origin[0])
+    return x, y
+
+
+def get_positions(snapshots: pa.Table) -> pa.Table:
+    """Returns the snapshots that carry a position, without the rows filled in from delta records since those repeat
+        an earlier position, sorted by train_id and current_timestamp."""
+    is_filled = pc.fill_null(pc.equal(snapshots['record_type'].cast(pa.string()), 'filled'), False)
+    has_position = pc.and_(
+        pc.and_(pc.is_valid(snapshots['latitude']), pc.is_valid(snapshots['longitude'])),
+        pc.is_valid(snapshots['current_timestamp'])
+    )
+    positions = snapshots.filter(pc.and_(has_position, pc.invert(is_filled)))
+    return positions.sort_by([('train_id', 'ascending'), ('current_timestamp', 'ascending')])
+
+
+def get_station_passes(positions: pa.Table) -> Tuple[np.ndarray, pa.DictionaryArray]:
+    """Returns the rows of positions, sorted by train_id and current_timestamp, after which the run's next station
+        changes, so the train passed that station between the row and the next one, along with the next station IDs
+        of all rows as a dictionary array."""
+    train_codes = to_codes(positions['train_id']).indices.to_numpy()
+    station_ids = to_codes(positions['next_station_id'])
+    station_codes = station_ids.indices.to_numpy()
+    is_pass = (train_codes[1:] == train_codes[:-1]) & (station_codes[1:] != station_codes[:-1])
+    return np.flatnonzero(is_pass), station_ids
+
+
+def estimate_station_locations(positions: pa.Table) -> pa.Table:
+    """Returns a STATIONS_SCHEMA table with the location of each station, estimated as the median midpoint of the
+        positions just before and just after runs passed it, given positions sorted by train_id and
+        current_timestamp."""
+    positions = positions.filter(pc.is_valid(positions['next_station_id']))
+    if positions.num_rows < 2:
+        return STATIONS_SCHEMA.empty_table()
+    rows, station_ids = get_station_passes(positions)
+    if len(rows) == 0:
+        return STATIONS_SCHEMA.empty_table()
+
+    station_codes = station_ids.indices.to_numpy()[rows]
+    columns = {}
+    for column in ('latitude', 'longitude'):
+        values = positions[column].to_numpy()
+        midpoints = (values[rows] + values[rows + 1]) / 2
+        order = np.lexsort([midpoints, station_codes])
+        group_starts = np.flatnonzero(get_group_starts(station_codes[order]))
+        group_counts = np.diff(np.append(group_starts, len(order)))
+        columns[column] = get_sorted_percentiles(midpoints[order], group_starts, group_counts, 50)
+    first_rows = pa.array(rows[order[group_starts]])
+    stations = pa.table(
+        {
+            'station_id': positions['next_station_id'].take(first_rows),
+            'station': positions['next_station'].take(first_rows),
+            'latitude': pa.array(columns['latitude']),
+            'longitude': pa.array(columns['longitude']),
+            'observation_count': pa.array(group_counts, type=pa.int64())
+        }
+    )
+    logger.info('Located %d stations from %d station passes', stations.num_rows, len(rows))
+    return stations.cast(STATIONS_SCHEMA).sort_by([('station_id', 'ascending')])
+
+
+def derive_segments(positions: pa.Table, stations: pa.Table) -> pa.Table:
+    """Returns a SEGMENTS_SCHEMA table with one segment per pair of stations a run was seen heading to one after the
+        other, given positions sorted by train_id and current_timestamp. The pair is ordered by station ID, and pairs
+        with a station of unknown location are dropped."""
+    positions = positions.filter(pc.is_valid(positions['next_station_id']))
+    if positions.num_rows < 2 or stations.num_rows == 0:
+        return SEGMENTS_SCHEMA.empty_table()
+
+    rows, station_ids = get_station_passes(positions)
+    station_codes = station_ids.indices.to_numpy()
+    previous_ids = station_ids.dictionary.take(pa.array(station_codes[rows]))
+    next_ids = station_ids.dictionary.take(pa.array(station_codes[rows + 1]))
+    pairs = pa.table(
+        {
+            'from_station_id': pc.min_element_wise(previous_ids, next_ids),
+            'to_station_id': pc.max_element_wise(previous_ids, next_ids)
+        }
+    ).group_by(['from_station_id', 'to_station_id']).aggregate([])
+
+    for end in ('from', 'to'):
+        end_stations = stations.select(['station_id', 'station', 'latitude', 'longitude']).rename_columns(
+            [f'{end}_station_id', f'{end}_station', f'{end}_latitude', f'{end}_longitude']
+        )
+        pairs = pairs.join(end_stations, keys=f'{end}_station_id', join_type='inner')
+    if pairs.num_rows == 0:
+        return SEGMENTS_SCHEMA.empty_table()
+    pairs = pairs.sort_by([('from_station_id', 'ascending'), ('to_station_id', 'ascending')])
+    origin = (pc.mean(pairs['from_latitude']).as_py(), pc.mean(pairs['from_longitude']).as_py())
+    from_x, from_y = to_local_meters(pairs['from_latitude'].to_numpy(), pairs['from_longitude'].to_numpy(), origin)
+    to_x, to_y = to_local_meters(pairs['to_latitude'].to_numpy(), pairs['to_longitude'].to_numpy(), origin)
+    segments = pairs.append_column('length_meters', pa.array(np.hypot(to_x - from_x, to_y - from_y)))
+    segments = segments.add_column(0, 'segment_id', pa.array(np.arange(segments.num_rows), type=pa.int32()))
+    logger.info('Derived %d track segments between %d stations', segments.num_rows, stations.num_rows)
+    return segments.select(SEGMENTS_SCHEMA.names).cast(SEGMENTS_SCHEMA)
+
+
+class SegmentGridIndex:
+    """Uniform grid index of track segments for snapping positions to the nearest segment. Each segment is registered
+        in every cell that lies within max_distance_meters of its bounding box, so a query only checks the segments
+        registered in the cell of each position."""
+
+    def __init__(self, segments: pa.Table, cell_meters: float = GRID_CELL_METERS,
+                 max_distance_meters: float = MAX_SNAP_DISTANCE_METERS):
+        """Builds the index over a SEGMENTS_SCHEMA table."""
+        self.segment_ids = segments['segment_id'].to_numpy()
+        self.cell_meters = cell_meters
+        self.max_distance_meters = max_distance_meters
+        from_latitude = segments['from_latitude'].to_numpy()
+        from_longitude = segments['from_longitude'].to_numpy()
+        self.origin = (float(np.mean(from_latitude)), float(np.mean(from_longitude))) if len(segments) else (0.0, 0.0)
+        self.from_x, self.from_y = self.to_local_meters(from_latitude, from_longitude)
+        to_x, to_y = self.to_local_meters(segments['to_latitude'].to_numpy(), segments['to_longitude'].to_numpy())
+        self.delta_x = to_x - self.from_x
+        self.delta_y = to_y - self.from_y
+        self.length_squared = np.maximum(self.delta_x ** 2 + self.delta_y ** 2, 1e-9)
+
+        cell_keys = []
+        cell_segments = []
+        min_cells_x = self.get_cells(np.minimum(self.from_x, to_x) - max_distance_meters)
+        max_cells_x = self.get_cells(np.maximum(self.from_x, to_x) + max_distance_meters)
+        min_cells_y = self.get_cells(np.minimum(self.from_y, to_y) - max_distance_meters)
+        max_cells_y = self.get_cells(np.maximum(self.from_y, to_y) + max_distance_meters)
+        for segment in range(len(self.segment_ids)):
+            cells_x, cells_y = np.meshgrid(
+                np.arange(min_cells_x[segment], max_cells_x[segment] + 1),
+                np.arange(min_cells_y[segment], max_cells_y[segment] + 1)
+            )
+            cell_keys.append(self.get_cell_keys(cells_x.ravel(), cells_y.ravel()))
+            cell_segments.append(np.full(cells_x.size, segment))
+        cell_keys = np.concatenate(cell_keys) if cell_keys else np.empty(0, dtype=np.int64)
+        cell_segments = np.concatenate(cell_segments) if cell_segments else np.empty(0, dtype=np.int64)
+        order = np.argsort(cell_keys, kind='stable')
+        self.cell_keys = cell_keys[order]
+        self.cell_segments = cell_segments[order]
+        logger.info('Indexed %d segments in %d grid cells', len(self.segment_ids), len(np.unique(self.cell_keys)))
+
+    def to_local_meters(self, latitude: np.ndarray, longitude: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Projects coordinates onto the plane of the index."""
+        return to_local_meters(latitude, longitude, self.origin)
+
+    def get_cells(self, meters: np.ndarray) -> np.ndarray:
+        """Returns the grid cell of each coordinate in meters along one axis."""
+        return np.floor(meters / self.cell_meters).astype(np.int64)
+
+    @staticmethod
+    def get_cell_keys(cells_x: np.ndarray, cells_y: np.ndarray) -> np.ndarray:
+        """Combines the cells along both axes into a single int64 key per cell."""
+        return (cells_x + GRID_KEY_OFFSET) * (2 * GRID_KEY_OFFSET) + (cells_y + GRID_KEY_OFFSET)
+
+    def snap(self, latitude: np.ndarray, longitude: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Snaps each position to the nearest segment within max_distance_meters. Returns the segment_id (-1 where no
+            segment is close enough), the distance to it in meters and the fraction of the way along it from its
+            from station."""
+        point_count = len(latitude)
+        segment_ids = np.full(point_count, -1, dtype=np.int64)
+        distances = np.full(point_count, np.inf)
+        fractions = np.full(point_count, np.nan)
+        x, y = self.to_local_meters(latitude, longitude)
+        is_valid = np.isfinite(x) & np.isfinite(y)
+        keys = self.get_cell_keys(self.get_cells(np.where(is_valid, x, 0)), self.get_cells(np.where(is_valid, y, 0)))
+        first = np.searchsorted(self.cell_keys, keys, side='left')
+        counts = np.where(is_valid, np.searchsorted(self.cell_keys, keys, side='right') - first, 0)
+        if counts.sum() == 0:
+            return segment_ids, distances, fractions
+
+        # Expand every position into one candidate row per segment registered in its cell
+        points = np.repeat(np.arange(point_count), counts)
+        candidate_offsets = np.arange(len(points)) - np.repeat(np.cumsum(counts) - counts, counts)
+        segments = self.cell_segments[np.repeat(first, counts) + candidate_offsets]
+        offset_x = x[points] - self.from_x[segments]
+        offset_y = y[points] - self.from_y[segments]
+        fraction = np.clip(
+            (offset_x * self.delta_x[segments] + offset_y * self.delta_y[segments]) / self.length_squared[segments],
+            0,
+            1
+        )
+        distance = np.hypot(offset_x - fraction * self.delta_x[segments], offset_y - fraction * self.delta_y[segments])
+
+        order = np.lexsort([distance, points])
+        nearest = order[np.flatnonzero(get_group_starts(points[order]))]
+        nearest = nearest[distance[nearest] <= self.max_distance_meters]
+        segment_ids[points[nearest]] = self.segment_ids[segments[nearest]]
+        distances[points[nearest]] = distance[nearest]
+        fractions[points[nearest]] = fraction[nearest]
+        return segment_ids, distances, fractions
+
+
+def compute_segment_observations(positions: pa.Table, index: SegmentGridIndex,
+                                 max_gap_seconds: float = MAX_PAIR_GAP_SECONDS) -> pa.Table:
+    """Returns a SEGMENT_OBSERVATIONS_SCHEMA table with the speed between each pair of consecutive positions of a run
+        at most max_gap_seconds apart, given positions sorted by train_id and current_timestamp. Each pair is
+        attributed to the segment its midpoint snaps to, and pairs whose midpoint is off the track are dropped."""
+    if positions.num_rows < 2:
+        return SEGMENT_OBSERVATIONS_SCHEMA.empty_table()
+
+    train_codes = to_codes(positions['train_id']).indices.to_numpy()
+    timestamps = to_microseconds(positions['current_timestamp'])
+    latitude = positions['latitude'].to_numpy()
+    longitude = positions['longitude'].to_numpy()
+    elapsed_seconds = (timestamps[1:] - timestamps[:-1]) / 1e6
+    is_pair = (train_codes[1:] == train_codes[:-1]) & (elapsed_seconds > 0) & (elapsed_seconds <= max_gap_seconds)
+    rows = np.flatnonzero(is_pair)
+    segment_ids, _, _ = index.snap(
+        latitude=(latitude[rows] + latitude[rows + 1]) / 2,
+        longitude=(longitude[rows] + longitude[rows + 1]) / 2
+    )
+    is_snapped = segment_ids >= 0
+    rows, segment_ids = rows[is_snapped], segment_ids[is_snapped]
+
+    x, y = index.to_local_meters(latitude, longitude)
+    distance_meters = np.hypot(x[rows + 1] - x[rows], y[rows + 1] - y[rows])
+    elapsed_seconds = elapsed_seconds[rows]
+    train_ids = positions['train_id'].take(pa.array(rows)).combine_chunks()
+    start_time = positions['current_timestamp'].take(pa.array(rows))
+    train_id_parts = split_train_ids(train_ids)
+    observations = pa.table(
+        {
+            'segment_id': pa.array(segment_ids, type=pa.int32()),
+            'train_id': train_ids,
+            'train_line': train_id_parts['train_line'],
+            'direction': train_id_parts['direction'],
+            'start_time': start_time,
+            'hour': pc.floor_temporal(start_time, unit='hour'),
+            'elapsed_seconds': pa.array(elapsed_seconds),
+            'distance_meters': pa.array(distance_meters),
+            'speed_meters_per_second': pa.array(distance_meters / elapsed_seconds)
+        }
+    )
+    logger.info('Computed %d segment speed observations from %d positions', observations.num_rows, positions.num_rows)
+    return observations.cast(SEGMENT_OBSERVATIONS_SCHEMA)
+
+
+def summarize_segment_speeds(observations: pa.Table, percentiles: Sequence[int] = SPEED_PERCENTILES) -> pa.Table:
+    """Aggregates a SEGMENT_OBSERVATIONS_SCHEMA table into one row per segment, train line, direction and hour with
+        the mean and exact (linearly interpolated) speed percentiles. Persistently low percentiles on a segment point
+        to a slow zone."""
+    schema = get_segment_speeds_schema(percentiles)
+    if observations.num_rows == 0:
+        return schema.empty_table()
+
+    group_codes = [
+        observations['segment_id'].to_numpy(),
+        to_codes(observations['train_line']).indices.to_numpy(),
+        to_codes(observations['direction']).indices.to_numpy(),
+        to_microseconds(observations['hour'])
+    ]
+    speeds = observations['speed_meters_per_second'].to_numpy()
+    order = np.lexsort([speeds] + group_codes[::-1])
+    group_starts = np.flatnonzero(get_group_starts(*[code[order] for code in group_codes]))
+    group_counts = np.diff(np.append(group_starts, len(order)))
+    sorted_speeds = speeds[order]
+    first_rows = pa.array(order[group_starts])
+
+    columns = {
+        'segment_id': observations['segment_id'].take(first_rows),
+        'train_line': observations['train_line'].take(first_rows),
+        'direction': observations['direction'].take(first_rows),
+        'hour': observations['hour'].take(first_rows),
+        'observation_count': pa.array(group_counts, type=pa.int64()),
+        'mean_speed_meters_per_second': pa.array(np.add.reduceat(sorted_speeds, group_starts) / group_counts)
+    }
+    for percentile in percentiles:
+        columns[f'p{percentile}_speed_meters_per_second'] = pa.array(
+            get_sorted_percentiles(sorted_speeds, group_starts, group_counts, percentile)
+        )
+    summary = pa.table(columns)
+    logger.info('Summarized %d speed observations into %d rows', observations.num_rows, summary.num_rows)
+    return summary.cast(schema)
+
+
+def main():
+    """Builds the track segments of a load date from the processed dataset and writes them, together with the hourly
+        segment speeds, as their own tables."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bucket', required=True, help='Bucket holding the processed dataset')
+    parser.add_argument('--load-date', required=True, type=datetime.date.fromisoformat, help='Load date to process')
+    parser.add_argument('--max-snap-distance-meters', type=float, default=MAX_SNAP_DISTANCE_METERS,
+                        help='Farthest a position can be from a segment and still be snapped to it')
+    args = parser.parse_args()
+
+    s3_client = create_s3_client()
+    snapshots = read_processed_day(
+        s3_client=s3_client,
+        bucket_name=args.bucket,
+        load_date=args.load_date,
+        columns=POSITION_COLUMNS
+    )
+    positions = get_positions(snapshots)
+    segments = derive_segments(positions=positions, stations=estimate_station_locations(positions))
+    index = SegmentGridIndex(segments=segments, max_distance_meters=args.max_snap_distance_meters)
+    observations = compute_segment_observations(positions=positions, index=index)
+    for name, table in (('track_segments', segments), ('segment_speeds', summarize_segment_speeds(observations))):
+        write_analytics_table(
+            table=table,
+            s3_client=s3_client,
+            bucket_name=args.bucket,
+            name=name,
+            load_date=args.load_date
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Derives station arrival and departure events for each train run from the per-minute processed snapshots.
+
+A run's snapshots are split into segments of consecutive snapshots heading to the same next station. When the next
+station changes, the train has passed the station of the previous segment, so each segment followed by another
+segment of the same run becomes an event. The arrival time is the last prediction for the station, clamped to the
+window between the last snapshot heading to it and the first snapshot heading beyond it, and the departure time is
+the end of that window. All of this is done with Arrow compute kernels and NumPy operations over the sorted day.
+
+Run from the repository root, after the setup in the Analytics section of the README, with:
+    python -m analytics.trip_events --bucket <bucket name> --load-date YYYY-MM-DD
+"""
+from typing import Dict
+import argparse
+import datetime
+import logging
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from analytics.datasets import read_processed_day, write_analytics_table
+from lambdas.bucket_raw_data.bucket_raw_data import PROCESSED_TIMEZONE, create_s3_client
+
+logger = logging.getLogger('cta-train-analytics-analytics')
+
+TIMESTAMP_TYPE = pa.timestamp('us', tz=PROCESSED_TIMEZONE)
+TRIP_EVENTS_SCHEMA = pa.schema(
+    [
+        ('train_id', pa.string()),
+        ('train_line', pa.dictionary(pa.int8(), pa.string())),
+        ('run_number', pa.string()),
+        ('direction', pa.dictionary(pa.int8(), pa.string())),
+        ('station', pa.dictionary(pa.int32(), pa.string())),
+        ('following_station', pa.dictionary(pa.int32(), pa.string())),
+        ('first_seen_time', TIMESTAMP_TYPE),
+        ('approach_time', TIMESTAMP_TYPE),
+        ('arrival_time', TIMESTAMP_TYPE),
+        ('departure_time', TIMESTAMP_TYPE),
+        ('observation_gap_seconds', pa.float64())
+    ]
+)
+SNAPSHOT_COLUMNS = ['train_id', 'current_timestamp', 'next_station', 'next_station_arrival_time',
+                    'is_approaching_station']
+
+
+def to_microseconds(column: pa.ChunkedArray) -> np.ndarray:
+    """Returns a timestamp column as an int64 NumPy array of microseconds since the epoch. Nulls become the minimum
+        int64 value."""
+    return pc.fill_null(column.cast(pa.int64()), np.iinfo(np.int64).min).to_numpy()
+
+
+def to_codes(column: pa.ChunkedArray) -> pa.DictionaryArray:
+    """Returns a string or dictionary column as a single dictionary array whose indices can be compared."""
+    return pc.dictionary_encode(column.cast(pa.string())).combine_chunks()
+
+
+def split_train_ids(train_ids: pa.Array) -> Dict[str, pa.Array]:
+    """Returns the train line, run number and direction parts of train IDs of the form date#line#run#direction."""
+    parts = pc.split_pattern(train_ids, pattern='#')
+    return {
+        'train_line': pc.list_element(parts, 1),
+        'run_number': pc.list_element(parts, 2),
+        'direction': pc.list_element(parts, 3)
+    }
+
+
+def derive_trip_events(snapshots: pa.Table) -> pa.Table:
+    """Derives a TRIP_EVENTS_SCHEMA table with one row per station passed by each run from a table of processed
+        snapshots. Snapshots without a next station or current timestamp are ignored."""
+    snapshots = snapshots.select(SNAPSHOT_COLUMNS).filter(
+        pc.and_(pc.is_valid(snapshots['next_station']), pc.is_valid(snapshots['current_timestamp']))
+    )
+    if snapshots.num_rows == 0:
+        return TRIP_EVENTS_SCHEMA.empty_table()
+    snapshots = snapshots.sort_by([('train_id', 'ascending'), ('current_timestamp', 'ascending')])
+    row_count = snapshots.num_rows
+
+    train_codes = to_codes(snapshots['train_id']).indices.to_numpy()
+    stations = to_codes(snapshots['next_station'])
+    station_codes = stations.indices.to_numpy()
+    timestamps = to_microseconds(snapshots['current_timestamp'])
+    predictions = to_microseconds(snapshots['next_station_arrival_time'])
+    approaching = pc.fill_null(snapshots['is_approaching_station'], False).to_numpy()
+
+    # A segment starts at each new run and at each change of next station within a run
+    new_run = np.ones(row_count, dtype=bool)
+    new_run[1:] = train_codes[1:] != train_codes[:-1]
+    new_segment = new_run.copy()
+    new_segment[1:] |= station_codes[1:] != station_codes[:-1]
+    segment_starts = np.flatnonzero(new_segment)
+    segment_ends = np.append(segment_starts[1:], row_count) - 1
+
+    # Only segments followed by another segment of the same run have been passed
+    passed = np.zeros(len(segment_starts), dtype=bool)
+    passed[:-1] = ~new_run[segment_starts[1:]]
+    no_approach = np.iinfo(np.int64).max
+    approach_times = np.minimum.reduceat(np.where(approaching, timestamps, no_approach), segment_starts)[passed]
+    starts = segment_starts[passed]
+    ends = segment_ends[passed]
+    window_starts = timestamps[ends]
+    window_ends = timestamps[ends + 1]
+    last_predictions = predictions[ends]
+    has_prediction = last_predictions != np.iinfo(np.int64).min
+    arrival_times = np.where(has_prediction, np.clip(last_predictions, window_starts, window_ends), window_ends)
+
+    train_ids = snapshots['train_id'].take(pa.array(starts)).combine_chunks()
+    train_id_parts = split_train_ids(train_ids)
+    events = pa.table(
+        {
+            'train_id': train_ids,
+            'train_line': train_id_parts['train_line'],
+            'run_number': train_id_parts['run_number'],
+            'direction': train_id_parts['direction'],
+            'station': stations.dictionary.take(pa.array(station_codes[ends])),
+            'following_station': stations.dictionary.take(pa.array(station_codes[ends + 1])),
+            'first_seen_time': pa.array(timestamps[starts]).cast(TIMESTAMP_TYPE),
+            'approach_time': pa.array(approach_times, mask=approach_times == no_approach).cast(TIMESTAMP_TYPE),
+            'arrival_time': pa.array(arrival_times).cast(TIMESTAMP_TYPE),
+            'departure_time': pa.array(window_ends).cast(TIMESTAMP_TYPE),
+            'observation_gap_seconds': pa.array((window_ends - window_starts) / 1e6)
+        }
+    )
+    logger.info('Derived %d trip events from %d snapshots', events.num_rows, row_count)
+    return events.cast(TRIP_EVENTS_SCHEMA)
+
+
+def main():
+    """Derives the trip events of a load date from the processed dataset and writes them as their own table."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bucket', required=True, help='Bucket holding the processed dataset')
+    parser.add_argument('--load-date', required=True, type=datetime.date.fromisoformat, help='Load date to process')
+    args = parser.parse_args()
+
+    s3_client = create_s3_client()
+    snapshots = read_processed_day(s3_client=s3_client, bucket_name=args.bucket, load_date=args.load_date)
+    events = derive_trip_events(snapshots)
+    write_analytics_table(
+        table=events,
+        s3_client=s3_client,
+        bucket_name=args.bucket,
+        name='trip_events',
+        load_date=args.load_date
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Benchmark comparing the json.loads and pyarrow.json parser backends of bucket_raw_data on a synthetic full day.
+
+Run from the repository root with:
+    python -m benchmarks.benchmark_json_parsers [--objects 96] [--trains-per-minute 116] [--repeat 3]
+
+Throughput depends heavily on the CPU and the number of cores Arrow can use, so the machine is printed with the
+results and figures should only be quoted alongside it.
+"""
+from typing import Dict, Any, List
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import time
+import zoneinfo
+
+import botocore.response
+import pyarrow as pa
+
+from lambdas.bucket_raw_data.bucket_raw_data import read_raw_record_batches, JSON_PARSER_BACKENDS
+
+TRAIN_LINES = ['Red', 'Blue', 'Brown', 'Green', 'Orange', 'Purple', 'Pink']
+STATIONS = ['Howard', 'Belmont', 'Fullerton', 'Clark/Lake', 'Jackson', 'Roosevelt', 'Cermak-Chinatown', '95th/Dan Ryan']
+
+
+class InMemoryS3Client:
+    """Minimal stand-in for the S3 client serving objects held in memory, so only parsing is measured."""
+
+    def __init__(self, objects: Dict[str, bytes]):
+        """Initializes the client with a mapping of object keys to object contents."""
+        self.objects = objects
+
+    def get_object(self, Bucket: str, Key: str) -> Dict[str, Any]:
+        """Returns the object with a streaming body, as S3 GetObject does."""
+        data = self.objects[Key]
+        return {'Body': botocore.response.StreamingBody(io.BytesIO(data), len(data))}
+
+
+def generate_day(num_objects: int, trains_per_minute: int) -> Dict[str, bytes]:
+    """Generates a day of raw NDJSON objects as delivered by Firehose, one object per 1440 / num_objects minutes."""
+    random.seed(0)
+    timezone = zoneinfo.ZoneInfo('America/Chicago')
+    start = datetime.datetime(2025, 6, 20, tzinfo=timezone)
+    minutes_per_object = 1440 // num_objects
+    objects = {}
+    for object_index in range(num_objects):
+        lines = []
+        for minute in range(object_index * minutes_per_object, (object_index + 1) * minutes_per_object):
+            current_timestamp = start + datetime.timedelta(minutes=minute)
+            prediction_timestamp = current_timestamp.replace(tzinfo=None)
+            for train in range(trains_per_minute):
+                record = {
+                    'train_id': f'2025-06-20#{TRAIN_LINES[train % 7]}#{100 + train}#{1 + train % 2}',
+                    'current_timestamp': current_timestamp.isoformat(),
+                    'prediction_generated_timestamp': prediction_timestamp.isoformat(timespec='seconds'),
+                    'destination_station': random.choice(STATIONS),
+                    'next_station': random.choice(STATIONS),
+                    'next_station_arrival_time': (prediction_timestamp + datetime.timedelta(minutes=2)).isoformat(
+                        timespec='seconds'
+                    ),
+                    'is_approaching_station': random.choice(['0', '1']),
+                    'is_train_delayed': random.choice(['0', '0', '0', '1'])
+                }
+                lines.append(json.dumps(record))
+        objects[f'raw/2025/06/20/{object_index:04d}'] = ('\n'.join(lines) + '\n').encode('utf-8')
+    return objects
+
+
+def run_backend(s3_client: InMemoryS3Client, keys: List[str], backend: str, concurrency: int) -> int:
+    """Parses every object into raw record batches with the given backend and returns the number of rows."""
+    raw_batches = read_raw_record_batches(
+        s3_client=s3_client,
+        bucket_name='benchmark-bucket',
+        keys=keys,
+        concurrency=concurrency,
+        backend=backend
+    )
+    return sum(raw_batch.num_rows for raw_batch in raw_batches)
+
+
+def main():
+    """Runs the benchmark and prints rows/second for each backend."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--objects', type=int, default=96, help='Number of raw objects in the day')
+    parser.add_argument('--trains-per-minute', type=int, default=116, help='Trains reported each minute')
+    parser.add_argument('--concurrency', type=int, default=1, help='Concurrent object reads')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per backend, the fastest is reported')
+    args = parser.parse_args()
+
+    objects = generate_day(num_objects=args.objects, trains_per_minute=args.trains_per_minute)
+    s3_client = InMemoryS3Client(objects=objects)
+    keys = sorted(objects)
+    total_bytes = sum(len(data) for data in objects.values())
+    print(f'Machine: {platform.machine()}, {os.cpu_count()} CPUs, Python {platform.python_version()}, '
+          f'pyarrow {pa.__version__}')
+    print(f'Synthetic day: {len(keys)} objects, {total_bytes / 1024 / 1024:.1f} MiB')
+
+    results = {}
+    for backend in JSON_PARSER_BACKENDS:
+        timings = []
+        for _ in range(args.repeat):
+            start_time = time.perf_counter()
+            rows = run_backend(s3_client=s3_client, keys=keys, backend=backend, concurrency=args.concurrency)
+            timings.append(time.perf_counter() - start_time)
+        results[backend] = rows / min(timings)
+        print(f'{backend:>8}: {rows} rows in {min(timings):.2f} s ({results[backend]:,.0f} rows/s)')
+    print(f'Speedup of arrow over python: {results["arrow"] / results["python"]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
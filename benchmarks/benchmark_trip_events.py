@@ -0,0 +1,76 @@
+"""Benchmark of analytics.trip_events on a synthetic full system day of processed snapshots.
+
+Run from the repository root with:
+    python -m benchmarks.benchmark_trip_events [--trains-per-minute 116] [--minutes-per-station 2] [--repeat 3]
+"""
+import argparse
+import datetime
+import time
+import zoneinfo
+
+import numpy as np
+import pyarrow as pa
+
+from analytics.trip_events import derive_trip_events
+from lambdas.bucket_raw_data.bucket_raw_data import PROCESSED_SCHEMA
+
+TRAIN_LINES = ['Red', 'Blue', 'Brown', 'Green', 'Orange', 'Purple', 'Pink']
+STATIONS = [f'Station {index}' for index in range(40)]
+
+
+def generate_day(trains_per_minute: int, minutes_per_station: int) -> pa.Table:
+    """Generates a day of processed snapshots with each train reported every minute and moving on to the next
+        station every minutes_per_station minutes, shuffled as rows from different partitions would be."""
+    rng = np.random.default_rng(0)
+    start = datetime.datetime(2025, 6, 20, tzinfo=zoneinfo.ZoneInfo('America/Chicago'))
+    minutes = np.repeat(np.arange(1440), trains_per_minute)
+    trains = np.tile(np.arange(trains_per_minute), 1440)
+    order = rng.permutation(len(minutes))
+    minutes, trains = minutes[order], trains[order]
+    start_us = int(start.timestamp() * 1e6)
+    current_us = start_us + minutes * 60_000_000
+    station_index = (minutes // minutes_per_station + trains) % len(STATIONS)
+    next_station_minute = (minutes // minutes_per_station + 1) * minutes_per_station
+    train_ids = np.array(
+        [f'2025-06-20#{TRAIN_LINES[train % 7]}#{100 + train}#{1 + train % 2}' for train in range(trains_per_minute)]
+    )
+    columns = {
+        'train_id': pa.array(train_ids[trains]),
+        'current_timestamp': pa.array(current_us),
+        'prediction_generated_timestamp': pa.array(current_us),
+        'destination_station': pa.array(np.array(STATIONS)[(trains * 7) % len(STATIONS)]),
+        'next_station': pa.array(np.array(STATIONS)[station_index]),
+        'next_station_arrival_time': pa.array(start_us + next_station_minute * 60_000_000 - 20_000_000),
+        'is_approaching_station': pa.array(next_station_minute - minutes == 1),
+        'is_train_delayed': pa.array(rng.random(len(minutes)) < 0.05),
+        'record_type': pa.array(np.full(len(minutes), 'keyframe'))
+    }
+    # Columns the trip events do not use, such as the train positions, are left null
+    return pa.table(
+        {
+            field.name: columns.get(field.name, pa.nulls(len(minutes))).cast(field.type)
+            for field in PROCESSED_SCHEMA
+        }
+    )
+
+
+def main():
+    """Runs the benchmark and prints snapshots/second."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--trains-per-minute', type=int, default=116, help='Trains reported each minute')
+    parser.add_argument('--minutes-per-station', type=int, default=2, help='Minutes between stations')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs, the fastest is reported')
+    args = parser.parse_args()
+
+    snapshots = generate_day(trains_per_minute=args.trains_per_minute, minutes_per_station=args.minutes_per_station)
+    print(f'Synthetic day: {snapshots.num_rows} snapshots')
+    timings = []
+    for _ in range(args.repeat):
+        start_time = time.perf_counter()
+        events = derive_trip_events(snapshots)
+        timings.append(time.perf_counter() - start_time)
+    print(f'{events.num_rows} events in {min(timings):.2f} s ({snapshots.num_rows / min(timings):,.0f} snapshots/s)')
+
+
+if __name__ == '__main__':
+    main()
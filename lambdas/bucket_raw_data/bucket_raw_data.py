@@ -1,14 +1,24 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Iterable, Iterator, Tuple, Callable, Union, Optional
+import collections
+import concurrent.futures
+import itertools
 import logging
 import os
 import json
 import datetime
+import io
+import time
+import zlib
 import zoneinfo
 import uuid
 
 import boto3
+import botocore.config
+import botocore.exceptions
 from dotenv import load_dotenv
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json
 import pyarrow.parquet as pq
 from retry_api_exceptions import backoff_on_client_error
 
@@ -25,52 +35,1015 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
+GZIP_MAGIC = b'\x1f\x8b'
+READ_CHUNK_BYTES = 64 * 1024
+POLL_INTERVAL_SECONDS = 60
+DELTA_MAX_FILL_SECONDS = 900
+S3_READ_CONCURRENCY = 8
+PARQUET_ROW_GROUP_SIZE = 50000
+PROCESSED_TIMEZONE = 'America/Chicago'
+API_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+JSON_PARSER_BACKENDS = ('python', 'arrow')
+ARROW_JSON_BLOCK_SIZE = 1024 * 1024
+S3_UPLOAD_PART_SIZE = 8 * 1024 * 1024
+# Firehose buffers records for up to 900 seconds, so an hour is complete once rows twice that far past it are seen
+PARTITION_LATENESS_SECONDS = 1800
+PARTITION_SORT_KEYS = [('train_id', 'ascending'), ('current_timestamp', 'ascending')]
+COMPACTION_MODES = ('daily', 'incremental')
+MANIFEST_PREFIX = 'processed/_manifest/'
+# Lambda invocations run for at most 15 minutes, so a compaction run started longer ago than this has ended
+COMPACTION_RUN_TIMEOUT_SECONDS = 900
+# Rollups are kept under their own prefix so they outlive the processed rows, which expire after a few days
+ROLLUP_PREFIX = 'rollups/'
+# Parquet metadata key of a rollup table holding the processed objects merged into it last
+ROLLUP_MERGED_PARTS_KEY = b'merged_parts'
+
+# Schema of the raw rows written by get_train_status, where every value is a string
+RAW_SCHEMA = pa.schema(
+    [
+        ('train_id', pa.string()),
+        ('current_timestamp', pa.string()),
+        ('prediction_generated_timestamp', pa.string()),
+        ('destination_station', pa.string()),
+        ('next_station', pa.string()),
+        ('next_station_arrival_time', pa.string()),
+        ('is_approaching_station', pa.string()),
+        ('is_train_delayed', pa.string()),
+        ('record_type', pa.string()),
+        ('next_station_id', pa.string()),
+        ('destination_station_id', pa.string()),
+        ('latitude', pa.string()),
+        ('longitude', pa.string()),
+        ('heading', pa.string())
+    ]
+)
+PROCESSED_SCHEMA = pa.schema(
+    [
+        ('train_id', pa.string()),
+        ('current_timestamp', pa.timestamp('us', tz=PROCESSED_TIMEZONE)),
+        ('prediction_generated_timestamp', pa.timestamp('us', tz=PROCESSED_TIMEZONE)),
+        ('destination_station', pa.dictionary(pa.int32(), pa.string())),
+        ('next_station', pa.dictionary(pa.int32(), pa.string())),
+        ('next_station_arrival_time', pa.timestamp('us', tz=PROCESSED_TIMEZONE)),
+        ('is_approaching_station', pa.bool_()),
+        ('is_train_delayed', pa.bool_()),
+        ('record_type', pa.dictionary(pa.int8(), pa.string())),
+        ('next_station_id', pa.dictionary(pa.int32(), pa.string())),
+        ('destination_station_id', pa.dictionary(pa.int32(), pa.string())),
+        ('latitude', pa.float64()),
+        ('longitude', pa.float64()),
+        ('heading', pa.int16())
+    ]
+)
+ROLLUP_SCHEMAS = {
+    'train_minutes': pa.schema(
+        [
+            ('train_line', pa.string()),
+            ('minute', pa.timestamp('us', tz=PROCESSED_TIMEZONE)),
+            ('train_id', pa.string()),
+            ('delayed', pa.bool_())
+        ]
+    ),
+    'trains_by_minute': pa.schema(
+        [
+            ('train_line', pa.string()),
+            ('minute', pa.timestamp('us', tz=PROCESSED_TIMEZONE)),
+            ('trains_in_service', pa.int64()),
+            ('delayed_trains', pa.int64())
+        ]
+    ),
+    'runs_by_hour': pa.schema(
+        [
+            ('train_line', pa.string()),
+            ('hour', pa.timestamp('us', tz=PROCESSED_TIMEZONE)),
+            ('train_id', pa.string()),
+            ('snapshot_count', pa.int64()),
+            ('delayed_count', pa.int64()),
+            ('first_seen', pa.timestamp('us', tz=PROCESSED_TIMEZONE)),
+            ('last_seen', pa.timestamp('us', tz=PROCESSED_TIMEZONE))
+        ]
+    ),
+    'lines_by_hour': pa.schema(
+        [
+            ('train_line', pa.string()),
+            ('hour', pa.timestamp('us', tz=PROCESSED_TIMEZONE)),
+            ('runs_in_service', pa.int64()),
+            ('snapshot_count', pa.int64()),
+            ('delayed_count', pa.int64()),
+            ('delayed_share', pa.float64())
+        ]
+    )
+}
+# Group keys and aggregations that merge partial rollups of the same load date; trains_by_minute and lines_by_hour are
+# derived from train_minutes and runs_by_hour after merging, since distinct counts cannot be summed across partials
+ROLLUP_MERGE_AGGREGATIONS = {
+    'train_minutes': (['train_line', 'minute', 'train_id'], [('delayed', 'any')]),
+    'runs_by_hour': (
+        ['train_line', 'hour', 'train_id'],
+        [('snapshot_count', 'sum'), ('delayed_count', 'sum'), ('first_seen', 'min'), ('last_seen', 'max')]
+    )
+}
+
+
+def create_s3_client(max_pool_connections: int = S3_READ_CONCURRENCY) -> boto3.client:
+    """Creates an S3 client whose connection pool is large enough to be shared by all concurrent readers."""
+    return boto3.client('s3', config=botocore.config.Config(max_pool_connections=max_pool_connections))
+
 
 @backoff_on_client_error
-def get_object_keys(s3_client: boto3.client, bucket_name: str, prefix: str) -> List[str]:
-    """Retrieves a list of object keys within the specified S3 bucket and prefix."""
+def get_object_etags(s3_client: boto3.client, bucket_name: str, prefix: str) -> Dict[str, str]:
+    """Retrieves the ETag of each object within the specified S3 bucket and prefix, keyed by object key."""
     paginator = s3_client.get_paginator('list_objects_v2')
     page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
 
-    json_files = []
+    object_etags = {}
     for page in page_iterator:
         for obj in page.get('Contents', []):
             logger.info('Found object: %s', obj['Key'])
-            json_files.append(obj['Key'])
-    return json_files
+            object_etags[obj['Key']] = obj['ETag']
+    return object_etags
+
+
+def iter_decompressed_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Yields the NDJSON bytes of a Firehose output object. Aggregated records written with gzip compression are
+        delivered as gzip members concatenated with any uncompressed records, so each member is transparently
+        decompressed in place. Raw JSON text never contains the gzip magic byte 0x1f, which makes the member
+        boundaries unambiguous."""
+    decompressor = None
+    pending = b''
+    for chunk in chunks:
+        chunk = pending + chunk
+        pending = b''
+        while chunk:
+            if decompressor is None:
+                magic_position = chunk.find(GZIP_MAGIC)
+                if magic_position == -1:
+                    # The magic bytes may be split across two chunks
+                    if chunk.endswith(GZIP_MAGIC[:1]):
+                        chunk, pending = chunk[:-1], chunk[-1:]
+                    yield chunk
+                    break
+                if magic_position > 0:
+                    yield chunk[:magic_position]
+                chunk = chunk[magic_position:]
+                decompressor = zlib.decompressobj(wbits=31)
+            yield decompressor.decompress(chunk)
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                decompressor = None
+            else:
+                chunk = b''
+    if decompressor is not None:
+        raise ValueError('Truncated gzip member in Firehose output object.')
+    if pending:
+        yield pending
+
+
+def iter_ndjson_lines(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Yields the non-empty lines of newline-delimited data arriving in chunks, holding at most one partial line
+        between chunks."""
+    partial_line = b''
+    for chunk in chunks:
+        lines = (partial_line + chunk).split(b'\n')
+        partial_line = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield line
+    if partial_line.strip():
+        yield partial_line
+
+
+@backoff_on_client_error
+def get_s3_object_body(s3_client: boto3.client, bucket_name: str, key: str):
+    """Returns the streaming body of an S3 object."""
+    response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    return response['Body']
+
+
+def iter_s3_object_records(s3_client: boto3.client, bucket_name: str, key: str,
+                           chunk_size: int = READ_CHUNK_BYTES) -> Iterator[Dict[str, Any]]:
+    """Yields the records of an NDJSON object in S3 while streaming the response body in chunks of chunk_size bytes,
+        so peak memory is bounded by the chunk size rather than the object size. Aggregated and gzip-compressed
+        Firehose records are de-aggregated and decompressed transparently."""
+    body = get_s3_object_body(s3_client=s3_client, bucket_name=bucket_name, key=key)
+    record_count = 0
+    for line in iter_ndjson_lines(iter_decompressed_chunks(body.iter_chunks(chunk_size=chunk_size))):
+        record_count += 1
+        yield json.loads(line)
+    logger.info('Read %d records from S3 object: %s', record_count, key)
 
 
 @backoff_on_client_error
 def read_s3_object(s3_client: boto3.client, bucket_name: str, key: str) -> List[Dict[str, Any]]:
     """Reads a JSON object from S3 and returns it as a list of dictionaries."""
-    response = s3_client.get_object(Bucket=bucket_name, Key=key)
-    data = response['Body'].read().decode('utf-8')
-    records = []
-    for line in data.strip().split('\n'):
-        if line.strip():
-            records.append(json.loads(line))
-    logger.info('Read %d records from S3 object: %s', len(records), key)
-    return records
+    return list(iter_s3_object_records(s3_client=s3_client, bucket_name=bucket_name, key=key))
 
 
-def write_local_parquet_file(data: List[Dict[str, Any]]) -> None:
-    """Writes the provided data to a Parquet file at /tmp directory."""
-    table = pa.Table.from_pylist(data)
-    output_dir = f'/tmp'
-    os.makedirs(name=output_dir, exist_ok=True)
-    pq.write_table(table=table, where=f'{output_dir}/{uuid.uuid4()}.parquet')
+@backoff_on_client_error
+def read_s3_object_records_table(s3_client: boto3.client, bucket_name: str, key: str,
+                                 batch_size: int = PARQUET_ROW_GROUP_SIZE) -> pa.Table:
+    """Reads an NDJSON object from S3 with json.loads into an Arrow table with RAW_SCHEMA. Records are streamed and
+        converted batch_size at a time, so only one batch of Python dictionaries is held while the object is read."""
+    record_batches = list(
+        iter_record_batches(
+            records=iter_s3_object_records(s3_client=s3_client, bucket_name=bucket_name, key=key),
+            batch_size=batch_size,
+            schema=RAW_SCHEMA
+        )
+    )
+    return pa.Table.from_batches(record_batches, schema=RAW_SCHEMA)
 
 
 @backoff_on_client_error
-def upload_parquet_to_s3(s3_client: boto3.client, local_dir: str, bucket_name: str, prefix: str) -> None:
-    """Uploads Parquet files from the local directory to the specified S3 bucket and prefix."""
-    for root, _, files in os.walk(local_dir):
-        for file in files:
-            local_path = os.path.join(root, file)
-            relative_path = os.path.relpath(path=local_path, start=local_dir)
-            s3_key = os.path.join(prefix, relative_path).replace('\\', '/')
-            logger.info(f'Uploading {local_path} to s3://{bucket_name}/{s3_key}')
-            s3_client.upload_file(Filename=local_path, Bucket=bucket_name, Key=s3_key)
+def read_s3_object_table(s3_client: boto3.client, bucket_name: str, key: str) -> pa.Table:
+    """Reads an NDJSON object from S3 into an Arrow table with RAW_SCHEMA using Arrow's multithreaded JSON reader,
+        without creating a Python object per row. Aggregated and gzip-compressed Firehose records are de-aggregated
+        and decompressed transparently."""
+    body = get_s3_object_body(s3_client=s3_client, bucket_name=bucket_name, key=key)
+    data = b''.join(iter_decompressed_chunks(body.iter_chunks(chunk_size=READ_CHUNK_BYTES)))
+    if not data.strip():
+        return RAW_SCHEMA.empty_table()
+    table = pyarrow.json.read_json(
+        pa.BufferReader(data),
+        read_options=pyarrow.json.ReadOptions(use_threads=True, block_size=ARROW_JSON_BLOCK_SIZE),
+        parse_options=pyarrow.json.ParseOptions(explicit_schema=RAW_SCHEMA, unexpected_field_behavior='ignore')
+    )
+    logger.info('Read %d records from S3 object: %s', table.num_rows, key)
+    return table.select(RAW_SCHEMA.names)
+
+
+def read_s3_objects_concurrently(
+    s3_client: boto3.client,
+    bucket_name: str,
+    keys: List[str],
+    concurrency: int = S3_READ_CONCURRENCY,
+    reader: Callable = None
+) -> Iterator[Tuple[str, Union[List[Dict[str, Any]], pa.Table]]]:
+    """Reads S3 objects on a bounded thread pool and yields (key, records) tuples in the same order as keys, so the
+        output is deterministic. At most concurrency objects are in flight or waiting to be consumed at a time, and
+        each is held whole, so peak memory is about concurrency times the largest decoded object. The reader defaults
+        to read_s3_object, while read_s3_object_table and read_s3_object_records_table yield Arrow tables, which take
+        far less memory than lists of records."""
+    reader = reader or read_s3_object
+    object_read_times_ms = []
+
+    def read(key: str) -> Union[List[Dict[str, Any]], pa.Table]:
+        start_time = time.perf_counter()
+        records = reader(s3_client=s3_client, bucket_name=bucket_name, key=key)
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        object_read_times_ms.append(elapsed_ms)
+        logger.info('Fetched %d records from %s in %.1f ms', len(records), key, elapsed_ms)
+        return records
+
+    start_time = time.perf_counter()
+    keys_iterator = iter(keys)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        pending = collections.deque()
+        for key in keys_iterator:
+            pending.append((key, executor.submit(read, key)))
+            if len(pending) >= concurrency:
+                break
+        while pending:
+            key, future = pending.popleft()
+            records = future.result()
+            next_key = next(keys_iterator, None)
+            if next_key is not None:
+                pending.append((next_key, executor.submit(read, next_key)))
+            yield key, records
+
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    if object_read_times_ms:
+        logger.info(
+            'Read %d objects with concurrency %d in %.1f ms (total object read time %.1f ms, slowest %.1f ms)',
+            len(object_read_times_ms),
+            concurrency,
+            elapsed_ms,
+            sum(object_read_times_ms),
+            max(object_read_times_ms)
+        )
+
+
+def expand_delta_records(records: List[Dict[str, Any]], interval_seconds: int = POLL_INTERVAL_SECONDS,
+                         max_fill_seconds: int = DELTA_MAX_FILL_SECONDS,
+                         delta_state: Optional[Dict[str, Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """Rebuilds the dense per-poll view from records written by get_train_status in delta mode. Each emitted row is
+        repeated every interval_seconds until the next row for the same train, a removed row, or max_fill_seconds
+        (the keyframe interval, after which a running train is always re-emitted). Repeated rows are marked with
+        record_type "filled". Records without a record_type are returned unchanged. If a delta_state dictionary is
+        given, the last row of each train carried over from the previous run is repeated from where that run
+        stopped, and the dictionary is updated in place with the rows to carry over into the next run, keyed by
+        train_id."""
+    if not any(record.get('record_type') for record in records):
+        return records
+
+    # Each train's rows are (timestamp, record, filled until), where only a carried over row was already filled
+    records_by_train = {}
+    for train_id, state in (delta_state or {}).items():
+        timestamp = datetime.datetime.fromisoformat(state['record']['current_timestamp'])
+        filled_until = datetime.datetime.fromisoformat(state['filled_until'])
+        records_by_train[train_id] = [(timestamp, state['record'], filled_until)]
+    for record in records:
+        timestamp = datetime.datetime.fromisoformat(record['current_timestamp'])
+        records_by_train.setdefault(record['train_id'], []).append((timestamp, record, None))
+    last_poll_timestamp = max(datetime.datetime.fromisoformat(record['current_timestamp']) for record in records)
+
+    interval = datetime.timedelta(seconds=interval_seconds)
+    max_fill = datetime.timedelta(seconds=max_fill_seconds)
+    expanded_records = []
+    carried_state = {}
+    for train_id, train_records in records_by_train.items():
+        train_records.sort(key=lambda item: item[0])
+        for index, (timestamp, record, filled_until) in enumerate(train_records):
+            if record.get('record_type') == 'removed':
+                continue
+            fill_timestamp = timestamp + interval
+            if filled_until is None:
+                expanded_records.append((timestamp, record))
+            else:
+                while fill_timestamp < filled_until:
+                    fill_timestamp += interval
+            is_last = index + 1 == len(train_records)
+            if is_last:
+                fill_until = min(last_poll_timestamp + interval, timestamp + max_fill)
+            else:
+                fill_until = min(train_records[index + 1][0], timestamp + max_fill)
+            while fill_timestamp < fill_until:
+                filled_record = {**record, 'current_timestamp': fill_timestamp.isoformat(), 'record_type': 'filled'}
+                expanded_records.append((fill_timestamp, filled_record))
+                fill_timestamp += interval
+            # A train still within its fill window at the last poll is filled further by the next run
+            if is_last and fill_timestamp < timestamp + max_fill:
+                carried_state[train_id] = {'record': record, 'filled_until': fill_timestamp.isoformat()}
+    if delta_state is not None:
+        delta_state.clear()
+        delta_state.update(carried_state)
+    expanded_records.sort(key=lambda item: (item[0], item[1]['train_id']))
+    logger.info('Expanded %d delta records into %d records', len(records), len(expanded_records))
+    return [record for _, record in expanded_records]
+
+
+def iter_record_batches(records: Iterable[Dict[str, Any]], batch_size: int = PARQUET_ROW_GROUP_SIZE,
+                        schema: pa.Schema = None) -> Iterator[pa.RecordBatch]:
+    """Converts records into Arrow record batches of up to batch_size rows as they are read, so only one batch of
+        Python dictionaries is held in memory at a time. Without a schema, it is inferred from the first batch and
+        applied to all later batches."""
+    records_iterator = iter(records)
+    while True:
+        batch_records = list(itertools.islice(records_iterator, batch_size))
+        if not batch_records:
+            return
+        record_batch = pa.RecordBatch.from_pylist(batch_records, schema=schema)
+        schema = record_batch.schema
+        yield record_batch
+
+
+def rebatch_record_batches(record_batches: Iterable[pa.RecordBatch],
+                           batch_size: int = PARQUET_ROW_GROUP_SIZE) -> Iterator[pa.RecordBatch]:
+    """Regroups record batches of arbitrary sizes into batches of batch_size rows, buffering at most one batch."""
+    buffered_batches = []
+    buffered_rows = 0
+    for record_batch in record_batches:
+        buffered_batches.append(record_batch)
+        buffered_rows += record_batch.num_rows
+        while buffered_rows >= batch_size:
+            table = pa.Table.from_batches(buffered_batches)
+            yield table.slice(0, batch_size).combine_chunks().to_batches()[0]
+            remainder = table.slice(batch_size)
+            buffered_batches = remainder.to_batches()
+            buffered_rows = remainder.num_rows
+    if buffered_rows:
+        yield pa.Table.from_batches(buffered_batches).combine_chunks().to_batches()[0]
+
+
+def read_raw_record_batches(s3_client: boto3.client, bucket_name: str, keys: List[str], concurrency: int,
+                            backend: str = 'python', batch_size: int = PARQUET_ROW_GROUP_SIZE,
+                            expand_delta: bool = False, interval_seconds: int = POLL_INTERVAL_SECONDS,
+                            max_fill_seconds: int = DELTA_MAX_FILL_SECONDS,
+                            delta_state: Optional[Dict[str, Dict[str, Any]]] = None) -> Iterator[pa.RecordBatch]:
+    """Reads the raw objects concurrently and yields RAW_SCHEMA record batches of batch_size rows. The python backend
+        parses each line with json.loads, while the arrow backend hands the NDJSON bytes to Arrow's JSON reader.
+        Either way each object is converted to Arrow in the thread that read it, so the objects held by the
+        concurrent reader are columnar. With expand_delta, the records are collected and expanded with
+        expand_delta_records before batching, filling every interval_seconds and carrying trains over between runs
+        in delta_state."""
+    if backend not in JSON_PARSER_BACKENDS:
+        raise ValueError(f'Unsupported JSON parser backend: {backend}')
+    objects = read_s3_objects_concurrently(
+        s3_client=s3_client,
+        bucket_name=bucket_name,
+        keys=keys,
+        concurrency=concurrency,
+        reader=read_s3_object_table if backend == 'arrow' else read_s3_object_records_table
+    )
+    record_batches = (record_batch for _, table in objects for record_batch in table.to_batches())
+    if not expand_delta:
+        yield from rebatch_record_batches(record_batches=record_batches, batch_size=batch_size)
+        return
+    # Expansion needs every record of a train, so delta data is collected before it is written
+    records = expand_delta_records(
+        records=[record for record_batch in record_batches for record in record_batch.to_pylist()],
+        interval_seconds=interval_seconds,
+        max_fill_seconds=max_fill_seconds,
+        delta_state=delta_state
+    )
+    yield from iter_record_batches(records=records, batch_size=batch_size, schema=RAW_SCHEMA)
+
+
+def convert_to_processed_schema(record_batch: pa.RecordBatch) -> pa.RecordBatch:
+    """Converts a batch of raw string columns to PROCESSED_SCHEMA with vectorized Arrow kernels. The current
+        timestamp carries its UTC offset, while the API timestamps are local Chicago time without an offset. The
+        "0"/"1" flags become booleans, station names and IDs are dictionary-encoded, and blank coordinates or headings
+        become nulls. Raises a ValueError naming the column on the first value that cannot be converted."""
+    columns = []
+    for field in PROCESSED_SCHEMA:
+        column = record_batch.column(field.name)
+        try:
+            if pa.types.is_timestamp(field.type) and field.name != 'current_timestamp':
+                local_timestamps = pc.strptime(column, format=API_TIMESTAMP_FORMAT, unit=field.type.unit)
+                column = pc.assume_timezone(
+                    local_timestamps,
+                    timezone=PROCESSED_TIMEZONE,
+                    ambiguous='earliest',
+                    nonexistent='earliest'
+                )
+            elif pa.types.is_floating(field.type) or pa.types.is_integer(field.type):
+                column = pc.if_else(pc.equal(column, ''), pa.scalar(None, pa.string()), column)
+            column = column.cast(field.type)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+            raise ValueError(f'Invalid value in column {field.name}: {e}') from e
+        columns.append(column)
+    return pa.RecordBatch.from_arrays(columns, schema=PROCESSED_SCHEMA)
+
+
+def write_parquet_batches(record_batches: Iterable[pa.RecordBatch], where: Any) -> int:
+    """Appends record batches to an open Parquet writer, one row group per batch, so peak memory stays flat
+        regardless of how many rows are written. Returns the number of rows written."""
+    writer = None
+    rows_written = 0
+    try:
+        for record_batch in record_batches:
+            if writer is None:
+                writer = pq.ParquetWriter(where=where, schema=record_batch.schema)
+            writer.write_batch(record_batch)
+            rows_written += record_batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows_written
+
+
+class S3MultipartUploadStream(io.RawIOBase):
+    """Writable file-like object that streams its contents to an S3 object from an in-memory buffer. Each time the
+        buffer reaches part_size bytes it is sent as a multipart upload part, so neither /tmp nor memory ever holds
+        the whole file. Output smaller than one part is sent with a single PutObject, and nothing is uploaded if
+        nothing was written. Used as a context manager, the upload is aborted if an exception is raised."""
+
+    def __init__(self, s3_client: boto3.client, bucket_name: str, key: str, part_size: int = S3_UPLOAD_PART_SIZE):
+        """Initializes the stream for s3://bucket_name/key."""
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.bytes_written = 0
+        self.upload_id = None
+        self.parts = []
+
+    def writable(self) -> bool:
+        """Returns True, the stream only supports writing."""
+        return True
+
+    def tell(self) -> int:
+        """Returns the number of bytes written to the stream."""
+        return self.bytes_written
+
+    def write(self, data: bytes) -> int:
+        """Buffers the data and uploads a part for each full part_size bytes in the buffer."""
+        self.buffer.extend(data)
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    @backoff_on_client_error
+    def create_multipart_upload(self) -> None:
+        """Starts the multipart upload."""
+        response = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=self.key)
+        self.upload_id = response['UploadId']
+        logger.info('Started multipart upload to s3://%s/%s', self.bucket_name, self.key)
+
+    @backoff_on_client_error
+    def upload_part(self, data: bytes) -> None:
+        """Uploads the data as the next part of the multipart upload."""
+        if self.upload_id is None:
+            self.create_multipart_upload()
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=data
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+    @backoff_on_client_error
+    def put_object(self, data: bytes) -> None:
+        """Uploads the data as the whole object, used when the output is smaller than one part."""
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=self.key, Body=data)
+
+    @backoff_on_client_error
+    def complete_multipart_upload(self) -> None:
+        """Completes the multipart upload from the uploaded parts."""
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+
+    def complete(self) -> None:
+        """Uploads any remaining buffered data and completes the upload."""
+        if self.upload_id is None:
+            if self.bytes_written:
+                self.put_object(bytes(self.buffer))
+        else:
+            if self.buffer:
+                self.upload_part(bytes(self.buffer))
+            self.complete_multipart_upload()
+        self.buffer = bytearray()
+        if self.bytes_written:
+            logger.info('Uploaded %d bytes to s3://%s/%s', self.bytes_written, self.bucket_name, self.key)
+
+    def abort(self) -> None:
+        """Discards the buffered data and aborts the multipart upload, if one was started."""
+        self.buffer = bytearray()
+        if self.upload_id is not None:
+            logger.warning('Aborting multipart upload to s3://%s/%s', self.bucket_name, self.key)
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+        super().close()
+
+    def close(self) -> None:
+        """Completes the upload and closes the stream."""
+        if not self.closed:
+            self.complete()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        """Completes the upload, or aborts it if an exception was raised."""
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def get_partition_columns(record_batch: pa.RecordBatch) -> Tuple[pa.Array, pa.Array]:
+    """Returns the train line and the local hour the row falls in for each row of a PROCESSED_SCHEMA batch. The train
+        line is the second field of the train_id, and the hour is the current timestamp truncated to the hour."""
+    train_lines = pc.list_element(pc.split_pattern(record_batch.column('train_id'), pattern='#'), 1)
+    hours = pc.floor_temporal(record_batch.column('current_timestamp'), unit='hour')
+    return train_lines, hours
+
+
+def get_part_key(partition_prefix: str, run_id: str) -> str:
+    """Returns a new key for a processed object in a partition, named after the compaction run writing it."""
+    return f'{partition_prefix}/{run_id}-{uuid.uuid4()}.parquet'
+
+
+def get_part_run_id(key: str) -> str:
+    """Returns the ID of the compaction run that wrote a processed object."""
+    return key.rsplit('/', 1)[1].split('-', 1)[0]
+
+
+def write_partition_to_s3(record_batches: List[pa.RecordBatch], s3_client: boto3.client, bucket_name: str, key: str,
+                          row_group_size: int = PARQUET_ROW_GROUP_SIZE) -> int:
+    """Sorts the rows of one partition by train_id and current_timestamp and uploads them as a Parquet object with
+        row groups of at most row_group_size rows. Returns the number of rows written."""
+    table = pa.Table.from_batches(record_batches, schema=PROCESSED_SCHEMA).unify_dictionaries().combine_chunks()
+    table = table.sort_by(PARTITION_SORT_KEYS)
+    with S3MultipartUploadStream(s3_client=s3_client, bucket_name=bucket_name, key=key) as sink:
+        return write_parquet_batches(record_batches=table.to_batches(max_chunksize=row_group_size), where=sink)
+
+
+def write_partitioned_parquet_to_s3(raw_batches: Iterable[pa.RecordBatch], s3_client: boto3.client, bucket_name: str,
+                                    prefix: str, row_group_size: int = PARQUET_ROW_GROUP_SIZE,
+                                    lateness_seconds: int = PARTITION_LATENESS_SECONDS,
+                                    rollups: Optional[Dict[str, Dict[str, pa.Table]]] = None,
+                                    run_id: Optional[str] = None) -> List[str]:
+    """Converts the RAW_SCHEMA record batches to PROCESSED_SCHEMA and writes them under prefix as a Hive-partitioned
+        dataset with one Parquet object per train_line=<line>/hour=<HH>/ partition, sorted by train_id and
+        current_timestamp. Rows are buffered per partition, and a partition is written as soon as a row more than
+        lateness_seconds past the end of its hour has been seen, so only the most recent hours are held in memory.
+        Rows arriving after their partition was written are written as an additional object in that partition.
+        If a rollups dictionary is given, the partial rollups of each object are added to it under the object's key
+        while the partition is in memory. Objects are named after run_id, a new one by default. Returns the keys of
+        the objects written."""
+    run_id = run_id or uuid.uuid4().hex
+    partitions = collections.defaultdict(list)
+    watermark = None
+    keys_written = []
+    rows_written = 0
+
+    def flush(partition):
+        nonlocal rows_written
+        train_line, hour = partition
+        key = get_part_key(partition_prefix=f'{prefix}train_line={train_line}/hour={hour.hour:02d}', run_id=run_id)
+        record_batches = partitions.pop(partition)
+        if rollups is not None:
+            rollups[key] = compute_partition_rollups(pa.Table.from_batches(record_batches, schema=PROCESSED_SCHEMA))
+        rows_written += write_partition_to_s3(
+            record_batches=record_batches,
+            s3_client=s3_client,
+            bucket_name=bucket_name,
+            key=key,
+            row_group_size=row_group_size
+        )
+        keys_written.append(key)
+
+    for raw_batch in raw_batches:
+        record_batch = convert_to_processed_schema(raw_batch)
+        if record_batch.num_rows == 0:
+            continue
+        train_lines, hours = get_partition_columns(record_batch)
+        if train_lines.null_count or hours.null_count:
+            raise ValueError('Rows without a train line or current timestamp cannot be partitioned.')
+        partition_table = pa.table({'train_line': train_lines, 'hour': hours})
+        for partition in partition_table.group_by(['train_line', 'hour']).aggregate([]).to_pylist():
+            mask = pc.and_(
+                pc.equal(train_lines, partition['train_line']),
+                pc.equal(hours, pa.scalar(partition['hour'], type=hours.type))
+            )
+            partitions[(partition['train_line'], partition['hour'])].append(record_batch.filter(mask))
+        batch_watermark = pc.max(record_batch.column('current_timestamp')).as_py()
+        watermark = batch_watermark if watermark is None else max(watermark, batch_watermark)
+        cutoff = watermark - datetime.timedelta(hours=1, seconds=lateness_seconds)
+        for partition in sorted(partition for partition in partitions if partition[1] <= cutoff):
+            flush(partition)
+    for partition in sorted(partitions):
+        flush(partition)
+    logger.info('Wrote %d rows to %d partition objects under s3://%s/%s',
+                rows_written, len(keys_written), bucket_name, prefix)
+    return keys_written
+
+
+def compute_partition_rollups(table: pa.Table) -> Dict[str, pa.Table]:
+    """Returns the train_minutes and runs_by_hour rollups of a PROCESSED_SCHEMA table: each train reported each
+        minute and whether it was delayed then, and the snapshots of each run each hour, in total and delayed. Rows
+        recording that a train left service are not counted. The counts assume one row per train per poll, so delta
+        records must be expanded first."""
+    is_removed = pc.fill_null(pc.equal(table.column('record_type').cast(pa.string()), 'removed'), False)
+    table = table.filter(pc.invert(is_removed))
+    train_lines, hours = get_partition_columns(table)
+    is_delayed = pc.fill_null(table.column('is_train_delayed'), False)
+    columns = pa.table(
+        {
+            'train_line': train_lines,
+            'hour': hours,
+            'minute': pc.floor_temporal(table.column('current_timestamp'), unit='minute'),
+            'train_id': table.column('train_id'),
+            'delayed': is_delayed,
+            'is_delayed': is_delayed.cast(pa.int64()),
+            'current_timestamp': table.column('current_timestamp')
+        }
+    )
+    train_minutes = columns.group_by(['train_line', 'minute', 'train_id']).aggregate([('delayed', 'any')])
+    runs_by_hour = columns.group_by(['train_line', 'hour', 'train_id']).aggregate(
+        [('train_id', 'count'), ('is_delayed', 'sum'), ('current_timestamp', 'min'), ('current_timestamp', 'max')]
+    )
+    return {
+        'train_minutes': train_minutes.rename_columns(ROLLUP_SCHEMAS['train_minutes'].names),
+        'runs_by_hour': runs_by_hour.rename_columns(ROLLUP_SCHEMAS['runs_by_hour'].names)
+    }
+
+
+def merge_rollups(tables: List[pa.Table], name: str) -> pa.Table:
+    """Merges partial rollups of the same load date into one row per group of ROLLUP_MERGE_AGGREGATIONS, sorted by the
+        group keys. Every group key of a partial rollup includes the train, so a train reported in several partial
+        rollups is still counted once per minute or hour."""
+    keys, aggregations = ROLLUP_MERGE_AGGREGATIONS[name]
+    schema = ROLLUP_SCHEMAS[name]
+    table = pa.concat_tables([rollup.cast(schema) for rollup in tables]) if tables else schema.empty_table()
+    merged = table.group_by(keys).aggregate(aggregations)
+    merged = merged.select([f'{column}_{aggregation}' for column, aggregation in aggregations] + keys)
+    merged = merged.rename_columns([column for column, _ in aggregations] + keys).select(schema.names)
+    return merged.sort_by([(key, 'ascending') for key in keys]).cast(schema)
+
+
+def get_trains_by_minute(train_minutes: pa.Table) -> pa.Table:
+    """Returns the trains_by_minute rollup derived from a merged train_minutes rollup, with the distinct trains in
+        service and delayed on each line each minute."""
+    trains_by_minute = pa.table(
+        {
+            'train_line': train_minutes.column('train_line'),
+            'minute': train_minutes.column('minute'),
+            'train_id': train_minutes.column('train_id'),
+            'delayed': train_minutes.column('delayed').cast(pa.int64())
+        }
+    ).group_by(['train_line', 'minute']).aggregate(
+        [('train_id', 'count'), ('delayed', 'sum')]
+    ).select(['train_line', 'minute', 'train_id_count', 'delayed_sum'])
+    trains_by_minute = trains_by_minute.rename_columns(ROLLUP_SCHEMAS['trains_by_minute'].names)
+    return trains_by_minute.sort_by([('train_line', 'ascending'), ('minute', 'ascending')]).cast(
+        ROLLUP_SCHEMAS['trains_by_minute']
+    )
+
+
+def get_lines_by_hour(runs_by_hour: pa.Table) -> pa.Table:
+    """Returns the lines_by_hour rollup derived from a merged runs_by_hour rollup, with the distinct runs in service
+        and the share of delayed snapshots of each line each hour."""
+    lines_by_hour = runs_by_hour.group_by(['train_line', 'hour']).aggregate(
+        [('train_id', 'count'), ('snapshot_count', 'sum'), ('delayed_count', 'sum')]
+    ).select(['train_line', 'hour', 'train_id_count', 'snapshot_count_sum', 'delayed_count_sum'])
+    delayed_share = pc.divide(
+        lines_by_hour.column('delayed_count_sum').cast(pa.float64()),
+        lines_by_hour.column('snapshot_count_sum').cast(pa.float64())
+    )
+    lines_by_hour = lines_by_hour.append_column('delayed_share', delayed_share)
+    lines_by_hour = lines_by_hour.rename_columns(ROLLUP_SCHEMAS['lines_by_hour'].names)
+    return lines_by_hour.sort_by([('train_line', 'ascending'), ('hour', 'ascending')]).cast(
+        ROLLUP_SCHEMAS['lines_by_hour']
+    )
+
+
+def get_rollup_key(name: str, load_date: datetime.date) -> str:
+    """Returns the key of a rollup table for a load date."""
+    return f'{ROLLUP_PREFIX}{name}/load_date={load_date.isoformat()}/{name}.parquet'
+
+
+@backoff_on_client_error
+def load_rollup(s3_client: boto3.client, bucket_name: str, key: str) -> Optional[pa.Table]:
+    """Returns the rollup table saved under key, or None if there is none."""
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+    return pq.read_table(pa.BufferReader(response['Body'].read()))
+
+
+def write_rollups(s3_client: boto3.client, bucket_name: str, load_date: datetime.date,
+                  part_rollups: Dict[str, Dict[str, pa.Table]]) -> List[str]:
+    """Merges the partial rollups of processed objects, keyed by object key, into the rollup tables already saved for
+        the load date and uploads each table as a single small Parquet object. Each table records the keys merged
+        into it last, and objects it already holds are skipped, so retrying a run that failed after its rollups were
+        written does not count its rows twice. Returns the keys written."""
+    merged_parts = json.dumps(sorted(part_rollups)).encode('utf-8')
+    merged_rollups = {}
+    for name in ROLLUP_MERGE_AGGREGATIONS:
+        key = get_rollup_key(name=name, load_date=load_date)
+        saved_rollup = load_rollup(s3_client=s3_client, bucket_name=bucket_name, key=key)
+        tables = []
+        already_merged = set()
+        if saved_rollup is not None:
+            tables.append(saved_rollup)
+            already_merged = set(json.loads((saved_rollup.schema.metadata or {}).get(ROLLUP_MERGED_PARTS_KEY, b'[]')))
+        tables.extend(rollups[name] for part, rollups in sorted(part_rollups.items()) if part not in already_merged)
+        merged_rollups[name] = merge_rollups(tables=tables, name=name)
+    merged_rollups['trains_by_minute'] = get_trains_by_minute(merged_rollups['train_minutes'])
+    merged_rollups['lines_by_hour'] = get_lines_by_hour(merged_rollups['runs_by_hour'])
+
+    keys_written = []
+    for name, table in merged_rollups.items():
+        key = get_rollup_key(name=name, load_date=load_date)
+        table = table.replace_schema_metadata({ROLLUP_MERGED_PARTS_KEY: merged_parts})
+        with S3MultipartUploadStream(s3_client=s3_client, bucket_name=bucket_name, key=key) as sink:
+            pq.write_table(table, sink)
+        logger.info('Wrote %d rollup rows to s3://%s/%s', table.num_rows, bucket_name, key)
+        keys_written.append(key)
+    return keys_written
+
+
+def get_manifest_key(load_date: datetime.date) -> str:
+    """Returns the key of the compaction manifest for a load date. The leading underscore keeps query engines from
+        treating the manifest as part of the dataset."""
+    return f'{MANIFEST_PREFIX}load_date={load_date.isoformat()}.json'
+
+
+@backoff_on_client_error
+def load_manifest(s3_client: boto3.client, bucket_name: str, key: str) -> Dict[str, Any]:
+    """Returns the compaction manifest saved under key, or an empty manifest if there is none. It holds the ETag of
+        each raw object already compacted, the keys of the processed objects that make up the dataset, the keys of
+        those not yet merged into the rollups, the start time of each compaction run that has not committed what it
+        wrote, keyed by run ID, the keys of objects merged by a consolidation that are still to be deleted and the
+        expanded delta records carried over to the next run."""
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return {
+                'objects': {},
+                'parts': [],
+                'rollup_pending_parts': [],
+                'pending_runs': {},
+                'obsolete_parts': [],
+                'delta_state': {}
+            }
+        raise
+    manifest = json.loads(response['Body'].read())
+    manifest.setdefault('rollup_pending_parts', [])
+    manifest.setdefault('pending_runs', {})
+    manifest.setdefault('obsolete_parts', [])
+    manifest.setdefault('delta_state', {})
+    return manifest
+
+
+@backoff_on_client_error
+def save_manifest(s3_client: boto3.client, bucket_name: str, key: str, manifest: Dict[str, Any]) -> None:
+    """Saves the compaction manifest under key."""
+    s3_client.put_object(Bucket=bucket_name, Key=key, Body=json.dumps(manifest).encode('utf-8'))
+
+
+@backoff_on_client_error
+def read_parquet_object(s3_client: boto3.client, bucket_name: str, key: str,
+                        columns: Optional[List[str]] = None) -> pa.Table:
+    """Reads a processed Parquet object from S3 into an Arrow table, or only the given columns of it."""
+    response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    return pq.read_table(pa.BufferReader(response['Body'].read()), schema=PROCESSED_SCHEMA, columns=columns)
+
+
+@backoff_on_client_error
+def delete_objects(s3_client: boto3.client, bucket_name: str, keys: List[str]) -> None:
+    """Deletes the objects from S3, up to 1000 keys per request."""
+    for i in range(0, len(keys), 1000):
+        s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={'Objects': [{'Key': key} for key in keys[i:i + 1000]], 'Quiet': True}
+        )
+
+
+def delete_abandoned_parts(s3_client: boto3.client, bucket_name: str, prefix: str, manifest: Dict[str, Any],
+                           now: datetime.datetime, run_timeout_seconds: int = COMPACTION_RUN_TIMEOUT_SECONDS) -> int:
+    """Deletes the processed objects under prefix that the manifest shows are not part of the dataset: those written
+        by pending runs started more than run_timeout_seconds before now, which must have failed before committing
+        them, and those merged by a consolidation. Objects of runs that may still be in progress and objects the
+        manifest does not know about, such as those written before there was a manifest, are left alone. The
+        manifest is updated in place. Returns the number of objects deleted."""
+    abandoned_runs = {
+        run_id for run_id, started_at in manifest['pending_runs'].items()
+        if (now - datetime.datetime.fromisoformat(started_at)).total_seconds() > run_timeout_seconds
+    }
+    abandoned_parts = []
+    if abandoned_runs:
+        committed_parts = set(manifest['parts'])
+        abandoned_parts = [
+            key for key in get_object_etags(s3_client=s3_client, bucket_name=bucket_name, prefix=prefix)
+            if key not in committed_parts and get_part_run_id(key) in abandoned_runs
+        ]
+    keys = sorted(set(abandoned_parts + manifest['obsolete_parts']))
+    if keys:
+        logger.warning('Deleting %d processed objects left by %d failed runs or consolidations',
+                       len(keys), len(abandoned_runs))
+        delete_objects(s3_client=s3_client, bucket_name=bucket_name, keys=keys)
+    for run_id in abandoned_runs:
+        del manifest['pending_runs'][run_id]
+    manifest['obsolete_parts'] = []
+    return len(keys)
+
+
+def consolidate_partitions(s3_client: boto3.client, bucket_name: str, parts: List[str], run_id: str,
+                           row_group_size: int = PARQUET_ROW_GROUP_SIZE) -> Tuple[List[str], List[str]]:
+    """Merges the processed objects of each partition that has more than one into a single sorted object named after
+        run_id. Returns the keys of the objects that now make up the dataset and the keys of the objects that were
+        merged, which the caller deletes once the new keys are recorded in the manifest."""
+    partition_parts = collections.defaultdict(list)
+    for key in parts:
+        partition_parts[key.rsplit('/', 1)[0]].append(key)
+    consolidated_parts = []
+    merged_parts = []
+    for partition, keys in sorted(partition_parts.items()):
+        if len(keys) == 1:
+            consolidated_parts.extend(keys)
+            continue
+        record_batches = [
+            record_batch
+            for key in keys
+            for record_batch in read_parquet_object(s3_client=s3_client, bucket_name=bucket_name, key=key).to_batches()
+        ]
+        key = get_part_key(partition_prefix=partition, run_id=run_id)
+        write_partition_to_s3(
+            record_batches=record_batches,
+            s3_client=s3_client,
+            bucket_name=bucket_name,
+            key=key,
+            row_group_size=row_group_size
+        )
+        logger.info('Consolidated %d objects into %s', len(keys), key)
+        consolidated_parts.append(key)
+        merged_parts.extend(keys)
+    return consolidated_parts, merged_parts
+
+
+def compact_load_date(s3_client: boto3.client, bucket_name: str, load_date: datetime.date, consolidate: bool = False,
+                      build_rollups: bool = True, run_timeout_seconds: int = COMPACTION_RUN_TIMEOUT_SECONDS,
+                      **read_options: Any) -> Dict[str, Any]:
+    """Compacts the raw objects of a load date that are not yet in its manifest into new processed objects, then
+        records them in the manifest so that a later run only reads objects delivered since. The manifest is the
+        commit point: the run is recorded in it as pending before any object is written, and objects of a pending
+        run missing from it once the run has timed out are deleted by a later run. With build_rollups, the new
+        objects are merged into the daily rollup tables once the manifest is saved, and objects still pending from a
+        failed run are read back and merged too. With consolidate, the objects of each partition are then merged
+        into one. The remaining keyword arguments are passed to read_raw_record_batches, with batch_size also used as
+        the row group size. Returns the compaction stats."""
+    manifest_key = get_manifest_key(load_date)
+    manifest = load_manifest(s3_client=s3_client, bucket_name=bucket_name, key=manifest_key)
+    processed_prefix = f'processed/load_date={load_date.isoformat()}/'
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    abandoned_parts_deleted = delete_abandoned_parts(
+        s3_client=s3_client,
+        bucket_name=bucket_name,
+        prefix=processed_prefix,
+        manifest=manifest,
+        now=started_at,
+        run_timeout_seconds=run_timeout_seconds
+    )
+    object_etags = get_object_etags(
+        s3_client=s3_client,
+        bucket_name=bucket_name,
+        prefix=f'raw/{load_date.year}/{load_date.month:02d}/{load_date.day:02d}/'
+    )
+    new_objects = {key: etag for key, etag in object_etags.items() if manifest['objects'].get(key) != etag}
+    logger.info('Found %d new raw objects of %d for load date %s', len(new_objects), len(object_etags), load_date)
+    row_group_size = read_options.get('batch_size', PARQUET_ROW_GROUP_SIZE)
+    # The run is recorded before it writes any processed object, so a later run can delete what it leaves behind
+    run_id = uuid.uuid4().hex
+    if new_objects or consolidate:
+        manifest['pending_runs'][run_id] = started_at.isoformat()
+    if new_objects or consolidate or abandoned_parts_deleted:
+        save_manifest(s3_client=s3_client, bucket_name=bucket_name, key=manifest_key, manifest=manifest)
+
+    # Records flow from the concurrent reader into per-partition buffers that are written as each hour completes,
+    # and the rollups of each partition are computed while it is still in memory. Expanded delta records pick up
+    # the trains the previous run left off with, and the trains left off with now are committed with the manifest.
+    part_rollups = {}
+    raw_batches = read_raw_record_batches(
+        s3_client=s3_client,
+        bucket_name=bucket_name,
+        keys=sorted(new_objects),
+        delta_state=manifest['delta_state'],
+        **read_options
+    )
+    new_parts = write_partitioned_parquet_to_s3(
+        raw_batches=raw_batches,
+        s3_client=s3_client,
+        bucket_name=bucket_name,
+        prefix=processed_prefix,
+        row_group_size=row_group_size,
+        rollups=part_rollups if build_rollups else None,
+        run_id=run_id
+    )
+    manifest['objects'].update(new_objects)
+    manifest['parts'].extend(new_parts)
+    if build_rollups:
+        manifest['rollup_pending_parts'].extend(new_parts)
+    if new_objects:
+        save_manifest(s3_client=s3_client, bucket_name=bucket_name, key=manifest_key, manifest=manifest)
+
+    rollup_keys = []
+    if build_rollups and manifest['rollup_pending_parts']:
+        for key in manifest['rollup_pending_parts']:
+            if key not in part_rollups:
+                part_rollups[key] = compute_partition_rollups(
+                    read_parquet_object(s3_client=s3_client, bucket_name=bucket_name, key=key)
+                )
+        rollup_keys = write_rollups(
+            s3_client=s3_client,
+            bucket_name=bucket_name,
+            load_date=load_date,
+            part_rollups=part_rollups
+        )
+        manifest['rollup_pending_parts'] = []
+        save_manifest(s3_client=s3_client, bucket_name=bucket_name, key=manifest_key, manifest=manifest)
+
+    # Objects still pending a rollup are kept until they have been merged into the rollups
+    merged_parts = []
+    if consolidate and not manifest['rollup_pending_parts']:
+        manifest['parts'], merged_parts = consolidate_partitions(
+            s3_client=s3_client,
+            bucket_name=bucket_name,
+            parts=manifest['parts'],
+            run_id=run_id,
+            row_group_size=row_group_size
+        )
+    if merged_parts:
+        # Recorded so a later run deletes them if this one fails before it does
+        manifest['obsolete_parts'] = merged_parts
+        save_manifest(s3_client=s3_client, bucket_name=bucket_name, key=manifest_key, manifest=manifest)
+        delete_objects(s3_client=s3_client, bucket_name=bucket_name, keys=merged_parts)
+    if run_id in manifest['pending_runs']:
+        del manifest['pending_runs'][run_id]
+        save_manifest(s3_client=s3_client, bucket_name=bucket_name, key=manifest_key, manifest=manifest)
+    return {
+        'load_date': load_date.isoformat(),
+        'objects_compacted': len(new_objects),
+        'parts_written': len(new_parts),
+        'parts_merged': len(merged_parts),
+        'abandoned_parts_deleted': abandoned_parts_deleted,
+        'rollups_written': len(rollup_keys)
+    }
 
 
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
@@ -82,34 +1055,43 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     logger.info(f'Event: {event}')
 
     timezone = zoneinfo.ZoneInfo('America/Chicago')
-    prev_day = datetime.datetime.now(timezone) - datetime.timedelta(days=1)
+    today = datetime.datetime.now(timezone).date()
+    prev_day = today - datetime.timedelta(days=1)
+
+    compaction_mode = os.environ.get('COMPACTION_MODE', 'daily')
+    if compaction_mode not in COMPACTION_MODES:
+        raise ValueError(f'Unsupported compaction mode: {compaction_mode}')
+    # Incremental runs pick up the day so far, and the previous day until its last objects have been delivered
+    load_dates = [prev_day, today] if compaction_mode == 'incremental' else [prev_day]
 
-    s3 = boto3.client('s3')
+    s3_read_concurrency = int(os.environ.get('S3_READ_CONCURRENCY', S3_READ_CONCURRENCY))
+    s3 = create_s3_client(max_pool_connections=s3_read_concurrency)
     s3_bucket_name = os.environ['S3_BUCKET_NAME']
 
-    json_files = get_object_keys(
-        s3_client=s3,
-        bucket_name=s3_bucket_name,
-        prefix=f'raw/{prev_day.year}/{prev_day.month:02d}/{prev_day.day:02d}/'
-    )
-    json_data = []
-    for file in json_files:
-        file_records = read_s3_object(
+    # Unexpanded delta records only hold the trains that changed, so the rollups would undercount trains in service
+    expand_delta = os.environ.get('EXPAND_DELTA_RECORDS', 'false').lower() == 'true'
+    build_rollups = expand_delta or os.environ.get('DELTA_MODE', 'false').lower() != 'true'
+    if not build_rollups:
+        logger.warning('Skipping rollups since delta records are not expanded, set EXPAND_DELTA_RECORDS to build them')
+
+    for load_date in load_dates:
+        stats = compact_load_date(
             s3_client=s3,
             bucket_name=s3_bucket_name,
-            key=file
+            load_date=load_date,
+            # Today's partitions are still growing, so only completed days are consolidated
+            consolidate=load_date != today and os.environ.get('CONSOLIDATE_PARTS', 'false').lower() == 'true',
+            build_rollups=build_rollups,
+            run_timeout_seconds=int(os.environ.get('COMPACTION_RUN_TIMEOUT_SECONDS', COMPACTION_RUN_TIMEOUT_SECONDS)),
+            concurrency=s3_read_concurrency,
+            backend=os.environ.get('JSON_PARSER_BACKEND', 'python'),
+            batch_size=int(os.environ.get('PARQUET_ROW_GROUP_SIZE', PARQUET_ROW_GROUP_SIZE)),
+            expand_delta=expand_delta,
+            # Filled rows are repeated at the interval get_train_status polls at
+            interval_seconds=int(os.environ.get('POLL_INTERVAL_SECONDS', POLL_INTERVAL_SECONDS)),
+            max_fill_seconds=int(os.environ.get('DELTA_MAX_FILL_SECONDS', DELTA_MAX_FILL_SECONDS))
         )
-        json_data.extend(file_records)
-    logger.info('Total records read from S3: %d', len(json_data))
-    write_local_parquet_file(
-        data=json_data
-    )
-    upload_parquet_to_s3(
-        s3_client=s3,
-        local_dir='/tmp',
-        bucket_name=s3_bucket_name,
-        prefix=f'processed/load_date={prev_day.year}-{prev_day.month:02d}-{prev_day.day:02d}/'
-    )
+        logger.info('Compaction stats: %s', stats)
 
     return {
         'statusCode': 200,
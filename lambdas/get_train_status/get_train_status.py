@@ -1,14 +1,24 @@
 """Module containing code for Lambda function to fetch CTA train statuses from the Train Tracker API."""
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple, Optional, Callable
+import collections
+import concurrent.futures
 import logging
 import os
 import datetime
+import fcntl
+import functools
+import gzip
+import random
+import threading
+import time
 import zoneinfo
 import json
 
 import boto3
+import botocore.exceptions
 from dotenv import load_dotenv
 import requests
+import requests.adapters
 
 from retry_api_exceptions import backoff_on_client_error
 
@@ -25,58 +35,928 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
+CTA_API_BASE_URL = 'https://lapi.transitchicago.com/api/1.0/ttpositions.aspx'
+HTTP_POOL_MAXSIZE = 10
+HTTP_LATENCY_SAMPLE_SIZE = 500
+FETCH_MAX_WORKERS = 8
+FIREHOSE_STREAM_NAME = 'cta-train-analytics-stream'
+FIREHOSE_MAX_BATCH_RECORDS = 500
+FIREHOSE_MAX_BATCH_BYTES = 4 * 1024 * 1024
+FIREHOSE_MAX_RECORD_BYTES = 1000 * 1024
+FIREHOSE_WRITE_MAX_WORKERS = 4
+FIREHOSE_BACKOFF_BASE_SECONDS = 0.1
+FIREHOSE_BACKOFF_MAX_SECONDS = 2.0
+DELTA_TRACKED_FIELDS = ('next_station', 'is_approaching_station', 'is_train_delayed')
+DELTA_KEYFRAME_INTERVAL_SECONDS = 900
+# Each invocation covers one scheduled minute, polling once per POLL_INTERVAL_SECONDS within it
+POLL_WINDOW_SECONDS = 60
+POLL_INTERVAL_SECONDS = 60
+# Time left at the end of an invocation for the Firehose write and the delta state save
+POLL_WRITE_RESERVE_MS = 5000
+# The Train Tracker API allows 100,000 transactions per day per key
+CTA_API_REQUESTS_PER_SECOND = 5
+CTA_API_REQUESTS_PER_DAY = 100000
+CTA_API_BURST_SECONDS = 3600
+RATE_LIMIT_MAX_WAIT_SECONDS = 1.0
+RATE_LIMIT_FILE_PATH = '/tmp/cta_api_rate_limit.json'
+STATE_UPDATE_MAX_ATTEMPTS = 5
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 3
+CIRCUIT_BREAKER_RECOVERY_SECONDS = 30
+CIRCUIT_BREAKER_FILE_PATH = '/tmp/cta_api_circuit_breaker.json'
+LINE_ACTIVITY_REFRESH_SECONDS = 300
+# Hedging only starts once enough latencies have been observed for the percentile to be meaningful
+HEDGE_MIN_SAMPLES = 20
+
+
+def create_http_session(pool_maxsize: int = HTTP_POOL_MAXSIZE) -> requests.Session:
+    """Creates an HTTP session with a keep-alive connection pool and gzip negotiation. Retries are left to the
+        backoff_on_client_error decorator so they are not stacked on top of urllib3 retries."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+    session.mount('https://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+    return session
+
+
+# Created at module level so the pooled connections survive across warm Lambda invocations
+http_session = create_http_session()
+http_request_latencies_ms = collections.deque(maxlen=HTTP_LATENCY_SAMPLE_SIZE)
+# time.monotonic() value by which the API requests of the current invocation, retries included, must have completed
+api_request_deadline = float('inf')
+
+
+class RequestDeadlineExceeded(Exception):
+    """Raised instead of sending a Train Tracker API request when the invocation has no time left for it."""
+
+
+def get_request_timeout() -> Tuple[float, float]:
+    """Returns the (connect, read) timeout in seconds for Train Tracker API requests, each capped at the time left
+        until api_request_deadline so that a slow attempt and its retries cannot outlast the Lambda timeout."""
+    connect_timeout = float(os.environ.get('CTA_API_CONNECT_TIMEOUT', '2'))
+    read_timeout = float(os.environ.get('CTA_API_READ_TIMEOUT', '5'))
+    remaining_seconds = api_request_deadline - time.monotonic()
+    if remaining_seconds <= 0:
+        raise RequestDeadlineExceeded('No time left in the invocation for a Train Tracker API request')
+    return min(connect_timeout, remaining_seconds), min(read_timeout, remaining_seconds)
+
+
+def get_http_session_stats(session: requests.Session = None) -> Dict[str, Any]:
+    """Returns connection reuse and latency statistics for the HTTP session since the container started. A request
+        that did not need a new connection was served by a pooled keep-alive connection."""
+    session = session or http_session
+    requests_made = 0
+    new_connections = 0
+    adapter = session.get_adapter(CTA_API_BASE_URL)
+    pools = adapter.poolmanager.pools
+    for pool_key in pools.keys():
+        pool = pools[pool_key]
+        requests_made += pool.num_requests
+        new_connections += pool.num_connections
+    latencies = sorted(http_request_latencies_ms)
+    stats = {
+        'requests': requests_made,
+        'new_connections': new_connections,
+        'reused_connections': max(requests_made - new_connections, 0),
+        'latency_p50_ms': None,
+        'latency_p99_ms': None,
+        'latency_max_ms': None
+    }
+    if latencies:
+        stats['latency_p50_ms'] = round(latencies[int(0.5 * (len(latencies) - 1))], 1)
+        stats['latency_p99_ms'] = round(latencies[int(0.99 * (len(latencies) - 1))], 1)
+        stats['latency_max_ms'] = round(latencies[-1], 1)
+    return stats
+
+
+def get_hedge_delay_seconds(percentile: float) -> Optional[float]:
+    """Returns the given percentile of the observed Train Tracker API latencies in seconds, or None until at least
+        HEDGE_MIN_SAMPLES latencies have been observed."""
+    latencies = sorted(http_request_latencies_ms)
+    if len(latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    return latencies[int(percentile / 100 * (len(latencies) - 1))] / 1000
+
+
+@functools.cache
+def get_hedge_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Returns the thread pool hedged requests are sent from."""
+    return concurrent.futures.ThreadPoolExecutor(max_workers=HTTP_POOL_MAXSIZE)
+
+
+def send_train_locations_request(query_params: Dict[str, str]) -> requests.Response:
+    """Sends a request to the Train Locations API endpoint and records its latency. When HEDGE_PERCENTILE is set and
+        no response has arrived within that percentile of the observed latencies, a duplicate request is sent and
+        the first successful response is returned. The hedged request counts against the rate limit, and is not
+        sent if the budget does not allow it."""
+    def send() -> requests.Response:
+        start_time = time.perf_counter()
+        response = http_session.get(url=CTA_API_BASE_URL, params=query_params, timeout=get_request_timeout())
+        latency_ms = (time.perf_counter() - start_time) * 1000
+        http_request_latencies_ms.append(latency_ms)
+        logger.info('Train Tracker API responded with status %s in %.1f ms', response.status_code, latency_ms)
+        return response
+
+    hedge_percentile = os.environ.get('HEDGE_PERCENTILE')
+    hedge_delay_seconds = get_hedge_delay_seconds(percentile=float(hedge_percentile)) if hedge_percentile else None
+    if hedge_delay_seconds is None:
+        return send()
+
+    executor = get_hedge_executor()
+    primary = executor.submit(send)
+    done, _ = concurrent.futures.wait([primary], timeout=hedge_delay_seconds)
+    if done:
+        return primary.result()
+    try:
+        get_rate_limiter().acquire()
+    except RateLimitExceeded:
+        return primary.result()
+    logger.info('No response within %.1f ms, sending hedged request', hedge_delay_seconds * 1000)
+    hedge = executor.submit(send)
+    for future in concurrent.futures.as_completed([primary, hedge]):
+        if future.exception() is None and future.result().ok:
+            return future.result()
+    return primary.result()
+
 
 @backoff_on_client_error
 def get_train_locations(train_line_abbrev: str) -> Dict[str, Any]:
-    """Makes request to Train Locations API endpoint to get locations of all trains for a given line."""
-    base_url = 'https://lapi.transitchicago.com/api/1.0/ttpositions.aspx'
+    """Makes request to Train Locations API endpoint to get locations of all trains for a given line. Multiple lines
+        can be requested in a single call by passing a comma-separated list of line abbreviations."""
     query_params = {
         'rt': train_line_abbrev,
         'key': os.environ['API_KEY'],
         'outputType': 'JSON'
     }
-    logger.info('Making request to %s with parameters %s', base_url, query_params)
-    response = requests.get(url=base_url, params=query_params)
+    # Every attempt, including retries, counts against the API's daily transaction limit
+    get_rate_limiter().acquire()
+    logger.info('Making request to %s for train line: %s', CTA_API_BASE_URL, train_line_abbrev)
+    response = send_train_locations_request(query_params=query_params)
     response.raise_for_status()
     logger.info('Successfully retrieved locations for train line: %s', train_line_abbrev)
     locations = response.json()
     return locations
 
 
+def get_train_lines_from_message(message_body: str) -> Dict[str, str]:
+    """Parses the train lines to poll from an SQS message body. Supports both a single line message
+        ({"train_line_abbrev": ..., "train_line": ...}) and a batched message containing a "train_lines" list
+        of such objects. Returns a dictionary mapping train line abbreviations to train line names."""
+    message = json.loads(message_body)
+    line_messages = message.get('train_lines', [message])
+    train_lines = {}
+    for line_message in line_messages:
+        train_line_abbrev = line_message.get('train_line_abbrev', '')
+        train_line = line_message.get('train_line', '')
+        if not train_line_abbrev or not train_line:
+            raise ValueError(
+                'Parameters train_line_abbrev and/or train_line were not present in the SQS message payload.'
+            )
+        train_lines[train_line_abbrev] = train_line
+    return train_lines
+
+
+def split_locations_by_line(locations: Dict[str, Any], train_lines: Dict[str, str]) -> Dict[str, List[Dict[str, Any]]]:
+    """Splits the ctatt.route[] array of a (possibly multi-route) API response into the trains running on each
+        requested train line, keyed by train line name. Routes are matched on their @name attribute, which the API
+        returns as either the route abbreviation or the line name in lowercase."""
+    routes = locations.get('ctatt', {}).get('route', [])
+    if not routes:
+        message = 'Route or ctatt object not present in API response'
+        logger.info(message)
+        raise KeyError(message)
+
+    route_names = {}
+    for train_line_abbrev, train_line in train_lines.items():
+        route_names[train_line_abbrev.lower()] = train_line
+        route_names[train_line.lower()] = train_line
+
+    trains_by_line = {}
+    for route in routes:
+        train_line = route_names.get(str(route.get('@name', '')).lower())
+        if train_line is None and len(routes) == 1 and len(train_lines) == 1:
+            train_line = next(iter(train_lines.values()))
+        if train_line is None:
+            logger.warning('Skipping unrecognized route in API response: %s', route.get('@name'))
+            continue
+        trains_by_line.setdefault(train_line, []).extend(route.get('train', []))
+    return trains_by_line
+
+
+def parse_train_location_data(trains: List[Dict[str, Any]], train_line: str, today_date: str,
+                              today_datetime: str) -> List[Dict[str, Any]]:
+    """Converts the trains returned by the API for a train line into the records written to Firehose. The station
+        IDs and position are optional in the API response and are None when missing."""
+    train_location_data = []
+    for train in trains:
+        train_location_data.append(
+            {
+                'train_id': f'{today_date}#{train_line}#{train['rn']}#{train['trDr']}',
+                'current_timestamp': today_datetime,
+                'prediction_generated_timestamp': train['prdt'],
+                'destination_station': train['destNm'],
+                'next_station': train['nextStaNm'],
+                'next_station_arrival_time': train['arrT'],
+                'is_approaching_station': train['isApp'],
+                'is_train_delayed': train['isDly'],
+                'next_station_id': train.get('nextStaId'),
+                'destination_station_id': train.get('destSt'),
+                'latitude': train.get('lat'),
+                'longitude': train.get('lon'),
+                'heading': train.get('heading')
+            }
+        )
+    return train_location_data
+
+
+def group_train_lines(train_lines: Dict[str, str], max_routes_per_request: int) -> List[Dict[str, str]]:
+    """Splits the train lines to poll into request groups of at most max_routes_per_request lines. Each group is
+        fetched with a single multi-route API request."""
+    items = list(train_lines.items())
+    return [dict(items[i:i + max_routes_per_request]) for i in range(0, len(items), max_routes_per_request)]
+
+
+def fetch_train_locations_concurrently(request_groups: List[Dict[str, str]],
+                                       max_workers: int) -> List[Tuple[Optional[Dict[str, Any]], Optional[Exception]]]:
+    """Fetches the train locations for each request group in parallel using a bounded thread pool, so wall-clock
+        time is close to the slowest single request. Returns a (locations, error) tuple for each group in the same
+        order as request_groups."""
+    circuit_breaker = get_circuit_breaker()
+
+    def fetch(request_group: Dict[str, str]) -> Dict[str, Any]:
+        return circuit_breaker.call(get_train_locations, train_line_abbrev=','.join(request_group.keys()))
+
+    results = []
+    if len(request_groups) <= 1 or max_workers <= 1:
+        for request_group in request_groups:
+            try:
+                results.append((fetch(request_group), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
+
+    start_time = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(request_groups))) as executor:
+        futures = [executor.submit(fetch, request_group) for request_group in request_groups]
+        for future in futures:
+            error = future.exception()
+            results.append((None, error) if error else (future.result(), None))
+    logger.info(
+        'Fetched %d request groups concurrently in %.1f ms',
+        len(request_groups),
+        (time.perf_counter() - start_time) * 1000
+    )
+    return results
+
+
 def dictionary_to_firehose_record(data):
     """Converts a python dictionary into a format that Firehose accepts."""
     json_line = json.dumps(data) + "\n"
     return {'Data': json_line.encode('utf-8')}
 
 
+def aggregate_firehose_records(data_to_write: List[Dict[str, Any]], max_record_bytes: int = FIREHOSE_MAX_RECORD_BYTES,
+                               compress: bool = False) -> List[Dict[str, bytes]]:
+    """Packs many rows into each Firehose record as newline-delimited JSON, up to max_record_bytes of uncompressed
+        payload per record. Firehose bills in 5 KB increments per record, so packing rows cuts ingest cost and request
+        count. With compress each record is a self-contained gzip member, which concatenate into a valid gzip stream
+        in the delivered S3 object."""
+    records = []
+    current_lines = []
+    current_bytes = 0
+    for data in data_to_write:
+        line = (json.dumps(data) + '\n').encode('utf-8')
+        if current_lines and current_bytes + len(line) > max_record_bytes:
+            records.append(b''.join(current_lines))
+            current_lines = []
+            current_bytes = 0
+        current_lines.append(line)
+        current_bytes += len(line)
+    if current_lines:
+        records.append(b''.join(current_lines))
+    if compress:
+        records = [gzip.compress(record) for record in records]
+    return [{'Data': record} for record in records]
+
+
+@functools.cache
+def get_firehose_client():
+    """Returns the Firehose client."""
+    return boto3.client('firehose')
+
+
+def chunk_firehose_records(records: List[Dict[str, bytes]], max_records: int = FIREHOSE_MAX_BATCH_RECORDS,
+                           max_bytes: int = FIREHOSE_MAX_BATCH_BYTES) -> List[List[Dict[str, bytes]]]:
+    """Splits Firehose records into chunks that respect the PutRecordBatch limits on record count and total
+        payload size per call."""
+    chunks = []
+    current_chunk = []
+    current_bytes = 0
+    for record in records:
+        record_bytes = len(record['Data'])
+        if record_bytes > FIREHOSE_MAX_RECORD_BYTES:
+            raise ValueError(
+                f'Firehose record of {record_bytes} bytes exceeds the {FIREHOSE_MAX_RECORD_BYTES} byte limit.'
+            )
+        if current_chunk and (len(current_chunk) >= max_records or current_bytes + record_bytes > max_bytes):
+            chunks.append(current_chunk)
+            current_chunk = []
+            current_bytes = 0
+        current_chunk.append(record)
+        current_bytes += record_bytes
+    if current_chunk:
+        chunks.append(current_chunk)
+    return chunks
+
+
 @backoff_on_client_error
-def write_train_location_data(data_to_write: List[Dict[str, Any]], max_retries: int):
-    """Writes train location data to Firehose. If errors occur, retries until retry_attempts
-        are exhausted."""
-    firehose = boto3.client('firehose')
-    remaining = [dictionary_to_firehose_record(data) for data in data_to_write]
-    logger.info('Converted incoming data into format for Firehose')
+def put_firehose_record_batch(firehose, records: List[Dict[str, bytes]]) -> Dict[str, Any]:
+    """Sends a single PutRecordBatch request to the train analytics Firehose stream."""
+    return firehose.put_record_batch(
+        DeliveryStreamName=FIREHOSE_STREAM_NAME,
+        Records=records
+    )
+
+
+def write_firehose_chunk(firehose, records: List[Dict[str, bytes]], max_retries: int) -> Dict[str, int]:
+    """Writes a chunk of records to Firehose. Only the entries that failed are resent, after an exponential backoff
+        with full jitter, until max_retries attempts are exhausted. Returns the number of retried records."""
+    remaining = records
     attempts = 0
+    retried_records = 0
     while remaining and attempts < max_retries:
         logger.info('Attempt %s:', str(attempts))
-        response = firehose.put_record_batch(
-            DeliveryStreamName='cta-train-analytics-stream',
-            Records=remaining
-        )
+        response = put_firehose_record_batch(firehose=firehose, records=remaining)
         failed_count = response['FailedPutCount']
         if failed_count > 0:
             logger.info(f'{failed_count} records failed on attempt {attempts}, retrying batch send with failed records')
-            failed_records = [
+            remaining = [
                 remaining[i] for i, r in enumerate(response['RequestResponses']) if 'ErrorCode' in r
             ]
-            remaining = failed_records
             attempts += 1
+            if attempts < max_retries:
+                retried_records += len(remaining)
+                backoff_seconds = min(FIREHOSE_BACKOFF_MAX_SECONDS, FIREHOSE_BACKOFF_BASE_SECONDS * 2 ** attempts)
+                time.sleep(random.uniform(0, backoff_seconds))
         else:
-            logger.info(f'Successfully wrote all records to Firehose')
-            return
+            remaining = []
 
     if remaining:
         raise Exception(f'Failed to send {len(remaining)} records after {max_retries} retries.')
+    return {'records': len(records), 'retried_records': retried_records}
+
+
+def write_train_location_data(data_to_write: List[Dict[str, Any]], max_retries: int,
+                              max_workers: int = FIREHOSE_WRITE_MAX_WORKERS,
+                              record_format: str = None) -> Dict[str, Any]:
+    """Writes train location data to Firehose. Records are chunked to the PutRecordBatch limits and the chunks are
+        sent concurrently. The record_format (FIREHOSE_RECORD_FORMAT environment variable by default) is one of
+        json (one row per record), ndjson (many rows per record) or ndjson_gzip (many rows per gzip-compressed
+        record). Returns throughput and retry statistics for the write."""
+    firehose = get_firehose_client()
+    record_format = record_format or os.environ.get('FIREHOSE_RECORD_FORMAT', 'json')
+    if record_format == 'json':
+        records = [dictionary_to_firehose_record(data) for data in data_to_write]
+    elif record_format in ('ndjson', 'ndjson_gzip'):
+        records = aggregate_firehose_records(
+            data_to_write=data_to_write,
+            max_record_bytes=int(os.environ.get('FIREHOSE_AGGREGATION_BYTES', FIREHOSE_MAX_RECORD_BYTES)),
+            compress=record_format == 'ndjson_gzip'
+        )
+    else:
+        raise ValueError(f'Unsupported Firehose record format: {record_format}')
+    chunks = chunk_firehose_records(records=records)
+    logger.info('Converted incoming data into %d Firehose batches', len(chunks))
+
+    start_time = time.perf_counter()
+    if len(chunks) <= 1 or max_workers <= 1:
+        chunk_results = [
+            write_firehose_chunk(firehose=firehose, records=chunk, max_retries=max_retries) for chunk in chunks
+        ]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+            futures = [
+                executor.submit(write_firehose_chunk, firehose=firehose, records=chunk, max_retries=max_retries)
+                for chunk in chunks
+            ]
+            chunk_results = [future.result() for future in futures]
+    elapsed_seconds = time.perf_counter() - start_time
+
+    stats = {
+        'rows': len(data_to_write),
+        'records': len(records),
+        'bytes': sum(len(record['Data']) for record in records),
+        'batches': len(chunks),
+        'retried_records': sum(result['retried_records'] for result in chunk_results),
+        'elapsed_ms': round(elapsed_seconds * 1000, 1),
+        'records_per_second': round(len(records) / elapsed_seconds, 1) if elapsed_seconds > 0 else None
+    }
+    logger.info('Successfully wrote all records to Firehose: %s', stats)
+    return stats
+
+
+@functools.cache
+def get_s3_client():
+    """Returns the S3 client."""
+    return boto3.client('s3')
+
+
+# Takes the current state of a key and returns the new state and a result for the caller
+StateUpdateFunction = Callable[[Optional[Dict[str, Any]]], Tuple[Dict[str, Any], Any]]
+
+
+class InMemoryStateStore:
+    """Key-value store for JSON state that lives in the Lambda container and survives warm invocations."""
+
+    def __init__(self):
+        """Initializes an empty store."""
+        self.state = {}
+        self.lock = threading.Lock()
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        """Returns the state saved under key, or None if there is none."""
+        return self.state.get(key)
+
+    def save(self, key: str, value: Dict[str, Any]) -> None:
+        """Saves the state under key."""
+        self.state[key] = value
+
+    def update(self, key: str, update_function: StateUpdateFunction) -> Any:
+        """Atomically replaces the state under key with the new state returned by update_function, which is passed
+            the current state. Returns the result returned alongside the new state."""
+        with self.lock:
+            new_value, result = update_function(self.state.get(key))
+            self.state[key] = new_value
+            return result
+
+
+class FileStateStore:
+    """Key-value store for JSON state kept in a single local file, shared by every process on the same host. Each
+        access holds a lock on the file."""
+
+    def __init__(self, path: str):
+        """Initializes the store backed by the file at path, which is created on first use."""
+        self.path = path
+
+    def update(self, key: str, update_function: StateUpdateFunction) -> Any:
+        """Atomically replaces the state under key with the new state returned by update_function, which is passed
+            the current state. Returns the result returned alongside the new state."""
+        with open(self.path, 'a+', encoding='utf-8') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            file.seek(0)
+            contents = file.read()
+            states = json.loads(contents) if contents else {}
+            new_value, result = update_function(states.get(key))
+            if new_value == states.get(key):
+                return result
+            states[key] = new_value
+            file.seek(0)
+            file.truncate()
+            file.write(json.dumps(states))
+            return result
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        """Returns the state saved under key, or None if there is none."""
+        return self.update(key, lambda value: (value, value))
+
+    def save(self, key: str, value: Dict[str, Any]) -> None:
+        """Saves the state under key."""
+        self.update(key, lambda _: (value, None))
+
+
+class S3StateStore:
+    """Key-value store for JSON state kept as S3 objects, shared by all concurrent Lambda containers. Reads go to S3
+        so a container never acts on state that another container has since replaced, and writes go through to the
+        in-memory cache."""
+
+    def __init__(self, bucket_name: str, prefix: str, cache: InMemoryStateStore = None):
+        """Initializes the store for objects under s3://bucket_name/prefix."""
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.cache = cache or InMemoryStateStore()
+
+    @backoff_on_client_error
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        """Returns the state saved under key, or None if there is none."""
+        try:
+            response = get_s3_client().get_object(Bucket=self.bucket_name, Key=f'{self.prefix}{key}.json')
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            raise
+        value = json.loads(response['Body'].read())
+        self.cache.save(key, value)
+        return value
+
+    @backoff_on_client_error
+    def save(self, key: str, value: Dict[str, Any]) -> None:
+        """Saves the state under key."""
+        get_s3_client().put_object(
+            Bucket=self.bucket_name,
+            Key=f'{self.prefix}{key}.json',
+            Body=json.dumps(value).encode('utf-8')
+        )
+        self.cache.save(key, value)
+
+    @backoff_on_client_error
+    def update(self, key: str, update_function: StateUpdateFunction,
+               max_attempts: int = STATE_UPDATE_MAX_ATTEMPTS) -> Any:
+        """Atomically replaces the state under key with the new state returned by update_function, which is passed
+            the current state. The write is conditional on the object being unchanged since it was read, and the
+            update is repeated with the latest state if another container wrote it first. Returns the result
+            returned alongside the new state."""
+        s3 = get_s3_client()
+        object_key = f'{self.prefix}{key}.json'
+        for _ in range(max_attempts):
+            try:
+                response = s3.get_object(Bucket=self.bucket_name, Key=object_key)
+                value, condition = json.loads(response['Body'].read()), {'IfMatch': response['ETag']}
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchKey':
+                    raise
+                value, condition = None, {'IfNoneMatch': '*'}
+            new_value, result = update_function(value)
+            if new_value == value:
+                return result
+            try:
+                s3.put_object(
+                    Bucket=self.bucket_name,
+                    Key=object_key,
+                    Body=json.dumps(new_value).encode('utf-8'),
+                    **condition
+                )
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                    logger.info('State %s was updated concurrently, retrying the update', object_key)
+                    continue
+                raise
+            self.cache.save(key, new_value)
+            return result
+        raise Exception(f'Failed to update state {object_key} after {max_attempts} attempts.')
+
+
+@functools.cache
+def get_state_cache(name: str) -> InMemoryStateStore:
+    """Returns the in-memory store of the named state, such as the delta state or the request budget, which the
+        shared stores also use as their cache."""
+    return InMemoryStateStore()
+
+
+def get_delta_state_store():
+    """Returns the store for the last emitted train states. The warm-container cache is used unless
+        DELTA_STATE_BUCKET is set, in which case state is shared across containers through S3."""
+    bucket_name = os.environ.get('DELTA_STATE_BUCKET')
+    if bucket_name:
+        return S3StateStore(bucket_name=bucket_name, prefix='state/delta/', cache=get_state_cache('delta'))
+    return get_state_cache('delta')
+
+
+class RateLimitExceeded(Exception):
+    """Raised when the Train Tracker API request budget does not allow another request."""
+
+
+class TokenBucketRateLimiter:
+    """Meters requests against a per-second and a per-day budget shared through a state store. The per-second bucket
+        holds at most one second's worth of tokens. The daily bucket refills at requests_per_day spread evenly over
+        the day and holds at most burst_seconds worth of requests, so a backlog cannot spend the day's budget at
+        once. A hard count of the day's requests enforces the daily limit itself."""
+
+    def __init__(self, store, key: str = 'cta_api', requests_per_second: float = CTA_API_REQUESTS_PER_SECOND,
+                 requests_per_day: int = CTA_API_REQUESTS_PER_DAY, burst_seconds: int = CTA_API_BURST_SECONDS,
+                 max_wait_seconds: float = RATE_LIMIT_MAX_WAIT_SECONDS):
+        """Initializes the limiter for the budget saved under key in store."""
+        self.store = store
+        self.key = key
+        self.requests_per_second = requests_per_second
+        self.second_capacity = max(1.0, requests_per_second)
+        self.requests_per_day = requests_per_day
+        self.daily_rate = requests_per_day / 86400
+        self.daily_capacity = max(1.0, self.daily_rate * burst_seconds)
+        self.max_wait_seconds = max_wait_seconds
+        self.timezone = zoneinfo.ZoneInfo('America/Chicago')
+
+    def refill(self, state: Optional[Dict[str, Any]], now: datetime.datetime) -> Dict[str, Any]:
+        """Returns the budget state with both buckets refilled for the time elapsed since it was last updated."""
+        today = now.date().isoformat()
+        timestamp = now.timestamp()
+        if not state:
+            state = {
+                'updated': timestamp,
+                'second_tokens': self.second_capacity,
+                'day_tokens': self.daily_capacity
+            }
+        elapsed = max(0.0, timestamp - state['updated'])
+        return {
+            'updated': timestamp,
+            'second_tokens': min(self.second_capacity, state['second_tokens'] + elapsed * self.requests_per_second),
+            'day_tokens': min(self.daily_capacity, state['day_tokens'] + elapsed * self.daily_rate),
+            'day': today,
+            'day_count': state.get('day_count', 0) if state.get('day') == today else 0
+        }
+
+    def reserve(self, state: Optional[Dict[str, Any]],
+                now: datetime.datetime) -> Tuple[Dict[str, Any], Optional[float]]:
+        """Takes a token from both buckets if available. Returns the new state and 0 if the request may be made, the
+            seconds to wait until it may be made, or None once the day's budget is spent."""
+        state = self.refill(state=state, now=now)
+        if state['day_count'] >= self.requests_per_day:
+            return state, None
+        wait_seconds = max(
+            (1 - state['second_tokens']) / self.requests_per_second,
+            (1 - state['day_tokens']) / self.daily_rate
+        )
+        if wait_seconds > 0:
+            return state, wait_seconds
+        state['second_tokens'] -= 1
+        state['day_tokens'] -= 1
+        state['day_count'] += 1
+        return state, 0
+
+    def acquire(self) -> None:
+        """Blocks until a request may be made. Raises RateLimitExceeded if the day's budget is spent or the wait
+            would be longer than max_wait_seconds."""
+        while True:
+            now = datetime.datetime.now(self.timezone)
+            wait_seconds = self.store.update(self.key, lambda state: self.reserve(state=state, now=now))
+            if wait_seconds is None:
+                raise RateLimitExceeded(f'Daily budget of {self.requests_per_day} requests spent.')
+            if wait_seconds == 0:
+                return
+            if wait_seconds > self.max_wait_seconds:
+                raise RateLimitExceeded(f'Request budget exhausted for the next {wait_seconds:.1f} seconds.')
+            time.sleep(wait_seconds)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns the remaining budget for the day and the tokens currently in each bucket."""
+        now = datetime.datetime.now(self.timezone)
+        state = self.store.update(self.key, lambda state: (state, self.refill(state=state, now=now)))
+        return {
+            'requests_today': state['day_count'],
+            'remaining_today': max(0, self.requests_per_day - state['day_count']),
+            'second_tokens': round(state['second_tokens'], 2),
+            'day_tokens': round(state['day_tokens'], 2)
+        }
+
+
+def create_shared_state_store(store_type: str, cache: InMemoryStateStore, file_path: str, bucket_name: Optional[str],
+                              prefix: str):
+    """Returns the state store of the given type: memory (the warm container), file (a local file shared by the
+        processes on one host) or s3 (objects under prefix shared by all concurrent Lambda containers)."""
+    if store_type == 'memory':
+        return cache
+    if store_type == 'file':
+        return FileStateStore(path=file_path)
+    if store_type == 's3':
+        if not bucket_name:
+            raise ValueError('A bucket name is required for the s3 state store.')
+        return S3StateStore(bucket_name=bucket_name, prefix=prefix, cache=cache)
+    raise ValueError(f'Unsupported state store: {store_type}')
+
+
+def get_rate_limiter() -> TokenBucketRateLimiter:
+    """Returns the rate limiter for the Train Tracker API. RATE_LIMIT_STORE selects where the budget is kept: memory
+        (the warm container, the default), file (RATE_LIMIT_FILE, shared by processes on one host) or s3
+        (RATE_LIMIT_BUCKET, shared by all concurrent Lambda containers)."""
+    store = create_shared_state_store(
+        store_type=os.environ.get('RATE_LIMIT_STORE', 'memory'),
+        cache=get_state_cache('rate_limit'),
+        file_path=os.environ.get('RATE_LIMIT_FILE', RATE_LIMIT_FILE_PATH),
+        bucket_name=os.environ.get('RATE_LIMIT_BUCKET'),
+        prefix='state/rate_limit/'
+    )
+    return TokenBucketRateLimiter(
+        store=store,
+        requests_per_second=float(os.environ.get('CTA_API_REQUESTS_PER_SECOND', CTA_API_REQUESTS_PER_SECOND)),
+        requests_per_day=int(os.environ.get('CTA_API_REQUESTS_PER_DAY', CTA_API_REQUESTS_PER_DAY)),
+        burst_seconds=int(os.environ.get('CTA_API_BURST_SECONDS', CTA_API_BURST_SECONDS)),
+        max_wait_seconds=float(os.environ.get('RATE_LIMIT_MAX_WAIT_SECONDS', RATE_LIMIT_MAX_WAIT_SECONDS))
+    )
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the Train Tracker API while the circuit breaker is open."""
+
+
+def is_circuit_breaker_failure(error: Exception) -> bool:
+    """Checks whether an error means the Train Tracker API is unhealthy: a timeout, a connection error, throttling
+        or a server error. Other client errors are caused by the request and do not count."""
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, requests.exceptions.RequestException)
+
+
+class CircuitBreaker:
+    """Fails calls fast once failure_threshold consecutive calls have failed, instead of letting every Lambda wait on
+        and retry an unhealthy API. After recovery_seconds a single probe call is let through: the circuit closes if
+        it succeeds and stays open for another recovery_seconds if it fails. State is kept in a store so that it
+        can be shared across containers."""
+
+    def __init__(self, store, key: str = 'cta_api', failure_threshold: int = CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+                 recovery_seconds: float = CIRCUIT_BREAKER_RECOVERY_SECONDS):
+        """Initializes the circuit breaker for the state saved under key in store."""
+        self.store = store
+        self.key = key
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+
+    def allow(self, state: Optional[Dict[str, Any]], now: float) -> Tuple[Dict[str, Any], bool]:
+        """Returns the new state and whether a call may be made. An open circuit lets one probe through once
+            recovery_seconds have passed, and lets another through if the probe has not reported back in time."""
+        state = state or {'state': 'closed', 'failures': 0, 'opened_at': None}
+        if state['state'] == 'closed':
+            return state, True
+        if now - state['opened_at'] < self.recovery_seconds:
+            return state, False
+        logger.info('Circuit breaker half open, sending a probe request')
+        return {**state, 'state': 'half_open', 'opened_at': now}, True
+
+    def record(self, state: Optional[Dict[str, Any]], now: float, success: bool) -> Tuple[Dict[str, Any], None]:
+        """Returns the new state after a call succeeded or failed."""
+        state = state or {'state': 'closed', 'failures': 0, 'opened_at': None}
+        if success:
+            return {'state': 'closed', 'failures': 0, 'opened_at': None}, None
+        failures = state['failures'] + 1
+        if state['state'] == 'half_open' or failures >= self.failure_threshold:
+            if state['state'] != 'open':
+                logger.warning('Circuit breaker opened after %d consecutive failures', failures)
+            return {'state': 'open', 'failures': failures, 'opened_at': now}, None
+        return {**state, 'failures': failures}, None
+
+    def call(self, function: Callable[..., Any], *args, **kwargs) -> Any:
+        """Calls the function unless the circuit is open, in which case a CircuitOpenError is raised."""
+        if not self.store.update(self.key, lambda state: self.allow(state=state, now=time.time())):
+            raise CircuitOpenError('Circuit breaker open, not calling the Train Tracker API.')
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            if is_circuit_breaker_failure(e):
+                self.store.update(self.key, lambda state: self.record(state=state, now=time.time(), success=False))
+            raise
+        self.store.update(self.key, lambda state: self.record(state=state, now=time.time(), success=True))
+        return result
+
+
+def get_circuit_breaker() -> CircuitBreaker:
+    """Returns the circuit breaker for the Train Tracker API. CIRCUIT_BREAKER_STORE selects where its state is kept,
+        as for RATE_LIMIT_STORE."""
+    store = create_shared_state_store(
+        store_type=os.environ.get('CIRCUIT_BREAKER_STORE', 'memory'),
+        cache=get_state_cache('circuit_breaker'),
+        file_path=os.environ.get('CIRCUIT_BREAKER_FILE', CIRCUIT_BREAKER_FILE_PATH),
+        bucket_name=os.environ.get('CIRCUIT_BREAKER_BUCKET'),
+        prefix='state/circuit_breaker/'
+    )
+    return CircuitBreaker(
+        store=store,
+        failure_threshold=int(os.environ.get('CIRCUIT_BREAKER_FAILURE_THRESHOLD', CIRCUIT_BREAKER_FAILURE_THRESHOLD)),
+        recovery_seconds=float(os.environ.get('CIRCUIT_BREAKER_RECOVERY_SECONDS', CIRCUIT_BREAKER_RECOVERY_SECONDS))
+    )
+
+
+def get_line_activity_store() -> Optional[S3StateStore]:
+    """Returns the store for the activity of each train line, which write_train_lines reads to decide which lines
+        to poll, or None if LINE_ACTIVITY_BUCKET is not set."""
+    bucket_name = os.environ.get('LINE_ACTIVITY_BUCKET')
+    if bucket_name:
+        return S3StateStore(
+            bucket_name=bucket_name,
+            prefix='state/line_activity/',
+            cache=get_state_cache('line_activity')
+        )
+    return None
+
+
+def update_line_activity(activity: Optional[Dict[str, Any]], trains_running: int, now: datetime.datetime,
+                         refresh_seconds: int = LINE_ACTIVITY_REFRESH_SECONDS) -> Optional[Dict[str, Any]]:
+    """Returns the activity of a train line after a poll, which is when trains were last seen running on it, or None
+        if the saved activity is still accurate enough. A line already seen running is only saved again once its
+        last active time is older than refresh_seconds, which must stay below the active window of
+        write_train_lines, so a running line costs one write every refresh_seconds rather than one every poll."""
+    if activity is None:
+        return {'last_active': now.isoformat() if trains_running else None}
+    if not trains_running:
+        return None
+    last_active = activity.get('last_active')
+    if last_active and (now - datetime.datetime.fromisoformat(last_active)).total_seconds() < refresh_seconds:
+        return None
+    return {'last_active': now.isoformat()}
+
+
+def record_line_activity(store: S3StateStore, trains_running: Dict[str, int], now: datetime.datetime,
+                         refresh_seconds: int = LINE_ACTIVITY_REFRESH_SECONDS) -> None:
+    """Saves the activity of each polled train line when it changed. The previous activity comes from the
+        warm-container cache when available. Failures are logged rather than raised since the activity only guides
+        scheduling."""
+    for train_line, line_trains_running in trains_running.items():
+        try:
+            activity = update_line_activity(
+                activity=store.cache.load(train_line) or store.load(train_line),
+                trains_running=line_trains_running,
+                now=now,
+                refresh_seconds=refresh_seconds
+            )
+            if activity is not None:
+                store.save(train_line, activity)
+        except botocore.exceptions.ClientError as e:
+            logger.error('Failed to save activity for %s: %s', train_line, e)
+
+
+def apply_delta_encoding(rows: List[Dict[str, Any]], state: Optional[Dict[str, Any]], now: datetime.datetime,
+                         keyframe_interval_seconds: int) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """Filters the rows for one train line down to the trains whose tracked fields changed since they were last
+        emitted. Every row is emitted as a keyframe when there is no previous state or the last keyframe is older
+        than keyframe_interval_seconds, and a removed row is emitted for each train that is no longer reported.
+        Returns the rows to emit and the new state, which should only be saved once the rows are written."""
+    last_keyframe = state and datetime.datetime.fromisoformat(state['last_keyframe'])
+    is_keyframe = not state or (now - last_keyframe).total_seconds() >= keyframe_interval_seconds
+    previous_trains = {} if is_keyframe else state['trains']
+
+    emitted_rows = []
+    trains = {}
+    for row in rows:
+        tracked_values = [row[field] for field in DELTA_TRACKED_FIELDS]
+        trains[row['train_id']] = tracked_values
+        if is_keyframe:
+            emitted_rows.append({**row, 'record_type': 'keyframe'})
+        elif previous_trains.get(row['train_id']) != tracked_values:
+            emitted_rows.append({**row, 'record_type': 'delta'})
+    current_timestamp = rows[0]['current_timestamp'] if rows else now.isoformat()
+    for train_id in (state or {}).get('trains', {}):
+        if train_id not in trains:
+            emitted_rows.append(
+                {'train_id': train_id, 'current_timestamp': current_timestamp, 'record_type': 'removed'}
+            )
+
+    new_state = {
+        'last_keyframe': now.isoformat() if is_keyframe else state['last_keyframe'],
+        'trains': trains
+    }
+    return emitted_rows, new_state
+
+
+def get_poll_ticks(now: datetime.datetime, interval_seconds: int,
+                   window_seconds: int = POLL_WINDOW_SECONDS) -> List[datetime.datetime]:
+    """Returns the wall-clock times to poll at within the window containing now, aligned to multiples of
+        interval_seconds so every invocation samples at the same offsets into the minute. The first tick is the
+        one now falls in, so the first poll happens straight away."""
+    if interval_seconds <= 0 or window_seconds % interval_seconds:
+        raise ValueError(f'Poll interval must be a positive divisor of {window_seconds} seconds: {interval_seconds}')
+    epoch_seconds = now.timestamp()
+    window_start = epoch_seconds - epoch_seconds % window_seconds
+    first_tick = epoch_seconds - epoch_seconds % interval_seconds
+    return [
+        datetime.datetime.fromtimestamp(tick, tz=now.tzinfo)
+        for tick in range(int(first_tick), int(window_start) + window_seconds, interval_seconds)
+    ]
+
+
+class BatchFailedError(Exception):
+    """Raised when every message in an SQS batch failed, so the whole batch is redelivered."""
+
+
+def poll_train_locations(request_groups: List[Dict[str, str]], now: datetime.datetime, max_workers: int,
+                         delta_states: Optional[Dict[str, Any]] = None, delta_state_store=None,
+                         keyframe_interval_seconds: int = DELTA_KEYFRAME_INTERVAL_SECONDS
+                         ) -> Tuple[List[Dict[str, Any]], set, Dict[str, int]]:
+    """Fetches and parses the locations of every train line in the request groups once. When delta_states is
+        provided the rows are delta encoded against it, loading a line's state from delta_state_store the first
+        time the line is seen, and the dictionary is updated with each line's new state. Returns the rows, the
+        abbreviations of the lines that could not be retrieved and the number of trains running on each line that
+        was retrieved."""
+    today_date = now.date().strftime('%Y-%m-%d')
+    today_datetime = now.isoformat()
+    results = fetch_train_locations_concurrently(request_groups=request_groups, max_workers=max_workers)
+
+    train_location_data = []
+    failed_train_line_abbrevs = set()
+    trains_running = {}
+    for request_group, (locations, error) in zip(request_groups, results):
+        try:
+            if error:
+                raise error
+            trains_by_line = split_locations_by_line(locations=locations, train_lines=request_group)
+        except Exception as e:
+            logger.error('Failed to retrieve train locations for %s: %s', list(request_group.values()), e)
+            failed_train_line_abbrevs.update(request_group.keys())
+            continue
+        for train_line in request_group.values():
+            rows = parse_train_location_data(
+                trains=trains_by_line.get(train_line, []),
+                train_line=train_line,
+                today_date=today_date,
+                today_datetime=today_datetime
+            )
+            trains_running[train_line] = len(rows)
+            if delta_states is not None:
+                if train_line not in delta_states:
+                    delta_states[train_line] = delta_state_store.load(train_line)
+                rows, delta_states[train_line] = apply_delta_encoding(
+                    rows=rows,
+                    state=delta_states[train_line],
+                    now=now,
+                    keyframe_interval_seconds=keyframe_interval_seconds
+                )
+            train_location_data.extend(rows)
+    return train_location_data, failed_train_line_abbrevs, trains_running
 
 
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
@@ -89,50 +969,137 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     logger.info(f'Event: {event}')
 
     timezone = zoneinfo.ZoneInfo('America/Chicago')
-    today = datetime.datetime.now(timezone)
-    today_date = today.date().strftime('%Y-%m-%d')
-    today_datetime = today.isoformat()
-
-    sqs_message_body = event.get('Records', [])[0].get('body', '')
-    train_line_abbrev = json.loads(sqs_message_body).get('train_line_abbrev', '')
-    train_line = json.loads(sqs_message_body).get('train_line', '')
-    if not train_line_abbrev or not train_line:
-        raise ValueError('Parameters train_line_abbrev and/or train_line were not present in the SQS message payload.')
-
-    logger.info('Retrieved train_line_abbrev and train_line from SQS message body')
-    locations = get_train_locations(train_line_abbrev=train_line_abbrev)
-    trains = locations.get('ctatt', {}).get('route', [])
-    if trains:
-        trains_in_service = trains[0].get('train', [])
-        if trains_in_service:
-            logger.info('Found at least one train currently running, parsing train location data')
-            train_location_data = []
-            for train in trains_in_service:
-                train_location_data.append(
-                    {
-                        'train_id': f'{today_date}#{train_line}#{train['rn']}#{train['trDr']}',
-                        'current_timestamp': today_datetime,
-                        'prediction_generated_timestamp': train['prdt'],
-                        'destination_station': train['destNm'],
-                        'next_station': train['nextStaNm'],
-                        'next_station_arrival_time': train['arrT'],
-                        'is_approaching_station': train['isApp'],
-                        'is_train_delayed': train['isDly']
-                    }
-                )
-            write_train_location_data(data_to_write=train_location_data, max_retries=5)
-        else:
-            logger.info('No trains running currently')
+
+    # API requests must finish in time to leave POLL_WRITE_RESERVE_MS for the Firehose write
+    global api_request_deadline
+    remaining_ms = getattr(context, 'get_remaining_time_in_millis', lambda: float('inf'))()
+    api_request_deadline = time.monotonic() + (remaining_ms - POLL_WRITE_RESERVE_MS) / 1000
+
+    # Every record in the SQS batch is processed. Lines requested by more than one message are fetched once.
+    message_train_lines = {}
+    failed_message_ids = set()
+    for record in event.get('Records', []):
+        message_id = record.get('messageId', '')
+        try:
+            message_train_lines[message_id] = get_train_lines_from_message(message_body=record.get('body', ''))
+        except (ValueError, json.JSONDecodeError) as e:
+            logger.error('Invalid SQS message %s: %s', message_id, e)
+            failed_message_ids.add(message_id)
+    train_lines = {}
+    for message_lines in message_train_lines.values():
+        train_lines.update(message_lines)
+    logger.info(
+        'Retrieved %d train lines from %d SQS messages: %s',
+        len(train_lines),
+        len(event.get('Records', [])),
+        list(train_lines.values())
+    )
+
+    # The positions endpoint accepts a comma-separated route list, so by default all lines are fetched in one
+    # request. Smaller request groups are fetched in parallel.
+    max_routes_per_request = int(os.environ.get('MAX_ROUTES_PER_REQUEST', max(len(train_lines), 1)))
+    request_groups = group_train_lines(train_lines=train_lines, max_routes_per_request=max_routes_per_request)
+    max_workers = int(os.environ.get('FETCH_MAX_WORKERS', FETCH_MAX_WORKERS))
+
+    # In delta mode only trains whose tracked fields changed are emitted, plus a periodic keyframe of every train
+    delta_mode = os.environ.get('DELTA_MODE', 'false').lower() == 'true'
+    delta_state_store = get_delta_state_store() if delta_mode else None
+    keyframe_interval_seconds = int(os.environ.get('DELTA_KEYFRAME_INTERVAL_SECONDS', DELTA_KEYFRAME_INTERVAL_SECONDS))
+    new_delta_states = {} if delta_mode else None
+
+    # With a sub-minute poll interval the invocation polls at each aligned tick of its minute, and the rows of
+    # every poll are buffered into a single Firehose write at the end
+    poll_ticks = get_poll_ticks(
+        now=datetime.datetime.now(timezone),
+        interval_seconds=int(os.environ.get('POLL_INTERVAL_SECONDS', POLL_INTERVAL_SECONDS))
+    )
+    train_location_data = []
+    failed_polls = collections.Counter()
+    line_trains_running = {}
+    polls = 0
+    for tick in poll_ticks:
+        if polls:
+            remaining_ms = getattr(context, 'get_remaining_time_in_millis', lambda: float('inf'))()
+            wait_seconds = (tick - datetime.datetime.now(timezone)).total_seconds()
+            if remaining_ms - max(wait_seconds, 0) * 1000 < POLL_WRITE_RESERVE_MS:
+                logger.warning('Skipping %d remaining polls to leave time for the write', len(poll_ticks) - polls)
+                break
+            if wait_seconds > 0:
+                time.sleep(wait_seconds)
+        poll_data, poll_failed_abbrevs, poll_trains_running = poll_train_locations(
+            request_groups=request_groups,
+            now=datetime.datetime.now(timezone),
+            max_workers=max_workers,
+            delta_states=new_delta_states,
+            delta_state_store=delta_state_store,
+            keyframe_interval_seconds=keyframe_interval_seconds
+        )
+        train_location_data.extend(poll_data)
+        failed_polls.update(poll_failed_abbrevs)
+        for train_line, poll_line_trains_running in poll_trains_running.items():
+            line_trains_running[train_line] = max(line_trains_running.get(train_line, 0), poll_line_trains_running)
+        polls += 1
+    logger.info('Completed %d polls, HTTP session stats: %s', polls, get_http_session_stats())
+    logger.info('CTA API request budget: %s', get_rate_limiter().get_stats())
+    trains_running = sum(line_trains_running.values())
+
+    # The activity of each line lets write_train_lines slow down polling for lines that are not running
+    line_activity_store = get_line_activity_store()
+    if line_activity_store:
+        record_line_activity(
+            store=line_activity_store,
+            trains_running=line_trains_running,
+            now=datetime.datetime.now(timezone),
+            refresh_seconds=int(os.environ.get('LINE_ACTIVITY_REFRESH_SECONDS', LINE_ACTIVITY_REFRESH_SECONDS))
+        )
+    # A line only counts as failed if none of its polls succeeded
+    failed_train_line_abbrevs = {abbrev for abbrev, count in failed_polls.items() if count == polls}
+
+    # Only the messages covering a failed line are reported so SQS redelivers just those
+    for message_id, message_lines in message_train_lines.items():
+        if failed_train_line_abbrevs.intersection(message_lines.keys()):
+            failed_message_ids.add(message_id)
+    batch_item_failures = [{'itemIdentifier': message_id} for message_id in sorted(failed_message_ids)]
+    if batch_item_failures:
+        logger.warning('Reporting %d failed SQS messages: %s', len(batch_item_failures), batch_item_failures)
+
+    if train_location_data:
+        logger.info('Found %d trains currently running, writing train location data', trains_running)
+        write_train_location_data(data_to_write=train_location_data, max_retries=5)
+    for train_line, new_delta_state in (new_delta_states or {}).items():
+        delta_state_store.save(train_line, new_delta_state)
+
+    # A batch in which every message failed is raised rather than returned, so the failure is alerted on
+    records = event.get('Records', [])
+    if records and len(batch_item_failures) == len(records):
+        raise BatchFailedError(
+            f'Every message in the batch failed, failed train lines: {sorted(failed_train_line_abbrevs)}'
+        )
+
+    if not train_location_data:
+        if failed_train_line_abbrevs:
+            logger.info('No records written, train lines failed: %s', sorted(failed_train_line_abbrevs))
             return {
                 'statusCode': 204,
-                'body': 'No records written due to no trains running'
+                'body': 'No records written due to failed train lines',
+                'batchItemFailures': batch_item_failures
             }
-    else:
-        message = 'Route or ctatt object not present in API response'
-        logger.info(message)
-        raise KeyError(message)
+        if trains_running:
+            logger.info('No train changes since the last poll')
+            return {
+                'statusCode': 204,
+                'body': 'No records written due to no train changes',
+                'batchItemFailures': batch_item_failures
+            }
+        logger.info('No trains running currently')
+        return {
+            'statusCode': 204,
+            'body': 'No records written due to no trains running',
+            'batchItemFailures': batch_item_failures
+        }
 
     return {
         'statusCode': 200,
-        'body': 'Execution successful'
+        'body': 'Execution successful',
+        'batchItemFailures': batch_item_failures
     }
@@ -1,7 +1,12 @@
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
+import functools
 import logging
 import os
 import json
+import datetime
+import random
+import time
+import zoneinfo
 
 import boto3
 import botocore
@@ -32,6 +37,35 @@ cta_train_lines = {
     'Pink': 'Pink'
 }
 
+# Local service hours of each line as (start hour, end hour), padded to cover the first and last trains. An end hour
+# before the start hour means service runs past midnight, and None means the line runs around the clock.
+CTA_SERVICE_HOURS = {
+    'Red': None,
+    'Blue': None,
+    'Brown': (4, 2),
+    'Green': (4, 2),
+    'Orange': (3, 2),
+    'Purple': (4, 2),
+    'Pink': (4, 2)
+}
+LINE_ACTIVE_WINDOW_SECONDS = 900
+INACTIVE_POLL_INTERVAL_MINUTES = 10
+LINE_ACTIVITY_CACHE_SECONDS = 120
+
+SQS_MAX_BATCH_ENTRIES = 10
+SQS_MAX_RETRIES = 3
+SQS_BACKOFF_BASE_SECONDS = 0.1
+SQS_BACKOFF_MAX_SECONDS = 2.0
+
+# Created at module level so the line activity read from S3 is reused across warm Lambda invocations
+line_activity_cache = {}
+
+
+@functools.cache
+def get_sqs_client(region_name: str):
+    """Returns the SQS client."""
+    return boto3.client('sqs', region_name=region_name)
+
 
 @backoff_on_client_error
 def get_sqs_queue_url(sqs_client, queue_name: str) -> str:
@@ -51,21 +85,141 @@ def get_sqs_queue_url(sqs_client, queue_name: str) -> str:
         raise
 
 
+@functools.cache
+def get_s3_client():
+    """Returns the S3 client."""
+    return boto3.client('s3')
+
+
 @backoff_on_client_error
-def send_message_to_sqs(sqs_client, queue_url: str, message_body: Dict[str, Any]) -> None:
-    """Send a message to the specified SQS queue."""
-    logger.info('Sending message to SQS queue: %s', queue_url)
+def load_line_activity(s3_client, bucket_name: str, train_line: str) -> Optional[Dict[str, Any]]:
+    """Returns the activity get_train_status last recorded for a train line, or None if there is none."""
     try:
-        sqs_client.send_message(
-            QueueUrl=queue_url,
-            MessageBody=json.dumps(message_body)
+        response = s3_client.get_object(Bucket=bucket_name, Key=f'state/line_activity/{train_line}.json')
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+    return json.loads(response['Body'].read())
+
+
+def get_line_activity(s3_client, bucket_name: str, train_line: str,
+                      cache_seconds: int = LINE_ACTIVITY_CACHE_SECONDS) -> Optional[Dict[str, Any]]:
+    """Returns the activity of a train line, only reading it from S3 again once the copy cached in the warm Lambda
+        container is older than cache_seconds."""
+    cached = line_activity_cache.get(train_line)
+    if cached is None or time.monotonic() - cached[0] >= cache_seconds:
+        activity = load_line_activity(s3_client=s3_client, bucket_name=bucket_name, train_line=train_line)
+        cached = (time.monotonic(), activity)
+        line_activity_cache[train_line] = cached
+    return cached[1]
+
+
+def is_in_service_hours(service_hours: Optional[Tuple[int, int]], now: datetime.datetime) -> bool:
+    """Checks whether the local hour of now falls within a line's service hours."""
+    if service_hours is None:
+        return True
+    start_hour, end_hour = service_hours
+    if start_hour <= end_hour:
+        return start_hour <= now.hour < end_hour
+    return now.hour >= start_hour or now.hour < end_hour
+
+
+def should_poll_line(train_line: str, activity: Optional[Dict[str, Any]], now: datetime.datetime,
+                     use_service_hours: bool = True, active_window_seconds: int = LINE_ACTIVE_WINDOW_SECONDS,
+                     inactive_poll_interval_minutes: int = INACTIVE_POLL_INTERVAL_MINUTES) -> bool:
+    """Decides whether a train line is polled this minute. The activity recorded by get_train_status decides first:
+        lines with trains seen within active_window_seconds are polled every minute and other lines only every
+        inactive_poll_interval_minutes, so trains appearing are still noticed. Lines without any recorded activity
+        fall back to the service hours table when use_service_hours is set, and are otherwise always polled."""
+    on_interval = (now.hour * 60 + now.minute) % inactive_poll_interval_minutes == 0
+    if activity is not None:
+        last_active = activity.get('last_active')
+        if last_active and (now - datetime.datetime.fromisoformat(last_active)).total_seconds() < active_window_seconds:
+            return True
+        return on_interval
+    if use_service_hours and train_line in CTA_SERVICE_HOURS:
+        return is_in_service_hours(service_hours=CTA_SERVICE_HOURS[train_line], now=now) or on_interval
+    return True
+
+
+def get_train_lines_to_poll(train_lines: Dict[str, str], now: datetime.datetime) -> Dict[str, str]:
+    """Returns the train lines to poll this minute. Every line is polled unless ADAPTIVE_SCHEDULING is enabled, in
+        which case the activity get_train_status records in LINE_ACTIVITY_BUCKET decides."""
+    if os.environ.get('ADAPTIVE_SCHEDULING', 'false').lower() != 'true':
+        return train_lines
+    bucket_name = os.environ['LINE_ACTIVITY_BUCKET']
+    use_service_hours = os.environ.get('USE_SERVICE_HOURS', 'true').lower() == 'true'
+    lines_to_poll = {}
+    for train_abbrev, train_line in train_lines.items():
+        activity = get_line_activity(
+            s3_client=get_s3_client(),
+            bucket_name=bucket_name,
+            train_line=train_line,
+            cache_seconds=int(os.environ.get('LINE_ACTIVITY_CACHE_SECONDS', LINE_ACTIVITY_CACHE_SECONDS))
         )
-        logger.info('Successfully sent message to SQS queue')
+        if should_poll_line(
+            train_line=train_line,
+            activity=activity,
+            now=now,
+            use_service_hours=use_service_hours,
+            active_window_seconds=int(os.environ.get('LINE_ACTIVE_WINDOW_SECONDS', LINE_ACTIVE_WINDOW_SECONDS)),
+            inactive_poll_interval_minutes=int(
+                os.environ.get('INACTIVE_POLL_INTERVAL_MINUTES', INACTIVE_POLL_INTERVAL_MINUTES)
+            )
+        ):
+            lines_to_poll[train_abbrev] = train_line
+    skipped_lines = [train_line for train_line in train_lines.values() if train_line not in lines_to_poll.values()]
+    if skipped_lines:
+        logger.info('Skipping inactive train lines this minute: %s', skipped_lines)
+    return lines_to_poll
+
+
+@functools.cache
+def get_cached_sqs_queue_url(sqs_client, queue_name: str) -> str:
+    """Get the URL of the specified SQS queue, only calling GetQueueUrl the first time in a warm Lambda container."""
+    return get_sqs_queue_url(sqs_client=sqs_client, queue_name=queue_name)
+
+
+@backoff_on_client_error
+def send_sqs_message_batch(sqs_client, queue_url: str, entries: List[Dict[str, str]]) -> Dict[str, Any]:
+    """Send up to 10 message entries to the specified SQS queue in a single SendMessageBatch call."""
+    logger.info('Sending %d messages to SQS queue: %s', len(entries), queue_url)
+    try:
+        return sqs_client.send_message_batch(QueueUrl=queue_url, Entries=entries)
     except botocore.exceptions.ClientError as e:
-        logger.error('Failed to send message to SQS queue: %s', e)
+        logger.error('Failed to send messages to SQS queue: %s', e)
         raise
 
 
+def send_messages_to_sqs(sqs_client, queue_url: str, message_bodies: List[Dict[str, Any]],
+                         max_retries: int = SQS_MAX_RETRIES) -> None:
+    """Send messages to the specified SQS queue in batches of up to 10. Only the entries that failed are resent,
+        after an exponential backoff with full jitter, until max_retries attempts are exhausted."""
+    for start in range(0, len(message_bodies), SQS_MAX_BATCH_ENTRIES):
+        remaining = [
+            {'Id': str(start + i), 'MessageBody': json.dumps(message_body)}
+            for i, message_body in enumerate(message_bodies[start:start + SQS_MAX_BATCH_ENTRIES])
+        ]
+        attempts = 0
+        while remaining and attempts < max_retries:
+            response = send_sqs_message_batch(sqs_client=sqs_client, queue_url=queue_url, entries=remaining)
+            failed = response.get('Failed', [])
+            sender_faults = [entry for entry in failed if entry.get('SenderFault')]
+            if sender_faults:
+                raise Exception(f'Failed to send {len(sender_faults)} messages to SQS queue: {sender_faults}')
+            failed_ids = {entry['Id'] for entry in failed}
+            remaining = [entry for entry in remaining if entry['Id'] in failed_ids]
+            attempts += 1
+            if remaining and attempts < max_retries:
+                logger.info('%d messages failed on attempt %d, retrying failed messages', len(remaining), attempts)
+                backoff_seconds = min(SQS_BACKOFF_MAX_SECONDS, SQS_BACKOFF_BASE_SECONDS * 2 ** attempts)
+                time.sleep(random.uniform(0, backoff_seconds))
+        if remaining:
+            raise Exception(f'Failed to send {len(remaining)} messages after {max_retries} retries.')
+    logger.info('Successfully sent %d messages to SQS queue', len(message_bodies))
+
+
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """Main handler function for the Lambda writing CTA train lines to SQS."""
     logger.info('Begin Lambda execution')
@@ -77,23 +231,37 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     queue_name = os.environ['SQS_QUEUE_NAME']
     logger.info('SQS queue name: %s', queue_name)
 
-    sqs = boto3.client('sqs', region_name=os.environ['REGION_NAME'])
-    queue_url = get_sqs_queue_url(
+    sqs = get_sqs_client(region_name=os.environ['REGION_NAME'])
+    queue_url = get_cached_sqs_queue_url(
         sqs_client=sqs,
         queue_name=queue_name
     )
 
-    for train_abbrev, train_line in cta_train_lines.items():
-        logger.info('Processing train line: %s', train_line)
-        message_body = {
-            'train_line_abbrev': train_abbrev,
-            'train_line': train_line
-        }
-        send_message_to_sqs(
-            sqs_client=sqs,
-            queue_url=queue_url,
-            message_body=message_body
-        )
+    train_lines_to_poll = get_train_lines_to_poll(
+        train_lines=cta_train_lines,
+        now=datetime.datetime.now(zoneinfo.ZoneInfo('America/Chicago'))
+    )
+
+    # In batched mode a single message covers every line, so get_train_status makes one multi-route API request
+    poll_mode = os.environ.get('POLL_MODE', 'per_line')
+    logger.info('Poll mode: %s', poll_mode)
+    if poll_mode == 'batched':
+        train_lines = [
+            {'train_line_abbrev': train_abbrev, 'train_line': train_line}
+            for train_abbrev, train_line in train_lines_to_poll.items()
+        ]
+        message_bodies = [{'train_lines': train_lines}] if train_lines else []
+    else:
+        message_bodies = [
+            {'train_line_abbrev': train_abbrev, 'train_line': train_line}
+            for train_abbrev, train_line in train_lines_to_poll.items()
+        ]
+    # All messages go out in a single SendMessageBatch call rather than one SendMessage call per line
+    send_messages_to_sqs(
+        sqs_client=sqs,
+        queue_url=queue_url,
+        message_bodies=message_bodies
+    )
     return {
         'statusCode': 200,
         'body': 'Processed all train lines'
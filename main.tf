@@ -140,6 +140,7 @@ module "cta_write_train_lines_lambda" {
   lambda_environment_variables = {
     SQS_QUEUE_NAME = local.queue_name
     REGION_NAME    = var.aws_region_name
+    POLL_MODE      = "batched"
   }
 }
 
@@ -147,6 +148,8 @@ module "sqs_queue" {
   source                     = "git::https://github.com/amolrairikar/aws-account-infrastructure.git//modules/sqs-topic?ref=main"
   queue_name                 = "cta-trigger-get-train-status"
   message_retention_seconds  = 3600
+  # At least the get_train_status Lambda timeout, so a batch is not redelivered while it is still being processed,
+  # and short enough for a failed line to be retried within the next minute or so
   visibility_timeout_seconds = 20
   project                    = var.project_name
   environment                = var.environment
@@ -268,12 +271,14 @@ module "cta_get_train_status_lambda" {
   }
 }
 
-module "sqs_lambda_trigger" {
-  source              = "git::https://github.com/amolrairikar/aws-account-infrastructure.git//modules/sqs-lambda-trigger?ref=main"
-  sqs_queue_arn       = module.sqs_queue.queue_arn
-  lambda_function_arn = module.cta_get_train_status_lambda.lambda_arn
-  trigger_enabled     = true
-  batch_size          = 1
+# The handler reports the messages of the lines it could not poll in batchItemFailures, so only those are
+# redelivered rather than the whole batch
+resource "aws_lambda_event_source_mapping" "sqs_lambda_trigger" {
+  event_source_arn        = module.sqs_queue.queue_arn
+  function_name           = module.cta_get_train_status_lambda.lambda_arn
+  enabled                 = true
+  batch_size              = 10
+  function_response_types = ["ReportBatchItemFailures"]
 }
 
 module "firehose_s3_delivery_stream" {
@@ -303,12 +308,26 @@ data "aws_iam_policy_document" "lambda_bucket_raw_data_execution_role_inline_pol
   statement {
     effect    = "Allow"
     actions = [
-      "s3:PutObject"
+      "s3:GetObject",
+      "s3:PutObject",
+      "s3:DeleteObject",
+      "s3:AbortMultipartUpload"
     ]
     resources = [
       "arn:aws:s3:::${module.cta_project_data_bucket.bucket_id}/processed/*"
     ]
   }
+  statement {
+    effect    = "Allow"
+    actions = [
+      "s3:GetObject",
+      "s3:PutObject",
+      "s3:AbortMultipartUpload"
+    ]
+    resources = [
+      "arn:aws:s3:::${module.cta_project_data_bucket.bucket_id}/rollups/*"
+    ]
+  }
   statement {
     effect    = "Allow"
     actions = [
@@ -329,7 +348,7 @@ data "aws_iam_policy_document" "lambda_bucket_raw_data_execution_role_inline_pol
     condition {
       test     = "StringLike"
       variable = "s3:prefix"
-      values   = ["raw/*", "processed/*"]
+      values   = ["raw/*", "processed/*", "rollups/*"]
     }
   }
   statement {
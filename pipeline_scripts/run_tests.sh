@@ -1,14 +1,14 @@
 #!/bin/bash
 
 echo "Running unit tests..."
-if ! pipenv run coverage run --source=lambdas -m unittest discover -s tests/unit -v; then
+if ! pipenv run coverage run --source=lambdas,analytics -m unittest discover -s tests/unit -v; then
     echo "Unit tests failed!"
     exit 1
 fi
 mv .coverage .coverage.unit
 
 echo "Running component tests..."
-if ! pipenv run coverage run --source=lambdas -m unittest discover -s tests/component -v; then
+if ! pipenv run coverage run --source=lambdas,analytics -m unittest discover -s tests/component -v; then
     echo "Component tests failed!"
     exit 1
 fi
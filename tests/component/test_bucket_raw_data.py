@@ -0,0 +1,311 @@
+"""Module for component testing of the bucket_raw_data lambda handler function."""
+import unittest
+from unittest.mock import patch
+import datetime
+import io
+import json
+import os
+import zoneinfo
+
+import boto3
+import pyarrow.parquet as pq
+from moto import mock_aws
+
+from lambdas.bucket_raw_data.bucket_raw_data import lambda_handler, save_manifest
+
+
+class MockLambdaContext:
+    """Mock class for AWS Lambda context."""
+
+    def __init__(self):
+        """Initializes mock Lambda context with constant attributes for tests."""
+        self.aws_request_id = 'test-request-id'
+        self.function_name = 'test-function-name'
+        self.function_version = 'test-function-version'
+
+
+def raw_object(train_ids, current_timestamp):
+    """Returns the NDJSON body of a raw object with one row per train at the given timestamp."""
+    rows = [
+        {
+            'train_id': train_id,
+            'current_timestamp': current_timestamp,
+            'prediction_generated_timestamp': '2025-06-20T12:42:56',
+            'destination_station': 'Forest Park',
+            'next_station': 'Belmont',
+            'next_station_arrival_time': '2025-06-20T12:43:56',
+            'is_approaching_station': '1',
+            'is_train_delayed': '0'
+        }
+        for train_id in train_ids
+    ]
+    return ''.join(json.dumps(row) + '\n' for row in rows).encode('utf-8')
+
+
+class TestBucketRawData(unittest.TestCase):
+    """Class for testing bucket_raw_data Lambda function."""
+
+    def setUp(self):
+        """Patch environment variables and common dependencies before each test."""
+        self.mock_event = {
+            'eventType': 'test-event'
+        }
+        self.env_patcher = patch.dict(
+            os.environ,
+            {
+                'S3_BUCKET_NAME': 'test-bucket',
+                'AWS_DEFAULT_REGION': 'us-east-2'
+            }
+        )
+        self.env_patcher.start()
+        today = datetime.datetime.now(zoneinfo.ZoneInfo('America/Chicago')).date()
+        self.prev_day = today - datetime.timedelta(days=1)
+        self.raw_prefix = f'raw/{self.prev_day.year}/{self.prev_day.month:02d}/{self.prev_day.day:02d}/'
+        self.processed_prefix = f'processed/load_date={self.prev_day.isoformat()}/'
+
+    def tearDown(self):
+        """Stop all patches after each test."""
+        self.env_patcher.stop()
+
+    def put_raw_object(self, s3, name, train_ids, hour):
+        """Uploads a raw object for the previous day with rows at the given hour."""
+        s3.put_object(
+            Bucket='test-bucket',
+            Key=f'{self.raw_prefix}{name}',
+            Body=raw_object(train_ids, f'{self.prev_day.isoformat()}T{hour:02d}:15:00-05:00')
+        )
+
+    def processed_objects(self, s3):
+        """Returns the rows of each processed object of the previous day, keyed by object key."""
+        response = s3.list_objects_v2(Bucket='test-bucket', Prefix=self.processed_prefix)
+        return {
+            obj['Key']: pq.read_table(
+                io.BytesIO(s3.get_object(Bucket='test-bucket', Key=obj['Key'])['Body'].read())
+            ).column('train_id').to_pylist()
+            for obj in response.get('Contents', [])
+        }
+
+    def rollup_rows(self, s3, name):
+        """Returns the rows of a rollup table of the previous day."""
+        key = f'rollups/{name}/load_date={self.prev_day.isoformat()}/{name}.parquet'
+        return pq.read_table(io.BytesIO(s3.get_object(Bucket='test-bucket', Key=key)['Body'].read())).to_pylist()
+
+    def failing_manifest_save(self, failed_save):
+        """Returns a save_manifest replacement that raises on the failed_save-th call and saves the manifest on all
+            others."""
+        manifest_saves = []
+
+        def save(**kwargs):
+            manifest_saves.append(kwargs)
+            if len(manifest_saves) == failed_save:
+                raise Exception('Timed out')
+            save_manifest(**kwargs)
+        return save
+
+    @mock_aws
+    def test_lambda_handler_success(self):
+        """Test each partition is written once and a second run compacts nothing new."""
+        s3 = boto3.client('s3', region_name='us-east-2')
+        s3.create_bucket(Bucket='test-bucket', CreateBucketConfiguration={'LocationConstraint': 'us-east-2'})
+        self.put_raw_object(s3, 'object-1', ['d#Red#2#1', 'd#Purple#1#5', 'd#Red#1#1'], hour=10)
+        self.put_raw_object(s3, 'object-2', ['d#Red#1#1'], hour=11)
+
+        response = lambda_handler(self.mock_event, MockLambdaContext())
+        first_run_objects = self.processed_objects(s3)
+        lambda_handler(self.mock_event, MockLambdaContext())
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(
+            sorted((key.rsplit('/', 1)[0], rows) for key, rows in first_run_objects.items()),
+            [
+                (f'{self.processed_prefix}train_line=Purple/hour=10', ['d#Purple#1#5']),
+                (f'{self.processed_prefix}train_line=Red/hour=10', ['d#Red#1#1', 'd#Red#2#1']),
+                (f'{self.processed_prefix}train_line=Red/hour=11', ['d#Red#1#1'])
+            ]
+        )
+        self.assertEqual(self.processed_objects(s3), first_run_objects)
+        manifest = json.loads(
+            s3.get_object(
+                Bucket='test-bucket',
+                Key=f'processed/_manifest/load_date={self.prev_day.isoformat()}.json'
+            )['Body'].read()
+        )
+        self.assertEqual(sorted(manifest['objects']), [f'{self.raw_prefix}object-1', f'{self.raw_prefix}object-2'])
+        self.assertEqual(sorted(manifest['parts']), sorted(first_run_objects))
+        self.assertEqual(
+            [
+                (row['train_line'], row['hour'].hour, row['runs_in_service'])
+                for row in self.rollup_rows(s3, 'lines_by_hour')
+            ],
+            [('Purple', 10, 1), ('Red', 10, 2), ('Red', 11, 1)]
+        )
+
+    @mock_aws
+    def test_incremental_compaction_with_consolidation(self):
+        """Test new raw objects are appended as new parts and then consolidated into one object per partition."""
+        s3 = boto3.client('s3', region_name='us-east-2')
+        s3.create_bucket(Bucket='test-bucket', CreateBucketConfiguration={'LocationConstraint': 'us-east-2'})
+        self.put_raw_object(s3, 'object-1', ['d#Red#2#1'], hour=10)
+
+        with patch.dict(os.environ, {'COMPACTION_MODE': 'incremental'}):
+            lambda_handler(self.mock_event, MockLambdaContext())
+            self.put_raw_object(s3, 'object-2', ['d#Red#1#1'], hour=10)
+            lambda_handler(self.mock_event, MockLambdaContext())
+            appended_objects = self.processed_objects(s3)
+            with patch.dict(os.environ, {'CONSOLIDATE_PARTS': 'true'}):
+                lambda_handler(self.mock_event, MockLambdaContext())
+
+        self.assertEqual(sorted(appended_objects.values()), [['d#Red#1#1'], ['d#Red#2#1']])
+        self.assertEqual(
+            [
+                (row['train_line'], row['hour'].hour, row['runs_in_service'], row['snapshot_count'])
+                for row in self.rollup_rows(s3, 'lines_by_hour')
+            ],
+            [('Red', 10, 2, 2)]
+        )
+        self.assertEqual([row['trains_in_service'] for row in self.rollup_rows(s3, 'trains_by_minute')], [2])
+        consolidated_objects = self.processed_objects(s3)
+        self.assertEqual(list(consolidated_objects.values()), [['d#Red#1#1', 'd#Red#2#1']])
+        self.assertTrue(list(consolidated_objects)[0].startswith(f'{self.processed_prefix}train_line=Red/hour=10/'))
+
+    @mock_aws
+    def test_retry_after_failure_before_manifest_saved(self):
+        """Test the objects written by a run that failed before recording them in the manifest are deleted by the
+            next run once the failed run has timed out, so their rows are not duplicated."""
+        s3 = boto3.client('s3', region_name='us-east-2')
+        s3.create_bucket(Bucket='test-bucket', CreateBucketConfiguration={'LocationConstraint': 'us-east-2'})
+        self.put_raw_object(s3, 'object-1', ['d#Red#2#1', 'd#Red#1#1'], hour=10)
+
+        with patch('lambdas.bucket_raw_data.bucket_raw_data.save_manifest', side_effect=self.failing_manifest_save(2)):
+            with self.assertRaises(Exception):
+                lambda_handler(self.mock_event, MockLambdaContext())
+        orphaned_objects = self.processed_objects(s3)
+        with patch.dict(os.environ, {'COMPACTION_RUN_TIMEOUT_SECONDS': '0'}):
+            lambda_handler(self.mock_event, MockLambdaContext())
+
+        self.assertEqual(len(orphaned_objects), 1)
+        self.assertEqual(list(self.processed_objects(s3).values()), [['d#Red#1#1', 'd#Red#2#1']])
+        self.assertNotIn(list(orphaned_objects)[0], self.processed_objects(s3))
+        self.assertEqual([row['trains_in_service'] for row in self.rollup_rows(s3, 'trains_by_minute')], [2])
+
+    @mock_aws
+    def test_retry_after_failure_before_rollups_recorded(self):
+        """Test a run that failed after writing its rollups but before recording them in the manifest does not have
+            its rows counted twice, and rows pending a rollup are merged by the next run."""
+        s3 = boto3.client('s3', region_name='us-east-2')
+        s3.create_bucket(Bucket='test-bucket', CreateBucketConfiguration={'LocationConstraint': 'us-east-2'})
+        self.put_raw_object(s3, 'object-1', ['d#Red#2#1', 'd#Red#1#1'], hour=10)
+
+        with patch.dict(os.environ, {'COMPACTION_MODE': 'incremental'}):
+            failing_save = self.failing_manifest_save(3)
+            with patch('lambdas.bucket_raw_data.bucket_raw_data.save_manifest', side_effect=failing_save):
+                with self.assertRaises(Exception):
+                    lambda_handler(self.mock_event, MockLambdaContext())
+            self.put_raw_object(s3, 'object-2', ['d#Red#3#1'], hour=10)
+            lambda_handler(self.mock_event, MockLambdaContext())
+
+        self.assertEqual([row['trains_in_service'] for row in self.rollup_rows(s3, 'trains_by_minute')], [3])
+
+    @mock_aws
+    def test_objects_not_written_by_a_failed_run_kept(self):
+        """Test processed objects the manifest does not know about, and objects of a run that may still be in
+            progress, are not deleted."""
+        s3 = boto3.client('s3', region_name='us-east-2')
+        s3.create_bucket(Bucket='test-bucket', CreateBucketConfiguration={'LocationConstraint': 'us-east-2'})
+        self.put_raw_object(s3, 'object-1', ['d#Red#1#1'], hour=10)
+        earlier_object_key = f'{self.processed_prefix}train_line=Red/hour=09/earlier.parquet'
+        in_progress_object_key = f'{self.processed_prefix}train_line=Red/hour=09/{"a" * 32}-part.parquet'
+        for key in (earlier_object_key, in_progress_object_key):
+            s3.put_object(Bucket='test-bucket', Key=key, Body=b'')
+
+        lambda_handler(self.mock_event, MockLambdaContext())
+        manifest_key = f'processed/_manifest/load_date={self.prev_day.isoformat()}.json'
+        manifest = json.loads(s3.get_object(Bucket='test-bucket', Key=manifest_key)['Body'].read())
+        manifest['pending_runs']['a' * 32] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        s3.put_object(Bucket='test-bucket', Key=manifest_key, Body=json.dumps(manifest).encode('utf-8'))
+        self.put_raw_object(s3, 'object-2', ['d#Red#2#1'], hour=11)
+        lambda_handler(self.mock_event, MockLambdaContext())
+
+        response = s3.list_objects_v2(Bucket='test-bucket', Prefix=self.processed_prefix)
+        keys = {obj['Key'] for obj in response['Contents']}
+        self.assertIn(earlier_object_key, keys)
+        self.assertIn(in_progress_object_key, keys)
+
+    @mock_aws
+    def test_rollups_skipped_for_unexpanded_delta_records(self):
+        """Test no rollups are written in delta mode unless delta records are expanded."""
+        s3 = boto3.client('s3', region_name='us-east-2')
+        s3.create_bucket(Bucket='test-bucket', CreateBucketConfiguration={'LocationConstraint': 'us-east-2'})
+        self.put_raw_object(s3, 'object-1', ['d#Red#1#1'], hour=10)
+
+        with patch.dict(os.environ, {'DELTA_MODE': 'true'}):
+            lambda_handler(self.mock_event, MockLambdaContext())
+
+        self.assertEqual(len(self.processed_objects(s3)), 1)
+        response = s3.list_objects_v2(Bucket='test-bucket', Prefix='rollups/')
+        self.assertEqual(response.get('Contents', []), [])
+
+    @mock_aws
+    def test_delta_records_expanded_at_poll_interval(self):
+        """Test delta records are expanded at the configured poll interval."""
+        s3 = boto3.client('s3', region_name='us-east-2')
+        s3.create_bucket(Bucket='test-bucket', CreateBucketConfiguration={'LocationConstraint': 'us-east-2'})
+        keyframe = json.loads(raw_object(['d#Red#1#1'], f'{self.prev_day.isoformat()}T10:15:00-05:00'))
+        records = [
+            {**keyframe, 'record_type': 'keyframe'},
+            {
+                'train_id': 'd#Red#1#1',
+                'current_timestamp': f'{self.prev_day.isoformat()}T10:16:00-05:00',
+                'record_type': 'removed'
+            }
+        ]
+        s3.put_object(
+            Bucket='test-bucket',
+            Key=f'{self.raw_prefix}object-1',
+            Body=''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+        )
+
+        environment = {'DELTA_MODE': 'true', 'EXPAND_DELTA_RECORDS': 'true', 'POLL_INTERVAL_SECONDS': '15'}
+        with patch.dict(os.environ, environment):
+            lambda_handler(self.mock_event, MockLambdaContext())
+
+        self.assertEqual(list(self.processed_objects(s3).values()), [['d#Red#1#1'] * 4])
+        self.assertEqual(self.rollup_rows(s3, 'runs_by_hour')[0]['snapshot_count'], 4)
+
+    @mock_aws
+    def test_delta_records_expanded_across_incremental_runs(self):
+        """Test a train carried over from the previous incremental run keeps being filled until its next record."""
+        s3 = boto3.client('s3', region_name='us-east-2')
+        s3.create_bucket(Bucket='test-bucket', CreateBucketConfiguration={'LocationConstraint': 'us-east-2'})
+        def put_delta_object(name, records):
+            s3.put_object(
+                Bucket='test-bucket',
+                Key=f'{self.raw_prefix}{name}',
+                Body=''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+            )
+        def delta_record(train_id, minute, record_type):
+            timestamp = f'{self.prev_day.isoformat()}T10:{minute:02d}:00-05:00'
+            if record_type == 'removed':
+                return {'train_id': train_id, 'current_timestamp': timestamp, 'record_type': record_type}
+            return {**json.loads(raw_object([train_id], timestamp)), 'record_type': record_type}
+
+        environment = {'COMPACTION_MODE': 'incremental', 'DELTA_MODE': 'true', 'EXPAND_DELTA_RECORDS': 'true'}
+        with patch.dict(os.environ, environment):
+            put_delta_object('object-1', [delta_record('d#Red#1#1', 15, 'keyframe'),
+                                          delta_record('d#Red#2#1', 17, 'keyframe')])
+            lambda_handler(self.mock_event, MockLambdaContext())
+            put_delta_object('object-2', [delta_record('d#Red#1#1', 19, 'removed'),
+                                          delta_record('d#Red#2#1', 20, 'removed')])
+            lambda_handler(self.mock_event, MockLambdaContext())
+
+        self.assertEqual(
+            [(row['train_id'], row['snapshot_count']) for row in self.rollup_rows(s3, 'runs_by_hour')],
+            [('d#Red#1#1', 4), ('d#Red#2#1', 3)]
+        )
+
+    @mock_aws
+    def test_invalid_compaction_mode(self):
+        """Test an unsupported compaction mode raises a ValueError."""
+        with patch.dict(os.environ, {'COMPACTION_MODE': 'weekly'}):
+            with self.assertRaises(ValueError):
+                lambda_handler(self.mock_event, MockLambdaContext())
@@ -81,7 +81,8 @@ class TestGetTrainStatus(unittest.TestCase):
             response,
             {
                 'statusCode': 200,
-                'body': 'Execution successful'
+                'body': 'Execution successful',
+                'batchItemFailures': []
             }
         )
 
@@ -0,0 +1,100 @@
+"""Module for component testing of the trip events analysis over the processed dataset."""
+import unittest
+from unittest.mock import patch
+import datetime
+import io
+import json
+import sys
+import zoneinfo
+
+import boto3
+import pyarrow as pa
+import pyarrow.parquet as pq
+from moto import mock_aws
+
+from analytics.trip_events import main
+from lambdas.bucket_raw_data.bucket_raw_data import PROCESSED_SCHEMA
+
+TIMEZONE = zoneinfo.ZoneInfo('America/Chicago')
+
+
+def processed_object(train_id, stations):
+    """Returns the Parquet body of a processed object with one snapshot per minute heading to each station."""
+    rows = [
+        {
+            'train_id': train_id,
+            'current_timestamp': datetime.datetime(2025, 6, 20, 10, minute, tzinfo=TIMEZONE),
+            'next_station': station,
+            'is_approaching_station': False,
+            'is_train_delayed': False
+        }
+        for minute, station in enumerate(stations)
+    ]
+    sink = io.BytesIO()
+    pq.write_table(pa.Table.from_pylist(rows, schema=PROCESSED_SCHEMA), sink)
+    return sink.getvalue()
+
+
+class TestTripEvents(unittest.TestCase):
+    """Class for testing the trip events command."""
+
+    @mock_aws
+    def test_main(self):
+        """Test the events of every partition in the manifest of a load date are written to the trip_events table."""
+        s3 = boto3.client('s3', region_name='us-east-2')
+        s3.create_bucket(Bucket='test-bucket', CreateBucketConfiguration={'LocationConstraint': 'us-east-2'})
+        prefix = 'processed/load_date=2025-06-20/'
+        s3.put_object(
+            Bucket='test-bucket',
+            Key=f'{prefix}train_line=Red/hour=10/part-1.parquet',
+            Body=processed_object('d#Red#801#1', ['Howard', 'Jarvis', 'Morse'])
+        )
+        s3.put_object(
+            Bucket='test-bucket',
+            Key=f'{prefix}train_line=Blue/hour=10/part-1.parquet',
+            Body=processed_object('d#Blue#101#1', ['Clark/Lake', 'Washington'])
+        )
+        # An object left by a failed compaction run is not in the manifest and is not read
+        s3.put_object(Bucket='test-bucket', Key=f'{prefix}train_line=Red/hour=10/part-2.parquet', Body=b'')
+        s3.put_object(Bucket='test-bucket', Key='processed/load_date=2025-06-21/x.parquet', Body=b'')
+        s3.put_object(
+            Bucket='test-bucket',
+            Key='processed/_manifest/load_date=2025-06-20.json',
+            Body=json.dumps(
+                {
+                    'objects': {},
+                    'parts': [f'{prefix}train_line=Red/hour=10/part-1.parquet',
+                              f'{prefix}train_line=Blue/hour=10/part-1.parquet']
+                }
+            ).encode('utf-8')
+        )
+
+        argv = ['trip_events', '--bucket', 'test-bucket', '--load-date', '2025-06-20']
+        with patch.object(sys, 'argv', argv), patch.dict('os.environ', {'AWS_DEFAULT_REGION': 'us-east-2'}):
+            main()
+
+        events = pq.read_table(
+            io.BytesIO(
+                s3.get_object(
+                    Bucket='test-bucket',
+                    Key='analytics/trip_events/load_date=2025-06-20/trip_events.parquet'
+                )['Body'].read()
+            )
+        )
+        self.assertEqual(
+            list(zip(events['train_id'].to_pylist(), events['station'].to_pylist())),
+            [('d#Blue#101#1', 'Clark/Lake'), ('d#Red#801#1', 'Howard'), ('d#Red#801#1', 'Jarvis')]
+        )
+
+    @mock_aws
+    def test_main_expired_load_date(self):
+        """Test a load date without a manifest raises an error rather than writing an empty table."""
+        s3 = boto3.client('s3', region_name='us-east-2')
+        s3.create_bucket(Bucket='test-bucket', CreateBucketConfiguration={'LocationConstraint': 'us-east-2'})
+
+        argv = ['trip_events', '--bucket', 'test-bucket', '--load-date', '2025-06-20']
+        with patch.object(sys, 'argv', argv), patch.dict('os.environ', {'AWS_DEFAULT_REGION': 'us-east-2'}):
+            with self.assertRaisesRegex(ValueError, 'expire after 3 days'):
+                main()
+
+        self.assertNotIn('Contents', s3.list_objects_v2(Bucket='test-bucket'))
@@ -7,7 +7,7 @@ import boto3
 import botocore
 from moto import mock_aws
 
-from lambdas.write_train_lines.write_train_lines import lambda_handler
+from lambdas.write_train_lines.write_train_lines import lambda_handler, get_sqs_client, get_cached_sqs_queue_url
 
 
 class MockLambdaContext:
@@ -36,6 +36,9 @@ class TestWriteTrainLines(unittest.TestCase):
             }
         )
         self.env_patcher.start()
+        # The client and queue URLs are cached across warm invocations, so each test starts from a cold container
+        get_sqs_client.cache_clear()
+        get_cached_sqs_queue_url.cache_clear()
 
     def tearDown(self):
         """Stop all patches after each test."""
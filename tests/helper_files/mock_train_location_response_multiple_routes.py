@@ -0,0 +1,57 @@
+MOCK_TRAIN_LOCATION_MULTIPLE_ROUTES_RESPONSE = {
+  "ctatt": {
+    "tmst": "2025-06-20T12:43:12",
+    "errCd": "0",
+    "errNm": "null",
+    "route": [
+      {
+        "@name": "red",
+        "train": [
+          {
+            "rn": "801",
+            "destSt": "30173",
+            "destNm": "Howard",
+            "trDr": "1",
+            "nextStaId": "41420",
+            "nextStpId": "30277",
+            "nextStaNm": "Addison",
+            "prdt": "2025-06-20T12:42:40",
+            "arrT": "2025-06-20T12:44:40",
+            "isApp": "0",
+            "isDly": "0",
+            "flags": "null",
+            "lat": "41.93999",
+            "lon": "-87.65329",
+            "heading": "358"
+          }
+        ]
+      },
+      {
+        "@name": "p",
+        "train": [
+          {
+            "rn": "110",
+            "destSt": "30077",
+            "destNm": "Forest Park",
+            "trDr": "5",
+            "nextStaId": "40060",
+            "nextStpId": "30013",
+            "nextStaNm": "Belmont",
+            "prdt": "2025-06-20T12:42:56",
+            "arrT": "2025-06-20T12:43:56",
+            "isApp": "1",
+            "isDly": "0",
+            "flags": "null",
+            "lat": "41.94644",
+            "lon": "-87.71833",
+            "heading": "142"
+          }
+        ]
+      },
+      {
+        "@name": "pink",
+        "train": []
+      }
+    ]
+  }
+}
\ No newline at end of file
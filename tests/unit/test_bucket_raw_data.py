@@ -0,0 +1,900 @@
+"""Module for unit testing of the bucket_raw_data lambda handler function."""
+import unittest
+from unittest.mock import patch, MagicMock
+import collections
+import datetime
+import gzip
+import io
+import json
+import random
+import threading
+import time
+
+import botocore.response
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from lambdas.bucket_raw_data.bucket_raw_data import iter_decompressed_chunks, read_s3_object, expand_delta_records, \
+    iter_ndjson_lines, iter_s3_object_records, read_s3_objects_concurrently, create_s3_client, iter_record_batches, \
+    write_parquet_batches, convert_to_processed_schema, RAW_SCHEMA, PROCESSED_SCHEMA, read_s3_object_table, \
+    rebatch_record_batches, read_raw_record_batches, S3MultipartUploadStream, write_partition_to_s3, \
+    write_partitioned_parquet_to_s3, compute_partition_rollups, merge_rollups, get_lines_by_hour, ROLLUP_SCHEMAS, \
+    get_trains_by_minute, read_s3_object_records_table
+
+
+def ndjson(records):
+    """Returns the records as newline-delimited JSON bytes."""
+    return ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+
+
+def streaming_body(data):
+    """Returns a botocore streaming body for the data, as returned by S3 GetObject."""
+    return botocore.response.StreamingBody(io.BytesIO(data), len(data))
+
+
+class TestIterNdjsonLines(unittest.TestCase):
+    """Class for testing iter_ndjson_lines method."""
+
+    def test_lines_split_across_chunks(self):
+        """Tests lines split across chunk boundaries are reassembled."""
+        chunks = [b'{"a": 1}\n{"a"', b': 2}\n\n{"a": 3}', b'\n{"a": 4}']
+
+        result = list(iter_ndjson_lines(chunks))
+
+        self.assertEqual(result, [b'{"a": 1}', b'{"a": 2}', b'{"a": 3}', b'{"a": 4}'])
+
+    def test_no_lines(self):
+        """Tests no lines are yielded for empty data."""
+        self.assertEqual(list(iter_ndjson_lines([b'', b'\n'])), [])
+
+
+class TestIterDecompressedChunks(unittest.TestCase):
+    """Class for testing iter_decompressed_chunks method."""
+
+    def test_uncompressed_data(self):
+        """Tests uncompressed NDJSON is passed through unchanged."""
+        data = ndjson([{'foo': 'bar'}, {'foo': 'baz'}])
+
+        result = b''.join(iter_decompressed_chunks([data]))
+
+        self.assertEqual(result, data)
+
+    def test_mixed_compressed_and_uncompressed_data(self):
+        """Tests gzip members concatenated with uncompressed records are decompressed in place."""
+        first = ndjson([{'index': 0}])
+        second = ndjson([{'index': 1}, {'index': 2}])
+        third = ndjson([{'index': 3}])
+        fourth = ndjson([{'index': 4}])
+        data = first + gzip.compress(second) + gzip.compress(third) + fourth
+
+        result = b''.join(iter_decompressed_chunks([data]))
+
+        self.assertEqual(result, first + second + third + fourth)
+
+    def test_small_chunks(self):
+        """Tests gzip members and magic bytes split across chunk boundaries are decompressed correctly."""
+        plain = ndjson([{'index': 0}])
+        compressed = ndjson([{'index': i} for i in range(1, 50)])
+        data = plain + gzip.compress(compressed) + plain
+        for chunk_size in (1, 2, 3, 7, 64):
+            chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+            result = b''.join(iter_decompressed_chunks(chunks))
+
+            self.assertEqual(result, plain + compressed + plain)
+
+    def test_truncated_gzip_member(self):
+        """Tests a ValueError is raised for a truncated gzip member."""
+        data = gzip.compress(ndjson([{'index': i} for i in range(50)]))
+
+        with self.assertRaises(ValueError):
+            b''.join(iter_decompressed_chunks([data[:-10]]))
+
+
+class TestReadS3Object(unittest.TestCase):
+    """Class for testing read_s3_object method."""
+
+    def test_read_aggregated_compressed_object(self):
+        """Tests an object containing aggregated gzip-compressed records is de-aggregated into rows."""
+        rows = [{'train_id': str(i)} for i in range(10)]
+        data = ndjson(rows[:3]) + gzip.compress(ndjson(rows[3:8])) + ndjson(rows[8:])
+        mock_s3 = MagicMock()
+        mock_s3.get_object.return_value = {'Body': streaming_body(data)}
+
+        result = read_s3_object(s3_client=mock_s3, bucket_name='test-bucket', key='raw/2025/06/20/file')
+
+        self.assertEqual(result, rows)
+        mock_s3.get_object.assert_called_once_with(Bucket='test-bucket', Key='raw/2025/06/20/file')
+
+
+class TestIterS3ObjectRecords(unittest.TestCase):
+    """Class for testing iter_s3_object_records method."""
+
+    def test_streams_records(self):
+        """Tests records are yielded one at a time while the body is read in chunks."""
+        rows = [{'train_id': str(i)} for i in range(100)]
+        body = streaming_body(ndjson(rows))
+        body.iter_chunks = MagicMock(wraps=body.iter_chunks)
+        mock_s3 = MagicMock()
+        mock_s3.get_object.return_value = {'Body': body}
+
+        records = iter_s3_object_records(
+            s3_client=mock_s3, bucket_name='test-bucket', key='raw/2025/06/20/file', chunk_size=16
+        )
+
+        self.assertEqual(next(records), rows[0])
+        self.assertEqual(list(records), rows[1:])
+        body.iter_chunks.assert_called_once_with(chunk_size=16)
+
+
+class TestReadS3ObjectsConcurrently(unittest.TestCase):
+    """Class for testing read_s3_objects_concurrently method."""
+
+    def setUp(self):
+        """Set up a mock object reader that tracks how many reads are in flight."""
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.read_patcher = patch(
+            'lambdas.bucket_raw_data.bucket_raw_data.read_s3_object',
+            side_effect=self.mock_read_s3_object
+        )
+        self.mock_read_s3_object = self.read_patcher.start()
+
+    def tearDown(self):
+        """Stop all patches after each test."""
+        self.read_patcher.stop()
+
+    def mock_read_s3_object(self, s3_client, bucket_name, key):
+        """Returns a single record for the key after a random delay."""
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(random.uniform(0, 0.02))
+        with self.lock:
+            self.in_flight -= 1
+        return [{'key': key}]
+
+    def test_results_in_key_order(self):
+        """Tests results are yielded in the order of the keys regardless of completion order."""
+        keys = [f'raw/2025/06/20/{i:02d}' for i in range(20)]
+
+        result = list(read_s3_objects_concurrently(s3_client=MagicMock(), bucket_name='test-bucket', keys=keys,
+                                                   concurrency=4))
+
+        self.assertEqual([key for key, _ in result], keys)
+        self.assertEqual([records for _, records in result], [[{'key': key}] for key in keys])
+
+    def test_concurrency_bounded(self):
+        """Tests no more than the configured number of objects are read at once."""
+        keys = [f'raw/2025/06/20/{i:02d}' for i in range(20)]
+
+        list(read_s3_objects_concurrently(s3_client=MagicMock(), bucket_name='test-bucket', keys=keys,
+                                          concurrency=3))
+
+        self.assertLessEqual(self.max_in_flight, 3)
+        self.assertGreater(self.max_in_flight, 1)
+        self.assertEqual(self.mock_read_s3_object.call_count, 20)
+
+    def test_no_keys(self):
+        """Tests nothing is yielded when there are no objects."""
+        self.assertEqual(list(read_s3_objects_concurrently(s3_client=MagicMock(), bucket_name='test-bucket',
+                                                           keys=[])), [])
+
+    def test_create_s3_client_pool_size(self):
+        """Tests the S3 client connection pool matches the read concurrency."""
+        s3 = create_s3_client(max_pool_connections=16)
+
+        self.assertEqual(s3.meta.config.max_pool_connections, 16)
+
+
+def delta_record(train_id, minute, record_type, next_station='Belmont'):
+    """Returns a record as written by get_train_status in delta mode."""
+    timestamp = datetime.datetime(2025, 6, 20, 12, minute, tzinfo=datetime.timezone(datetime.timedelta(hours=-5)))
+    record = {'train_id': train_id, 'current_timestamp': timestamp.isoformat(), 'record_type': record_type}
+    if record_type != 'removed':
+        record['next_station'] = next_station
+    return record
+
+
+class TestExpandDeltaRecords(unittest.TestCase):
+    """Class for testing expand_delta_records method."""
+
+    def test_records_without_record_type_unchanged(self):
+        """Tests records written without delta mode are returned unchanged."""
+        records = [{'train_id': 'a', 'current_timestamp': '2025-06-20T12:43:00-05:00'}]
+
+        self.assertIs(expand_delta_records(records=records), records)
+
+    def test_expand_until_next_record(self):
+        """Tests rows are repeated every poll interval until the next row for the same train."""
+        records = [
+            delta_record('a', 0, 'keyframe'),
+            delta_record('a', 3, 'delta', next_station='Addison'),
+            delta_record('a', 5, 'removed'),
+            delta_record('b', 0, 'keyframe'),
+            delta_record('b', 5, 'keyframe')
+        ]
+
+        result = expand_delta_records(records=records)
+
+        train_a = [(record['current_timestamp'][14:16], record['next_station'], record['record_type'])
+                   for record in result if record['train_id'] == 'a']
+        self.assertEqual(
+            train_a,
+            [
+                ('00', 'Belmont', 'keyframe'),
+                ('01', 'Belmont', 'filled'),
+                ('02', 'Belmont', 'filled'),
+                ('03', 'Addison', 'delta'),
+                ('04', 'Addison', 'filled')
+            ]
+        )
+        self.assertEqual(len([record for record in result if record['train_id'] == 'b']), 6)
+
+    def test_expand_bounded_by_max_fill(self):
+        """Tests rows are not repeated beyond the maximum fill window."""
+        records = [
+            delta_record('a', 0, 'keyframe'),
+            delta_record('b', 0, 'keyframe'),
+            delta_record('b', 30, 'keyframe')
+        ]
+
+        result = expand_delta_records(records=records, max_fill_seconds=300)
+
+        self.assertEqual(len([record for record in result if record['train_id'] == 'a']), 5)
+        self.assertEqual(len([record for record in result if record['train_id'] == 'b']), 6)
+
+    def test_expand_across_runs(self):
+        """Tests expanding the records of two runs, carrying the trains over in the delta state, gives the same rows
+            as expanding all the records in a single run."""
+        first_run_records = [
+            delta_record('a', 0, 'keyframe'),
+            delta_record('b', 0, 'keyframe'),
+            delta_record('c', 1, 'keyframe'),
+            delta_record('a', 2, 'delta', next_station='Addison')
+        ]
+        second_run_records = [delta_record('b', 4, 'removed'), delta_record('c', 5, 'delta', next_station='Addison')]
+        delta_state = {}
+
+        result = expand_delta_records(records=first_run_records, delta_state=delta_state)
+        result += expand_delta_records(records=second_run_records, delta_state=delta_state)
+
+        self.assertEqual(result, expand_delta_records(records=first_run_records + second_run_records))
+        self.assertEqual(
+            {train_id: state['filled_until'][11:16] for train_id, state in delta_state.items()},
+            {'a': '12:06', 'c': '12:06'}
+        )
+
+
+class TestIterRecordBatches(unittest.TestCase):
+    """Class for testing iter_record_batches method."""
+
+    def test_batches_are_built_lazily(self):
+        """Tests only one batch of records is pulled from the source before a batch is yielded."""
+        pulled = []
+        def records():
+            for i in range(25):
+                pulled.append(i)
+                yield {'train_id': str(i)}
+
+        batches = iter_record_batches(records=records(), batch_size=10)
+        first_batch = next(batches)
+
+        self.assertEqual(first_batch.num_rows, 10)
+        self.assertEqual(len(pulled), 10)
+        self.assertEqual([batch.num_rows for batch in batches], [10, 5])
+
+    def test_schema_from_first_batch(self):
+        """Tests later batches use the schema inferred from the first batch."""
+        records = [{'train_id': 'a', 'next_station': 'Belmont'}, {'train_id': 'b'}, {'train_id': 'c', 'extra': 1}]
+
+        batches = list(iter_record_batches(records=records, batch_size=1))
+
+        self.assertTrue(all(batch.schema == batches[0].schema for batch in batches))
+        self.assertIsNone(batches[1].column('next_station')[0].as_py())
+
+    def test_no_records(self):
+        """Tests no batches are yielded for no records."""
+        self.assertEqual(list(iter_record_batches(records=[])), [])
+
+
+class TestWriteParquetBatches(unittest.TestCase):
+    """Class for testing write_parquet_batches method."""
+
+    def test_one_row_group_per_batch(self):
+        """Tests each record batch is written as its own row group."""
+        records = [{'train_id': str(i)} for i in range(25)]
+        sink = pa.BufferOutputStream()
+
+        rows_written = write_parquet_batches(record_batches=iter_record_batches(records, batch_size=10), where=sink)
+
+        parquet_file = pq.ParquetFile(pa.BufferReader(sink.getvalue()))
+        self.assertEqual(rows_written, 25)
+        self.assertEqual(parquet_file.metadata.num_row_groups, 3)
+        self.assertEqual(parquet_file.read().to_pylist(), records)
+
+    def test_no_batches(self):
+        """Tests nothing is written when there are no batches."""
+        sink = pa.BufferOutputStream()
+
+        rows_written = write_parquet_batches(record_batches=[], where=sink)
+
+        self.assertEqual(rows_written, 0)
+        self.assertEqual(sink.getvalue().size, 0)
+
+
+def raw_row(**overrides):
+    """Returns a raw row as written by get_train_status."""
+    row = {
+        'train_id': '2025-06-20#Purple#110#5',
+        'current_timestamp': '2025-06-20T12:43:12.000045-05:00',
+        'prediction_generated_timestamp': '2025-06-20T12:42:56',
+        'destination_station': 'Forest Park',
+        'next_station': 'Belmont',
+        'next_station_arrival_time': '2025-06-20T12:43:56',
+        'is_approaching_station': '1',
+        'is_train_delayed': '0',
+        'next_station_id': '40060',
+        'destination_station_id': '30077',
+        'latitude': '41.94644',
+        'longitude': '-87.71833',
+        'heading': '142'
+    }
+    row.update(overrides)
+    return row
+
+
+class TestConvertToProcessedSchema(unittest.TestCase):
+    """Class for testing convert_to_processed_schema method."""
+
+    def test_convert_types(self):
+        """Tests raw string columns are converted to typed columns."""
+        raw_batch = pa.RecordBatch.from_pylist([raw_row(), raw_row(is_approaching_station='0')], schema=RAW_SCHEMA)
+
+        result = convert_to_processed_schema(raw_batch)
+
+        self.assertEqual(result.schema, PROCESSED_SCHEMA)
+        row = result.to_pylist()[0]
+        chicago = datetime.timezone(datetime.timedelta(hours=-5))
+        self.assertEqual(row['current_timestamp'], datetime.datetime(2025, 6, 20, 12, 43, 12, 45, tzinfo=chicago))
+        self.assertEqual(
+            row['prediction_generated_timestamp'],
+            datetime.datetime(2025, 6, 20, 12, 42, 56, tzinfo=chicago)
+        )
+        self.assertEqual(row['next_station_arrival_time'], datetime.datetime(2025, 6, 20, 12, 43, 56, tzinfo=chicago))
+        self.assertIs(row['is_approaching_station'], True)
+        self.assertIs(row['is_train_delayed'], False)
+        self.assertEqual(row['next_station'], 'Belmont')
+        self.assertIsNone(row['record_type'])
+        self.assertEqual(result.column('is_approaching_station').to_pylist(), [True, False])
+        self.assertEqual(
+            (row['next_station_id'], row['destination_station_id'], row['latitude'], row['longitude'], row['heading']),
+            ('40060', '30077', 41.94644, -87.71833, 142)
+        )
+
+    def test_blank_position_is_null(self):
+        """Tests blank coordinates and headings are converted to nulls."""
+        raw_batch = pa.RecordBatch.from_pylist([raw_row(latitude='', longitude='', heading='')], schema=RAW_SCHEMA)
+
+        row = convert_to_processed_schema(raw_batch).to_pylist()[0]
+
+        self.assertEqual([row['latitude'], row['longitude'], row['heading']], [None, None, None])
+
+    def test_missing_values_are_null(self):
+        """Tests missing values, such as the fields of removed delta rows, are converted to nulls."""
+        raw_batch = pa.RecordBatch.from_pylist(
+            [{'train_id': 'a', 'current_timestamp': '2025-06-20T12:43:12-05:00', 'record_type': 'removed'}],
+            schema=RAW_SCHEMA
+        )
+
+        row = convert_to_processed_schema(raw_batch).to_pylist()[0]
+
+        self.assertEqual(row['record_type'], 'removed')
+        self.assertIsNone(row['next_station_arrival_time'])
+        self.assertIsNone(row['is_train_delayed'])
+
+    def test_invalid_timestamp(self):
+        """Tests a ValueError naming the column is raised for an invalid timestamp."""
+        raw_batch = pa.RecordBatch.from_pylist(
+            [raw_row(), raw_row(next_station_arrival_time='soon')],
+            schema=RAW_SCHEMA
+        )
+
+        with self.assertRaisesRegex(ValueError, 'next_station_arrival_time'):
+            convert_to_processed_schema(raw_batch)
+
+    def test_invalid_flag(self):
+        """Tests a ValueError naming the column is raised for an invalid flag."""
+        raw_batch = pa.RecordBatch.from_pylist([raw_row(is_train_delayed='maybe')], schema=RAW_SCHEMA)
+
+        with self.assertRaisesRegex(ValueError, 'is_train_delayed'):
+            convert_to_processed_schema(raw_batch)
+
+
+class TestReadS3ObjectTable(unittest.TestCase):
+    """Class for testing read_s3_object_table method."""
+
+    def test_read_table(self):
+        """Tests an NDJSON object is read into a table with the raw schema, ignoring unexpected fields."""
+        rows = [raw_row(), raw_row(next_station='Addison')]
+        data = ndjson(rows[:1]) + gzip.compress(ndjson([{**rows[1], 'unexpected': 'value'}]))
+        mock_s3 = MagicMock()
+        mock_s3.get_object.return_value = {'Body': streaming_body(data)}
+
+        table = read_s3_object_table(s3_client=mock_s3, bucket_name='test-bucket', key='raw/2025/06/20/file')
+
+        self.assertEqual(table.schema, RAW_SCHEMA)
+        self.assertEqual(table.to_pylist(), [{**row, 'record_type': None} for row in rows])
+
+    def test_read_empty_object(self):
+        """Tests an empty object is read into an empty table."""
+        mock_s3 = MagicMock()
+        mock_s3.get_object.return_value = {'Body': streaming_body(b'')}
+
+        table = read_s3_object_table(s3_client=mock_s3, bucket_name='test-bucket', key='raw/2025/06/20/file')
+
+        self.assertEqual(table.num_rows, 0)
+        self.assertEqual(table.schema, RAW_SCHEMA)
+
+
+class TestReadS3ObjectRecordsTable(unittest.TestCase):
+    """Class for testing read_s3_object_records_table method."""
+
+    def test_read_records_table(self):
+        """Tests an NDJSON object is parsed with json.loads into a table with the raw schema in batches."""
+        rows = [raw_row(next_station=str(i)) for i in range(5)]
+        mock_s3 = MagicMock()
+        mock_s3.get_object.return_value = {'Body': streaming_body(ndjson(rows[:2]) + gzip.compress(ndjson(rows[2:])))}
+
+        table = read_s3_object_records_table(
+            s3_client=mock_s3,
+            bucket_name='test-bucket',
+            key='raw/2025/06/20/file',
+            batch_size=2
+        )
+
+        self.assertEqual(table.schema, RAW_SCHEMA)
+        self.assertEqual([batch.num_rows for batch in table.to_batches()], [2, 2, 1])
+        self.assertEqual(table.to_pylist(), [{**row, 'record_type': None} for row in rows])
+
+
+class TestRebatchRecordBatches(unittest.TestCase):
+    """Class for testing rebatch_record_batches method."""
+
+    def test_rebatch(self):
+        """Tests batches of arbitrary sizes are regrouped into batches of the requested size."""
+        batches = [
+            pa.RecordBatch.from_pylist([{'value': i} for i in range(start, start + size)])
+            for start, size in ((0, 3), (3, 9), (12, 1), (13, 4))
+        ]
+
+        result = list(rebatch_record_batches(record_batches=batches, batch_size=5))
+
+        self.assertEqual([batch.num_rows for batch in result], [5, 5, 5, 2])
+        self.assertEqual([row['value'] for batch in result for row in batch.to_pylist()], list(range(17)))
+
+
+class TestReadRawRecordBatches(unittest.TestCase):
+    """Class for testing read_raw_record_batches method."""
+
+    def setUp(self):
+        """Set up a mock S3 client serving two raw objects."""
+        self.rows = [raw_row(next_station=str(i)) for i in range(7)]
+        objects = {
+            'raw/2025/06/20/a': ndjson(self.rows[:4]),
+            'raw/2025/06/20/b': gzip.compress(ndjson(self.rows[4:]))
+        }
+        self.mock_s3 = MagicMock()
+        self.mock_s3.get_object.side_effect = lambda Bucket, Key: {'Body': streaming_body(objects[Key])}
+        self.keys = sorted(objects)
+
+    def test_backends_produce_same_batches(self):
+        """Tests the python and arrow backends produce identical raw record batches."""
+        results = {}
+        for backend in ('python', 'arrow'):
+            batches = list(read_raw_record_batches(
+                s3_client=self.mock_s3, bucket_name='test-bucket', keys=self.keys, concurrency=2, backend=backend,
+                batch_size=3
+            ))
+            self.assertEqual([batch.num_rows for batch in batches], [3, 3, 1])
+            results[backend] = pa.Table.from_batches(batches)
+
+        self.assertTrue(results['python'].equals(results['arrow']))
+        self.assertEqual(results['arrow'].to_pylist(), [{**row, 'record_type': None} for row in self.rows])
+
+    def test_expand_delta_at_poll_interval(self):
+        """Tests delta records are expanded at the given poll interval."""
+        records = [delta_record('d#Red#1#1', 0, 'keyframe'), delta_record('d#Red#1#1', 1, 'removed')]
+        objects = {'raw/2025/06/20/a': ndjson(records)}
+        self.mock_s3.get_object.side_effect = lambda Bucket, Key: {'Body': streaming_body(objects[Key])}
+
+        batches = list(read_raw_record_batches(
+            s3_client=self.mock_s3, bucket_name='test-bucket', keys=list(objects), concurrency=2, expand_delta=True,
+            interval_seconds=15
+        ))
+
+        self.assertEqual(
+            [record['current_timestamp'][14:19] for record in pa.Table.from_batches(batches).to_pylist()],
+            ['00:00', '00:15', '00:30', '00:45']
+        )
+
+    def test_invalid_backend(self):
+        """Tests a ValueError is raised for an unsupported backend."""
+        with self.assertRaises(ValueError):
+            list(read_raw_record_batches(
+                s3_client=self.mock_s3, bucket_name='test-bucket', keys=self.keys, concurrency=2, backend='simdjson'
+            ))
+
+
+class TestS3MultipartUploadStream(unittest.TestCase):
+    """Class for testing S3MultipartUploadStream class."""
+
+    def setUp(self):
+        """Creates a mock S3 client for each test."""
+        self.s3_client = MagicMock()
+        self.s3_client.create_multipart_upload.return_value = {'UploadId': 'test-upload-id'}
+        self.s3_client.upload_part.side_effect = lambda **kwargs: {'ETag': f'etag-{kwargs["PartNumber"]}'}
+
+    def test_small_output_uses_put_object(self):
+        """Tests output smaller than one part is uploaded with a single PutObject."""
+        with S3MultipartUploadStream(self.s3_client, 'test-bucket', 'test-key', part_size=10) as stream:
+            stream.write(b'12345')
+
+        self.s3_client.put_object.assert_called_once_with(Bucket='test-bucket', Key='test-key', Body=b'12345')
+        self.s3_client.create_multipart_upload.assert_not_called()
+
+    def test_no_output_uploads_nothing(self):
+        """Tests nothing is uploaded if nothing was written."""
+        with S3MultipartUploadStream(self.s3_client, 'test-bucket', 'test-key', part_size=10):
+            pass
+
+        self.s3_client.put_object.assert_not_called()
+        self.s3_client.create_multipart_upload.assert_not_called()
+
+    def test_large_output_uses_multipart_upload(self):
+        """Tests full parts are uploaded as they are written and the remainder is uploaded on close."""
+        with S3MultipartUploadStream(self.s3_client, 'test-bucket', 'test-key', part_size=10) as stream:
+            stream.write(b'0123456789abc')
+            self.assertEqual(self.s3_client.upload_part.call_count, 1)
+            stream.write(b'defghijk')
+            self.assertEqual(stream.tell(), 21)
+
+        bodies = [call.kwargs['Body'] for call in self.s3_client.upload_part.call_args_list]
+        self.assertEqual(bodies, [b'0123456789', b'abcdefghij', b'k'])
+        self.s3_client.complete_multipart_upload.assert_called_once_with(
+            Bucket='test-bucket',
+            Key='test-key',
+            UploadId='test-upload-id',
+            MultipartUpload={
+                'Parts': [
+                    {'ETag': 'etag-1', 'PartNumber': 1},
+                    {'ETag': 'etag-2', 'PartNumber': 2},
+                    {'ETag': 'etag-3', 'PartNumber': 3}
+                ]
+            }
+        )
+        self.s3_client.put_object.assert_not_called()
+
+    def test_exception_aborts_upload(self):
+        """Tests the multipart upload is aborted if an exception is raised while writing."""
+        with self.assertRaises(RuntimeError):
+            with S3MultipartUploadStream(self.s3_client, 'test-bucket', 'test-key', part_size=10) as stream:
+                stream.write(b'0123456789abc')
+                raise RuntimeError('test error')
+
+        self.s3_client.abort_multipart_upload.assert_called_once_with(
+            Bucket='test-bucket',
+            Key='test-key',
+            UploadId='test-upload-id'
+        )
+        self.s3_client.complete_multipart_upload.assert_not_called()
+
+
+def mock_upload_s3_client():
+    """Returns a mock S3 client and the dictionary that objects uploaded through it are stored in."""
+    uploaded = {}
+    parts = collections.defaultdict(dict)
+    s3_client = MagicMock()
+    s3_client.create_multipart_upload.side_effect = lambda **kwargs: {'UploadId': kwargs['Key']}
+    s3_client.upload_part.side_effect = lambda **kwargs: parts[kwargs['Key']].update(
+        {kwargs['PartNumber']: kwargs['Body']}
+    ) or {'ETag': str(kwargs['PartNumber'])}
+    s3_client.complete_multipart_upload.side_effect = lambda **kwargs: uploaded.update(
+        {kwargs['Key']: b''.join(parts[kwargs['Key']][part] for part in sorted(parts[kwargs['Key']]))}
+    )
+    s3_client.put_object.side_effect = lambda **kwargs: uploaded.update({kwargs['Key']: kwargs['Body']})
+    return s3_client, uploaded
+
+
+class TestWritePartitionToS3(unittest.TestCase):
+    """Class for testing write_partition_to_s3 method."""
+
+    def test_write_partition_to_s3(self):
+        """Tests the rows are sorted and uploaded as a single Parquet object across several parts."""
+        s3_client, uploaded = mock_upload_s3_client()
+        records = [raw_row(train_id=str(999 - i)) for i in range(1000)]
+        batches = [
+            convert_to_processed_schema(batch)
+            for batch in iter_record_batches(records, batch_size=100, schema=RAW_SCHEMA)
+        ]
+
+        with patch('lambdas.bucket_raw_data.bucket_raw_data.S3_UPLOAD_PART_SIZE', 1024):
+            rows_written = write_partition_to_s3(
+                record_batches=batches,
+                s3_client=s3_client,
+                bucket_name='test-bucket',
+                key='test.parquet',
+                row_group_size=300
+            )
+
+        parquet_file = pq.ParquetFile(pa.BufferReader(uploaded['test.parquet']))
+        self.assertEqual(rows_written, 1000)
+        self.assertEqual(parquet_file.schema_arrow, PROCESSED_SCHEMA)
+        self.assertEqual(parquet_file.metadata.num_row_groups, 4)
+        self.assertEqual(
+            parquet_file.read(columns=['train_id']).column(0).to_pylist(),
+            sorted(str(i) for i in range(1000))
+        )
+
+
+class TestWritePartitionedParquetToS3(unittest.TestCase):
+    """Class for testing write_partitioned_parquet_to_s3 method."""
+
+    @staticmethod
+    def partition_rows(uploaded, key):
+        """Returns the train_id and current_timestamp of the rows of an uploaded object."""
+        table = pq.read_table(pa.BufferReader(uploaded[key]), columns=['train_id', 'current_timestamp'])
+        return [(row['train_id'], row['current_timestamp'].isoformat()) for row in table.to_pylist()]
+
+    def test_partitioned_and_sorted(self):
+        """Tests rows are written to one sorted object per train line and hour."""
+        s3_client, uploaded = mock_upload_s3_client()
+        records = [
+            raw_row(train_id='2025-06-20#Red#2#1', current_timestamp='2025-06-20T10:05:00-05:00'),
+            raw_row(train_id='2025-06-20#Purple#1#5', current_timestamp='2025-06-20T10:30:00-05:00'),
+            raw_row(train_id='2025-06-20#Red#1#1', current_timestamp='2025-06-20T10:10:00-05:00'),
+            raw_row(train_id='2025-06-20#Red#1#1', current_timestamp='2025-06-20T10:00:00-05:00'),
+            raw_row(train_id='2025-06-20#Red#1#1', current_timestamp='2025-06-20T11:00:00-05:00')
+        ]
+
+        keys = write_partitioned_parquet_to_s3(
+            raw_batches=iter_record_batches(records, batch_size=2, schema=RAW_SCHEMA),
+            s3_client=s3_client,
+            bucket_name='test-bucket',
+            prefix='processed/load_date=2025-06-20/'
+        )
+
+        partitions = {key.rsplit('/', 1)[0]: key for key in keys}
+        self.assertEqual(len(keys), 3)
+        self.assertEqual(
+            self.partition_rows(uploaded, partitions['processed/load_date=2025-06-20/train_line=Red/hour=10']),
+            [
+                ('2025-06-20#Red#1#1', '2025-06-20T10:00:00-05:00'),
+                ('2025-06-20#Red#1#1', '2025-06-20T10:10:00-05:00'),
+                ('2025-06-20#Red#2#1', '2025-06-20T10:05:00-05:00')
+            ]
+        )
+        self.assertEqual(
+            self.partition_rows(uploaded, partitions['processed/load_date=2025-06-20/train_line=Purple/hour=10']),
+            [('2025-06-20#Purple#1#5', '2025-06-20T10:30:00-05:00')]
+        )
+        self.assertEqual(
+            self.partition_rows(uploaded, partitions['processed/load_date=2025-06-20/train_line=Red/hour=11']),
+            [('2025-06-20#Red#1#1', '2025-06-20T11:00:00-05:00')]
+        )
+
+    def test_completed_hours_written_before_end(self):
+        """Tests a partition is written once rows past its hour plus the lateness have been seen, and rows arriving
+            later are written as an additional object."""
+        s3_client, uploaded = mock_upload_s3_client()
+        records = [
+            raw_row(train_id='2025-06-20#Red#1#1', current_timestamp='2025-06-20T10:00:00-05:00'),
+            raw_row(train_id='2025-06-20#Red#1#1', current_timestamp='2025-06-20T11:30:00-05:00'),
+            raw_row(train_id='2025-06-20#Red#2#1', current_timestamp='2025-06-20T10:59:00-05:00'),
+            raw_row(train_id='2025-06-20#Red#1#1', current_timestamp='2025-06-20T11:35:00-05:00')
+        ]
+        keys_before_end = []
+
+        def raw_batches():
+            for batch in iter_record_batches(records, batch_size=1, schema=RAW_SCHEMA):
+                yield batch
+            keys_before_end.extend(uploaded)
+
+        keys = write_partitioned_parquet_to_s3(
+            raw_batches=raw_batches(),
+            s3_client=s3_client,
+            bucket_name='test-bucket',
+            prefix='processed/',
+            lateness_seconds=1800
+        )
+
+        self.assertEqual(
+            [key.rsplit('/', 1)[0] for key in keys_before_end],
+            ['processed/train_line=Red/hour=10', 'processed/train_line=Red/hour=10']
+        )
+        self.assertEqual(
+            [key.rsplit('/', 1)[0] for key in keys],
+            ['processed/train_line=Red/hour=10', 'processed/train_line=Red/hour=10', 'processed/train_line=Red/hour=11']
+        )
+        self.assertEqual(
+            self.partition_rows(uploaded, keys[2]),
+            [('2025-06-20#Red#1#1', '2025-06-20T11:30:00-05:00'), ('2025-06-20#Red#1#1', '2025-06-20T11:35:00-05:00')]
+        )
+
+    def test_partition_rollups_collected(self):
+        """Tests the rollups of each partition are added to the given rollups dictionary under the object's key."""
+        s3_client, _ = mock_upload_s3_client()
+        records = [
+            raw_row(train_id='2025-06-20#Red#1#1', current_timestamp='2025-06-20T10:00:00-05:00'),
+            raw_row(train_id='2025-06-20#Red#1#1', current_timestamp='2025-06-20T11:00:00-05:00'),
+            raw_row(train_id='2025-06-20#Blue#1#1', current_timestamp='2025-06-20T10:00:00-05:00')
+        ]
+        rollups = {}
+
+        keys = write_partitioned_parquet_to_s3(
+            raw_batches=iter_record_batches(records, batch_size=2, schema=RAW_SCHEMA),
+            s3_client=s3_client,
+            bucket_name='test-bucket',
+            prefix='processed/',
+            rollups=rollups
+        )
+
+        self.assertEqual(sorted(rollups), sorted(keys))
+        self.assertEqual(len(keys), 3)
+        for part_rollups in rollups.values():
+            self.assertEqual(sorted(part_rollups), ['runs_by_hour', 'train_minutes'])
+        self.assertEqual(sum(part_rollups['train_minutes'].num_rows for part_rollups in rollups.values()), 3)
+
+    def test_no_batches(self):
+        """Tests nothing is written when there are no batches."""
+        s3_client, uploaded = mock_upload_s3_client()
+
+        keys = write_partitioned_parquet_to_s3(
+            raw_batches=[],
+            s3_client=s3_client,
+            bucket_name='test-bucket',
+            prefix='processed/'
+        )
+
+        self.assertEqual(keys, [])
+        self.assertEqual(uploaded, {})
+
+
+def processed_table(rows):
+    """Returns a PROCESSED_SCHEMA table of (train_id, current_timestamp, is_train_delayed) rows."""
+    records = [
+        raw_row(train_id=train_id, current_timestamp=current_timestamp, is_train_delayed=is_train_delayed)
+        for train_id, current_timestamp, is_train_delayed in rows
+    ]
+    return pa.Table.from_batches(
+        [convert_to_processed_schema(batch) for batch in iter_record_batches(records, schema=RAW_SCHEMA)]
+    )
+
+
+class TestRollups(unittest.TestCase):
+    """Class for testing compute_partition_rollups, merge_rollups, get_trains_by_minute and get_lines_by_hour
+        methods."""
+
+    def test_compute_partition_rollups(self):
+        """Tests the distinct trains of each minute and the snapshots of each run each hour are counted."""
+        table = processed_table(
+            [
+                ('2025-06-20#Red#1#1', '2025-06-20T10:00:10-05:00', '1'),
+                ('2025-06-20#Red#1#1', '2025-06-20T10:00:40-05:00', '0'),
+                ('2025-06-20#Red#2#1', '2025-06-20T10:00:20-05:00', '0'),
+                ('2025-06-20#Red#1#1', '2025-06-20T10:01:10-05:00', '1')
+            ]
+        )
+
+        rollups = compute_partition_rollups(table)
+
+        self.assertEqual(
+            [
+                (row['minute'].minute, row['trains_in_service'], row['delayed_trains'])
+                for row in get_trains_by_minute(merge_rollups([rollups['train_minutes']], 'train_minutes')).to_pylist()
+            ],
+            [(0, 2, 1), (1, 1, 1)]
+        )
+        self.assertEqual(
+            [
+                (row['train_id'], row['snapshot_count'], row['delayed_count'], row['first_seen'].isoformat(),
+                 row['last_seen'].isoformat())
+                for row in merge_rollups([rollups['runs_by_hour']], 'runs_by_hour').to_pylist()
+            ],
+            [
+                ('2025-06-20#Red#1#1', 3, 2, '2025-06-20T10:00:10-05:00', '2025-06-20T10:01:10-05:00'),
+                ('2025-06-20#Red#2#1', 1, 0, '2025-06-20T10:00:20-05:00', '2025-06-20T10:00:20-05:00')
+            ]
+        )
+
+    def test_removed_rows_not_counted(self):
+        """Tests rows recording that a train left service are not counted as trains in service or snapshots."""
+        records = [
+            raw_row(train_id='2025-06-20#Red#1#1', current_timestamp='2025-06-20T10:01:00-05:00', record_type='filled'),
+            raw_row(train_id='2025-06-20#Red#2#1', current_timestamp='2025-06-20T10:01:00-05:00', record_type='removed')
+        ]
+        table = pa.Table.from_batches(
+            [convert_to_processed_schema(batch) for batch in iter_record_batches(records, schema=RAW_SCHEMA)]
+        )
+
+        rollups = compute_partition_rollups(table)
+
+        self.assertEqual(rollups['train_minutes'].column('train_id').to_pylist(), ['2025-06-20#Red#1#1'])
+        self.assertEqual(rollups['runs_by_hour'].column('train_id').to_pylist(), ['2025-06-20#Red#1#1'])
+
+    def test_merge_rollups_and_lines_by_hour(self):
+        """Tests partial rollups of the same group are merged and lines_by_hour is derived from runs_by_hour."""
+        first_rollups = compute_partition_rollups(
+            processed_table(
+                [
+                    ('2025-06-20#Red#1#1', '2025-06-20T10:00:00-05:00', '1'),
+                    ('2025-06-20#Red#2#1', '2025-06-20T10:00:00-05:00', '0')
+                ]
+            )
+        )
+        second_rollups = compute_partition_rollups(
+            processed_table(
+                [
+                    ('2025-06-20#Red#1#1', '2025-06-20T10:01:00-05:00', '0'),
+                    ('2025-06-20#Red#2#1', '2025-06-20T10:01:30-05:00', '0')
+                ]
+            )
+        )
+
+        runs_by_hour = merge_rollups(
+            [first_rollups['runs_by_hour'], second_rollups['runs_by_hour']],
+            'runs_by_hour'
+        )
+        trains_by_minute = get_trains_by_minute(
+            merge_rollups([first_rollups['train_minutes'], second_rollups['train_minutes']], 'train_minutes')
+        )
+        lines_by_hour = get_lines_by_hour(runs_by_hour)
+
+        self.assertEqual(runs_by_hour.column('snapshot_count').to_pylist(), [2, 2])
+        self.assertEqual(trains_by_minute.column('trains_in_service').to_pylist(), [2, 2])
+        self.assertEqual(lines_by_hour.schema, ROLLUP_SCHEMAS['lines_by_hour'])
+        self.assertEqual(
+            [
+                (row['train_line'], row['runs_in_service'], row['snapshot_count'], row['delayed_count'],
+                 row['delayed_share'])
+                for row in lines_by_hour.to_pylist()
+            ],
+            [('Red', 2, 4, 1, 0.25)]
+        )
+
+    def test_train_in_two_partial_rollups_counted_once(self):
+        """Tests a train reported in two partial rollups within the same minute is counted once, and as delayed if
+            it was delayed in either."""
+        first_rollups = compute_partition_rollups(
+            processed_table(
+                [
+                    ('2025-06-20#Red#1#1', '2025-06-20T10:00:10-05:00', '0'),
+                    ('2025-06-20#Red#2#1', '2025-06-20T10:00:10-05:00', '0')
+                ]
+            )
+        )
+        second_rollups = compute_partition_rollups(
+            processed_table([('2025-06-20#Red#1#1', '2025-06-20T10:00:40-05:00', '1')])
+        )
+
+        trains_by_minute = get_trains_by_minute(
+            merge_rollups([first_rollups['train_minutes'], second_rollups['train_minutes']], 'train_minutes')
+        )
+
+        self.assertEqual(
+            [(row['trains_in_service'], row['delayed_trains']) for row in trains_by_minute.to_pylist()],
+            [(2, 1)]
+        )
+
+    def test_merge_no_rollups(self):
+        """Tests merging no partial rollups gives an empty table."""
+        self.assertEqual(merge_rollups([], 'runs_by_hour'), ROLLUP_SCHEMAS['runs_by_hour'].empty_table())
+        self.assertEqual(
+            get_lines_by_hour(ROLLUP_SCHEMAS['runs_by_hour'].empty_table()),
+            ROLLUP_SCHEMAS['lines_by_hour'].empty_table()
+        )
+        self.assertEqual(
+            get_trains_by_minute(ROLLUP_SCHEMAS['train_minutes'].empty_table()),
+            ROLLUP_SCHEMAS['trains_by_minute'].empty_table()
+        )
@@ -3,7 +3,13 @@ import unittest
 from unittest.mock import patch, MagicMock
 import os
 import json
+import collections
 import datetime
+import gzip
+import io
+import tempfile
+import threading
+import time
 import zoneinfo
 
 import botocore
@@ -11,10 +17,19 @@ import botocore.exceptions
 import requests
 
 from lambdas.get_train_status.get_train_status import get_train_locations, dictionary_to_firehose_record, \
-    write_train_location_data, lambda_handler
+    write_train_location_data, lambda_handler, get_train_lines_from_message, split_locations_by_line, \
+    parse_train_location_data, create_http_session, get_request_timeout, get_http_session_stats, \
+    group_train_lines, fetch_train_locations_concurrently, get_firehose_client, chunk_firehose_records, \
+    write_firehose_chunk, aggregate_firehose_records, FIREHOSE_MAX_RECORD_BYTES, InMemoryStateStore, \
+    S3StateStore, get_delta_state_store, apply_delta_encoding, get_poll_ticks, update_line_activity, \
+    record_line_activity, TokenBucketRateLimiter, RateLimitExceeded, FileStateStore, get_rate_limiter, \
+    CircuitBreaker, CircuitOpenError, is_circuit_breaker_failure, get_circuit_breaker, get_hedge_delay_seconds, \
+    send_train_locations_request, BatchFailedError, get_state_cache, RequestDeadlineExceeded
 from tests.helper_files.mock_train_location_response import MOCK_TRAIN_LOCATION_RESPONSE
 from tests.helper_files.mock_train_location_response_no_trains import MOCK_TRAIN_LOCATION_NO_TRAINS_RESPONSE
 from tests.helper_files.mock_train_location_response_no_route_object import MOCK_TRAIN_LOCATION_NO_ROUTE_OBJECT
+from tests.helper_files.mock_train_location_response_multiple_routes import \
+    MOCK_TRAIN_LOCATION_MULTIPLE_ROUTES_RESPONSE
 
 
 class TestGetTrainLocations(unittest.TestCase):
@@ -29,12 +44,15 @@ class TestGetTrainLocations(unittest.TestCase):
             }
         )
         self.env_patcher.start()
+        self.deadline_patcher = patch('lambdas.get_train_status.get_train_status.api_request_deadline', float('inf'))
+        self.deadline_patcher.start()
 
     def tearDown(self):
         """Stop all patches after each test."""
         self.env_patcher.stop()
+        self.deadline_patcher.stop()
 
-    @patch('lambdas.get_train_status.get_train_status.requests.get')
+    @patch('lambdas.get_train_status.get_train_status.http_session.get')
     def test_get_train_locations_success(self, mock_get):
         """Tests a successful API request to the Train Locations CTA API endpoint."""
         mock_json = MOCK_TRAIN_LOCATION_RESPONSE
@@ -51,10 +69,11 @@ class TestGetTrainLocations(unittest.TestCase):
                 'rt': 'P',
                 'key': 'api-key',
                 'outputType': 'JSON'
-            }
+            },
+            timeout=(2.0, 5.0)
         )
 
-    @patch('lambdas.get_train_status.get_train_status.requests.get')
+    @patch('lambdas.get_train_status.get_train_status.http_session.get')
     def test_get_train_locations_failure(self, mock_get):
         """Tests when an error occurs with the API request to the Train Locations CTA API endpoint."""
         response_mock = MagicMock()
@@ -76,10 +95,11 @@ class TestGetTrainLocations(unittest.TestCase):
                 'rt': 'P',
                 'key': 'api-key',
                 'outputType': 'JSON'
-            }
+            },
+            timeout=(2.0, 5.0)
         )
 
-    @patch('lambdas.get_train_status.get_train_status.requests.get')
+    @patch('lambdas.get_train_status.get_train_status.http_session.get')
     def test_get_train_locations_retry(self, mock_get):
         """Tests the API request to the Train Locations CTA API endpoint gets retried for the appropriate HTTP codes."""
         response_mock = MagicMock()
@@ -101,11 +121,457 @@ class TestGetTrainLocations(unittest.TestCase):
                 'rt': 'P',
                 'key': 'api-key',
                 'outputType': 'JSON'
-            }
+            },
+            timeout=(2.0, 5.0)
         )
         self.assertEqual(mock_get.call_count, 3)
 
 
+class TestHttpSession(unittest.TestCase):
+    """Class for testing the pooled HTTP session helpers."""
+
+    def test_create_http_session(self):
+        """Tests the session negotiates gzip and keeps connections alive."""
+        session = create_http_session(pool_maxsize=4)
+
+        self.assertIn('gzip', session.headers['Accept-Encoding'])
+        self.assertEqual(session.headers['Connection'], 'keep-alive')
+        adapter = session.get_adapter('https://lapi.transitchicago.com')
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.total, 0)
+
+    def test_get_request_timeout_default(self):
+        """Tests the default connect and read timeouts."""
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertEqual(get_request_timeout(), (2.0, 5.0))
+
+    def test_get_request_timeout_from_env(self):
+        """Tests the connect and read timeouts can be configured with environment variables."""
+        with patch.dict(os.environ, {'CTA_API_CONNECT_TIMEOUT': '0.5', 'CTA_API_READ_TIMEOUT': '3'}):
+            self.assertEqual(get_request_timeout(), (0.5, 3.0))
+
+    @patch('lambdas.get_train_status.get_train_status.time.monotonic', return_value=100.0)
+    def test_get_request_timeout_capped_at_deadline(self, mock_monotonic):
+        """Tests the timeouts are capped at the time left until the deadline, and no request is allowed after it."""
+        with patch.dict(os.environ, {}, clear=True):
+            with patch('lambdas.get_train_status.get_train_status.api_request_deadline', 103.0):
+                self.assertEqual(get_request_timeout(), (2.0, 3.0))
+            with patch('lambdas.get_train_status.get_train_status.api_request_deadline', 100.0):
+                with self.assertRaises(RequestDeadlineExceeded):
+                    get_request_timeout()
+
+    def test_get_http_session_stats_connection_reuse(self):
+        """Tests requests served by pooled connections are counted as connection reuse."""
+        session = create_http_session()
+        pool = session.get_adapter('https://lapi.transitchicago.com').poolmanager.connection_from_url(
+            'https://lapi.transitchicago.com'
+        )
+        pool.num_requests = 5
+        pool.num_connections = 1
+
+        stats = get_http_session_stats(session=session)
+
+        self.assertEqual(stats['requests'], 5)
+        self.assertEqual(stats['new_connections'], 1)
+        self.assertEqual(stats['reused_connections'], 4)
+
+    @patch('lambdas.get_train_status.get_train_status.http_request_latencies_ms', [120.0, 40.0, 35.0, 50.0])
+    def test_get_http_session_stats_latency(self):
+        """Tests latency percentiles are computed from the recorded request latencies."""
+        stats = get_http_session_stats(session=create_http_session())
+
+        self.assertEqual(stats['latency_p50_ms'], 40.0)
+        self.assertEqual(stats['latency_max_ms'], 120.0)
+
+
+class TestGetTrainLinesFromMessage(unittest.TestCase):
+    """Class for testing get_train_lines_from_message method."""
+
+    def test_single_line_message(self):
+        """Tests parsing a message for a single train line."""
+        message_body = json.dumps({'train_line_abbrev': 'P', 'train_line': 'Purple'})
+
+        result = get_train_lines_from_message(message_body=message_body)
+
+        self.assertEqual(result, {'P': 'Purple'})
+
+    def test_batched_message(self):
+        """Tests parsing a batched message containing multiple train lines."""
+        message_body = json.dumps(
+            {
+                'train_lines': [
+                    {'train_line_abbrev': 'Red', 'train_line': 'Red'},
+                    {'train_line_abbrev': 'P', 'train_line': 'Purple'}
+                ]
+            }
+        )
+
+        result = get_train_lines_from_message(message_body=message_body)
+
+        self.assertEqual(result, {'Red': 'Red', 'P': 'Purple'})
+
+    def test_batched_message_missing_train_line(self):
+        """Tests a ValueError is raised if any line in a batched message is missing a parameter."""
+        message_body = json.dumps(
+            {
+                'train_lines': [
+                    {'train_line_abbrev': 'Red', 'train_line': 'Red'},
+                    {'train_line_abbrev': 'P'}
+                ]
+            }
+        )
+
+        with self.assertRaises(ValueError):
+            get_train_lines_from_message(message_body=message_body)
+
+
+class TestSplitLocationsByLine(unittest.TestCase):
+    """Class for testing split_locations_by_line method."""
+
+    def test_split_multiple_routes(self):
+        """Tests a multi-route response is split into trains per train line."""
+        result = split_locations_by_line(
+            locations=MOCK_TRAIN_LOCATION_MULTIPLE_ROUTES_RESPONSE,
+            train_lines={'Red': 'Red', 'P': 'Purple', 'Pink': 'Pink'}
+        )
+
+        self.assertEqual(set(result.keys()), {'Red', 'Purple', 'Pink'})
+        self.assertEqual([train['rn'] for train in result['Red']], ['801'])
+        self.assertEqual([train['rn'] for train in result['Purple']], ['110'])
+        self.assertEqual(result['Pink'], [])
+
+    def test_split_matches_line_name(self):
+        """Tests routes whose @name is the full line name are matched to the train line."""
+        result = split_locations_by_line(
+            locations=MOCK_TRAIN_LOCATION_RESPONSE,
+            train_lines={'P': 'Purple', 'Red': 'Red'}
+        )
+
+        self.assertEqual(list(result.keys()), ['Purple'])
+
+    def test_split_skips_unrequested_routes(self):
+        """Tests routes that were not requested are skipped."""
+        result = split_locations_by_line(
+            locations=MOCK_TRAIN_LOCATION_MULTIPLE_ROUTES_RESPONSE,
+            train_lines={'Red': 'Red', 'Blue': 'Blue'}
+        )
+
+        self.assertEqual(list(result.keys()), ['Red'])
+
+    def test_split_no_route_object(self):
+        """Tests a KeyError is raised if no route object is present in the response."""
+        with self.assertRaises(KeyError):
+            split_locations_by_line(
+                locations=MOCK_TRAIN_LOCATION_NO_ROUTE_OBJECT,
+                train_lines={'P': 'Purple'}
+            )
+
+
+class TestParseTrainLocationData(unittest.TestCase):
+    """Class for testing parse_train_location_data method."""
+
+    def test_parse_train_location_data(self):
+        """Tests API train objects are converted into Firehose records."""
+        trains = MOCK_TRAIN_LOCATION_RESPONSE['ctatt']['route'][0]['train']
+
+        result = parse_train_location_data(
+            trains=trains,
+            train_line='Purple',
+            today_date='2025-06-20',
+            today_datetime='2025-06-20T12:43:00-05:00'
+        )
+
+        self.assertEqual(
+            result,
+            [
+                {
+                    'train_id': '2025-06-20#Purple#110#5',
+                    'current_timestamp': '2025-06-20T12:43:00-05:00',
+                    'prediction_generated_timestamp': '2025-06-20T12:42:56',
+                    'destination_station': 'Forest Park',
+                    'next_station': 'Belmont',
+                    'next_station_arrival_time': '2025-06-20T12:43:56',
+                    'is_approaching_station': '1',
+                    'is_train_delayed': '0',
+                    'next_station_id': '40060',
+                    'destination_station_id': '30077',
+                    'latitude': '41.94644',
+                    'longitude': '-87.71833',
+                    'heading': '142'
+                }
+            ]
+        )
+
+    def test_parse_train_location_data_without_position(self):
+        """Tests trains without station IDs or a position are converted with None for those fields."""
+        train = dict(MOCK_TRAIN_LOCATION_RESPONSE['ctatt']['route'][0]['train'][0])
+        for field in ('nextStaId', 'destSt', 'lat', 'lon', 'heading'):
+            del train[field]
+
+        result = parse_train_location_data(
+            trains=[train],
+            train_line='Purple',
+            today_date='2025-06-20',
+            today_datetime='2025-06-20T12:43:00-05:00'
+        )
+
+        self.assertEqual(
+            [result[0][field] for field in ('next_station_id', 'destination_station_id', 'latitude', 'longitude',
+                                            'heading')],
+            [None] * 5
+        )
+
+
+class TestGroupTrainLines(unittest.TestCase):
+    """Class for testing group_train_lines method."""
+
+    def test_group_single_request(self):
+        """Tests all lines are grouped into one request when the group size covers every line."""
+        result = group_train_lines(train_lines={'Red': 'Red', 'P': 'Purple'}, max_routes_per_request=2)
+
+        self.assertEqual(result, [{'Red': 'Red', 'P': 'Purple'}])
+
+    def test_group_per_line(self):
+        """Tests each line gets its own request group when the group size is one."""
+        result = group_train_lines(
+            train_lines={'Red': 'Red', 'P': 'Purple', 'Pink': 'Pink'},
+            max_routes_per_request=1
+        )
+
+        self.assertEqual(result, [{'Red': 'Red'}, {'P': 'Purple'}, {'Pink': 'Pink'}])
+
+
+class TestHedgedRequests(unittest.TestCase):
+    """Class for testing get_hedge_delay_seconds and send_train_locations_request methods."""
+
+    def setUp(self):
+        """Patch environment variables and the observed latencies before each test."""
+        self.env_patcher = patch.dict(os.environ, {'HEDGE_PERCENTILE': '95'})
+        self.env_patcher.start()
+        self.latencies_patcher = patch(
+            'lambdas.get_train_status.get_train_status.http_request_latencies_ms',
+            collections.deque([10.0] * 19 + [50.0], maxlen=500)
+        )
+        self.latencies_patcher.start()
+
+    def tearDown(self):
+        """Stop all patches after each test."""
+        self.env_patcher.stop()
+        self.latencies_patcher.stop()
+
+    def test_get_hedge_delay_seconds(self):
+        """Tests the hedge delay is the latency percentile, once enough latencies have been observed."""
+        self.assertEqual(get_hedge_delay_seconds(percentile=50), 0.01)
+        self.assertEqual(get_hedge_delay_seconds(percentile=100), 0.05)
+        with patch('lambdas.get_train_status.get_train_status.http_request_latencies_ms', collections.deque([10.0])):
+            self.assertIsNone(get_hedge_delay_seconds(percentile=95))
+
+    @patch('lambdas.get_train_status.get_train_status.http_session.get')
+    def test_fast_response_not_hedged(self, mock_get):
+        """Tests no hedged request is sent when the first response arrives in time."""
+        mock_get.return_value = MagicMock(ok=True)
+
+        response = send_train_locations_request(query_params={'rt': 'P'})
+
+        self.assertIs(response, mock_get.return_value)
+        mock_get.assert_called_once()
+
+    @patch('lambdas.get_train_status.get_train_status.http_session.get')
+    def test_slow_response_hedged(self, mock_get):
+        """Tests a hedged request is sent when the first response is slow and the faster response is returned."""
+        slow_response = MagicMock(ok=True)
+        fast_response = MagicMock(ok=True)
+        calls = []
+
+        def response(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                time.sleep(0.3)
+                return slow_response
+            return fast_response
+        mock_get.side_effect = response
+
+        start_time = time.perf_counter()
+        result = send_train_locations_request(query_params={'rt': 'P'})
+        elapsed = time.perf_counter() - start_time
+
+        self.assertIs(result, fast_response)
+        self.assertLess(elapsed, 0.25)
+        self.assertEqual(mock_get.call_count, 2)
+
+    @patch('lambdas.get_train_status.get_train_status.http_session.get')
+    def test_hedging_disabled(self, mock_get):
+        """Tests requests are sent directly without HEDGE_PERCENTILE."""
+        mock_get.return_value = MagicMock(ok=True)
+
+        with patch.dict(os.environ, {}, clear=True):
+            send_train_locations_request(query_params={'rt': 'P'})
+
+        mock_get.assert_called_once()
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Class for testing CircuitBreaker class."""
+
+    def setUp(self):
+        """Create a circuit breaker with an in-memory store before each test."""
+        self.breaker = CircuitBreaker(store=InMemoryStateStore(), failure_threshold=2, recovery_seconds=30)
+        self.failing_call = MagicMock(side_effect=requests.exceptions.ConnectionError('Connection refused'))
+
+    def test_opens_after_consecutive_failures(self):
+        """Tests the circuit opens after failure_threshold consecutive failures and then fails fast."""
+        for _ in range(2):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                self.breaker.call(self.failing_call)
+
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.call(self.failing_call)
+        self.assertEqual(self.failing_call.call_count, 2)
+
+    def test_success_resets_failures(self):
+        """Tests a successful call resets the consecutive failure count."""
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.breaker.call(self.failing_call)
+        self.assertEqual(self.breaker.call(lambda: 'ok'), 'ok')
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.breaker.call(self.failing_call)
+
+        self.assertEqual(self.breaker.store.load('cta_api')['state'], 'closed')
+
+    @patch('lambdas.get_train_status.get_train_status.time.time')
+    def test_probe_after_recovery(self, mock_time):
+        """Tests a single probe is let through after recovery_seconds and closes the circuit if it succeeds."""
+        mock_time.return_value = 1000.0
+        for _ in range(2):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                self.breaker.call(self.failing_call)
+
+        mock_time.return_value = 1031.0
+        state, probe_allowed = self.breaker.allow(state=self.breaker.store.load('cta_api'), now=1031.0)
+        _, second_allowed = self.breaker.allow(state=state, now=1032.0)
+        result = self.breaker.call(lambda: 'ok')
+
+        self.assertTrue(probe_allowed)
+        self.assertFalse(second_allowed)
+        self.assertEqual(result, 'ok')
+        self.assertEqual(self.breaker.store.load('cta_api')['state'], 'closed')
+
+    @patch('lambdas.get_train_status.get_train_status.time.time')
+    def test_failed_probe_reopens(self, mock_time):
+        """Tests the circuit stays open for another recovery_seconds if the probe fails."""
+        mock_time.return_value = 1000.0
+        for _ in range(2):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                self.breaker.call(self.failing_call)
+
+        mock_time.return_value = 1031.0
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.breaker.call(self.failing_call)
+        mock_time.return_value = 1050.0
+
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.call(self.failing_call)
+        self.assertEqual(self.failing_call.call_count, 3)
+
+    def test_is_circuit_breaker_failure(self):
+        """Tests only errors that indicate an unhealthy API count as failures."""
+        not_found = requests.exceptions.HTTPError(response=MagicMock(status_code=404))
+        throttled = requests.exceptions.HTTPError(response=MagicMock(status_code=429))
+        server_error = requests.exceptions.HTTPError(response=MagicMock(status_code=503))
+
+        self.assertFalse(is_circuit_breaker_failure(not_found))
+        self.assertTrue(is_circuit_breaker_failure(throttled))
+        self.assertTrue(is_circuit_breaker_failure(server_error))
+        self.assertTrue(is_circuit_breaker_failure(requests.exceptions.ReadTimeout()))
+        self.assertFalse(is_circuit_breaker_failure(ValueError()))
+
+    def test_get_circuit_breaker(self):
+        """Tests the circuit breaker settings are read from the environment."""
+        with patch.dict(os.environ, {'CIRCUIT_BREAKER_FAILURE_THRESHOLD': '5', 'CIRCUIT_BREAKER_STORE': 's3',
+                                     'CIRCUIT_BREAKER_BUCKET': 'test-bucket'}):
+            circuit_breaker = get_circuit_breaker()
+
+        self.assertEqual(circuit_breaker.failure_threshold, 5)
+        self.assertEqual(circuit_breaker.store.prefix, 'state/circuit_breaker/')
+
+
+class TestFetchTrainLocationsConcurrently(unittest.TestCase):
+    """Class for testing fetch_train_locations_concurrently method."""
+
+    def setUp(self):
+        """Start each test with the circuit breaker closed."""
+        get_state_cache.cache_clear()
+
+    @patch('lambdas.get_train_status.get_train_status.get_train_locations')
+    def test_fetch_preserves_order(self, mock_train_locations):
+        """Tests results are returned in the same order as the request groups."""
+        def delayed_response(train_line_abbrev):
+            time.sleep(0.05 if train_line_abbrev == 'Red' else 0)
+            return {'rt': train_line_abbrev}
+        mock_train_locations.side_effect = delayed_response
+
+        result = fetch_train_locations_concurrently(
+            request_groups=[{'Red': 'Red'}, {'P': 'Purple'}, {'Pink': 'Pink'}],
+            max_workers=3
+        )
+
+        self.assertEqual(result, [({'rt': 'Red'}, None), ({'rt': 'P'}, None), ({'rt': 'Pink'}, None)])
+
+    @patch('lambdas.get_train_status.get_train_status.get_train_locations')
+    def test_fetch_runs_in_parallel(self, mock_train_locations):
+        """Tests wall-clock time is close to the slowest single request rather than the sum of all requests."""
+        def delayed_response(train_line_abbrev):
+            time.sleep(0.2)
+            return {'rt': train_line_abbrev}
+        mock_train_locations.side_effect = delayed_response
+
+        start_time = time.perf_counter()
+        fetch_train_locations_concurrently(
+            request_groups=[{'Red': 'Red'}, {'Blue': 'Blue'}, {'P': 'Purple'}, {'Pink': 'Pink'}],
+            max_workers=4
+        )
+        elapsed = time.perf_counter() - start_time
+
+        self.assertLess(elapsed, 0.6)
+        self.assertEqual(mock_train_locations.call_count, 4)
+
+    @patch('lambdas.get_train_status.get_train_status.get_train_locations')
+    def test_fetch_captures_errors(self, mock_train_locations):
+        """Tests an error for one request group is returned without affecting the other groups."""
+        http_error = requests.exceptions.HTTPError('500 Server Error')
+        mock_train_locations.side_effect = lambda train_line_abbrev: \
+            (_ for _ in ()).throw(http_error) if train_line_abbrev == 'P' else {'rt': train_line_abbrev}
+
+        result = fetch_train_locations_concurrently(
+            request_groups=[{'Red': 'Red'}, {'P': 'Purple'}],
+            max_workers=2
+        )
+
+        self.assertEqual(result, [({'rt': 'Red'}, None), (None, http_error)])
+
+    @patch('lambdas.get_train_status.get_train_status.get_train_locations')
+    def test_fetch_fails_fast_with_open_circuit(self, mock_train_locations):
+        """Tests the API is no longer called once repeated failures have opened the circuit breaker."""
+        mock_train_locations.side_effect = requests.exceptions.ConnectTimeout('Connection timed out')
+
+        for _ in range(3):
+            fetch_train_locations_concurrently(request_groups=[{'P': 'Purple'}], max_workers=1)
+        result = fetch_train_locations_concurrently(request_groups=[{'P': 'Purple'}], max_workers=1)
+
+        self.assertEqual(mock_train_locations.call_count, 3)
+        self.assertIsInstance(result[0][1], CircuitOpenError)
+
+    @patch('lambdas.get_train_status.get_train_status.get_train_locations')
+    def test_fetch_single_group_without_thread_pool(self, mock_train_locations):
+        """Tests a single request group is fetched directly."""
+        mock_train_locations.return_value = MOCK_TRAIN_LOCATION_RESPONSE
+
+        result = fetch_train_locations_concurrently(request_groups=[{'P': 'Purple'}], max_workers=8)
+
+        self.assertEqual(result, [(MOCK_TRAIN_LOCATION_RESPONSE, None)])
+        mock_train_locations.assert_called_once_with(train_line_abbrev='P')
+
+
 class TestDictionaryToFirehoseRecord(unittest.TestCase):
     """Class for testing dictionary_to_firehose_records method."""
 
@@ -169,6 +635,14 @@ class TestWriteTrainLocationData(unittest.TestCase):
     def setUp(self):
         """Patch environment variables and common dependencies before each test."""
         self.data_to_write = [{'foo': 'bar'}]
+        get_firehose_client.cache_clear()
+        self.sleep_patcher = patch('lambdas.get_train_status.get_train_status.time.sleep')
+        self.mock_sleep = self.sleep_patcher.start()
+
+    def tearDown(self):
+        """Stop all patches after each test."""
+        get_firehose_client.cache_clear()
+        self.sleep_patcher.stop()
 
     @patch('lambdas.get_train_status.get_train_status.boto3.client')
     def test_write_train_location_data_success(self, mock_boto_client):
@@ -280,6 +754,536 @@ class TestWriteTrainLocationData(unittest.TestCase):
         self.assertEqual(mock_firehose.put_record_batch.call_count, 3)
 
 
+    @patch('lambdas.get_train_status.get_train_status.boto3.client')
+    def test_write_train_location_data_backoff_between_retries(self, mock_boto_client):
+        """Tests failed entries are retried after a jittered exponential backoff."""
+        mock_firehose = MagicMock()
+        mock_firehose.put_record_batch.side_effect = [
+            {
+                'FailedPutCount': 1,
+                'RequestResponses': [
+                    {'RecordId': '0'},
+                    {'ErrorCode': 'ServiceUnavailableException', 'ErrorMessage': 'Slow down.'}
+                ]
+            },
+            {
+                'FailedPutCount': 0,
+                'RequestResponses': [{'RecordId': '1'}]
+            }
+        ]
+        mock_boto_client.return_value = mock_firehose
+        data_to_write = [{'foo': 'bar'}, {'foo': 'baz'}]
+
+        stats = write_train_location_data(data_to_write=data_to_write, max_retries=5)
+
+        self.assertEqual(
+            mock_firehose.put_record_batch.call_args_list[1].kwargs['Records'],
+            [dictionary_to_firehose_record({'foo': 'baz'})]
+        )
+        self.mock_sleep.assert_called_once()
+        self.assertLessEqual(self.mock_sleep.call_args.args[0], 0.2)
+        self.assertEqual(stats['records'], 2)
+        self.assertEqual(stats['retried_records'], 1)
+
+    @patch('lambdas.get_train_status.get_train_status.boto3.client')
+    def test_write_train_location_data_chunks_large_batches(self, mock_boto_client):
+        """Tests more than 500 records are split into multiple concurrent PutRecordBatch calls."""
+        mock_firehose = MagicMock()
+        mock_firehose.put_record_batch.return_value = {'FailedPutCount': 0}
+        mock_boto_client.return_value = mock_firehose
+        data_to_write = [{'index': i} for i in range(1201)]
+
+        stats = write_train_location_data(data_to_write=data_to_write, max_retries=5)
+
+        self.assertEqual(mock_firehose.put_record_batch.call_count, 3)
+        sent_records = sorted(
+            len(call.kwargs['Records']) for call in mock_firehose.put_record_batch.call_args_list
+        )
+        self.assertEqual(sent_records, [201, 500, 500])
+        self.assertEqual(stats['batches'], 3)
+        self.assertEqual(stats['records'], 1201)
+        self.assertEqual(stats['retried_records'], 0)
+
+    @patch('lambdas.get_train_status.get_train_status.boto3.client')
+    def test_get_firehose_client_cached(self, mock_boto_client):
+        """Tests the Firehose client is created once and reused."""
+        first_client = get_firehose_client()
+        second_client = get_firehose_client()
+
+        self.assertIs(first_client, second_client)
+        mock_boto_client.assert_called_once_with('firehose')
+
+
+    @patch('lambdas.get_train_status.get_train_status.boto3.client')
+    def test_write_train_location_data_aggregated(self, mock_boto_client):
+        """Tests rows are packed into a single gzip-compressed Firehose record in ndjson_gzip format."""
+        mock_firehose = MagicMock()
+        mock_firehose.put_record_batch.return_value = {'FailedPutCount': 0}
+        mock_boto_client.return_value = mock_firehose
+        data_to_write = [{'index': i} for i in range(100)]
+
+        with patch.dict(os.environ, {'FIREHOSE_RECORD_FORMAT': 'ndjson_gzip'}):
+            stats = write_train_location_data(data_to_write=data_to_write, max_retries=5)
+
+        records = mock_firehose.put_record_batch.call_args.kwargs['Records']
+        self.assertEqual(len(records), 1)
+        lines = gzip.decompress(records[0]['Data']).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line) for line in lines], data_to_write)
+        self.assertEqual(stats['rows'], 100)
+        self.assertEqual(stats['records'], 1)
+
+    def test_write_train_location_data_unsupported_format(self):
+        """Tests a ValueError is raised for an unsupported record format."""
+        with self.assertRaises(ValueError):
+            write_train_location_data(data_to_write=self.data_to_write, max_retries=5, record_format='xml')
+
+
+class TestAggregateFirehoseRecords(unittest.TestCase):
+    """Class for testing aggregate_firehose_records method."""
+
+    def test_aggregate_ndjson(self):
+        """Tests rows are packed into newline-delimited JSON records."""
+        data = [{'foo': 'bar'}, {'foo': 'baz'}]
+
+        result = aggregate_firehose_records(data_to_write=data)
+
+        self.assertEqual(result, [{'Data': b'{"foo": "bar"}\n{"foo": "baz"}\n'}])
+
+    def test_aggregate_respects_size_threshold(self):
+        """Tests a new record is started once the size threshold would be exceeded."""
+        data = [{'index': i} for i in range(10)]
+        line_bytes = len(json.dumps({'index': 0}) + '\n')
+
+        result = aggregate_firehose_records(data_to_write=data, max_record_bytes=line_bytes * 4)
+
+        self.assertEqual([record['Data'].count(b'\n') for record in result], [4, 4, 2])
+        self.assertTrue(all(len(record['Data']) <= line_bytes * 4 for record in result))
+
+    def test_aggregate_compressed(self):
+        """Tests each aggregated record is a self-contained gzip member."""
+        data = [{'index': i} for i in range(10)]
+
+        result = aggregate_firehose_records(data_to_write=data, max_record_bytes=50, compress=True)
+
+        self.assertGreater(len(result), 1)
+        concatenated = b''.join(record['Data'] for record in result)
+        lines = gzip.decompress(concatenated).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line) for line in lines], data)
+
+
+class TestChunkFirehoseRecords(unittest.TestCase):
+    """Class for testing chunk_firehose_records method."""
+
+    def test_chunk_by_record_count(self):
+        """Tests records are chunked by the maximum number of records per call."""
+        records = [{'Data': b'x'} for _ in range(5)]
+
+        result = chunk_firehose_records(records=records, max_records=2)
+
+        self.assertEqual([len(chunk) for chunk in result], [2, 2, 1])
+
+    def test_chunk_by_payload_size(self):
+        """Tests records are chunked by the maximum payload size per call."""
+        records = [{'Data': b'x' * 400} for _ in range(5)]
+
+        result = chunk_firehose_records(records=records, max_bytes=1000)
+
+        self.assertEqual([len(chunk) for chunk in result], [2, 2, 1])
+
+    def test_chunk_empty(self):
+        """Tests no chunks are produced for no records."""
+        self.assertEqual(chunk_firehose_records(records=[]), [])
+
+    def test_chunk_record_too_large(self):
+        """Tests a ValueError is raised for a record larger than the Firehose record size limit."""
+        with self.assertRaises(ValueError):
+            chunk_firehose_records(records=[{'Data': b'x' * (FIREHOSE_MAX_RECORD_BYTES + 1)}])
+
+
+class TestWriteFirehoseChunk(unittest.TestCase):
+    """Class for testing write_firehose_chunk method."""
+
+    @patch('lambdas.get_train_status.get_train_status.time.sleep')
+    def test_write_firehose_chunk_no_sleep_after_last_attempt(self, mock_sleep):
+        """Tests there is no backoff after the final failed attempt."""
+        mock_firehose = MagicMock()
+        mock_firehose.put_record_batch.return_value = {
+            'FailedPutCount': 1,
+            'RequestResponses': [{'ErrorCode': 'ServiceUnavailableException'}]
+        }
+
+        with self.assertRaises(Exception):
+            write_firehose_chunk(firehose=mock_firehose, records=[{'Data': b'x'}], max_retries=3)
+
+        self.assertEqual(mock_firehose.put_record_batch.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+
+def make_row(train_id, next_station='Belmont', is_approaching_station='0', is_train_delayed='0',
+             current_timestamp='2025-06-20T12:43:00-05:00'):
+    """Returns a train location row with the given tracked field values."""
+    return {
+        'train_id': train_id,
+        'current_timestamp': current_timestamp,
+        'next_station': next_station,
+        'is_approaching_station': is_approaching_station,
+        'is_train_delayed': is_train_delayed
+    }
+
+
+class TestApplyDeltaEncoding(unittest.TestCase):
+    """Class for testing apply_delta_encoding method."""
+
+    def setUp(self):
+        """Set up a poll time and an existing state before each test."""
+        self.now = datetime.datetime(2025, 6, 20, 12, 43, tzinfo=zoneinfo.ZoneInfo('America/Chicago'))
+        self.state = {
+            'last_keyframe': (self.now - datetime.timedelta(minutes=5)).isoformat(),
+            'trains': {
+                'a': ['Belmont', '0', '0'],
+                'b': ['Addison', '0', '0']
+            }
+        }
+
+    def test_keyframe_without_state(self):
+        """Tests every row is emitted as a keyframe when there is no previous state."""
+        rows = [make_row('a'), make_row('b')]
+
+        emitted_rows, new_state = apply_delta_encoding(
+            rows=rows, state=None, now=self.now, keyframe_interval_seconds=900
+        )
+
+        self.assertEqual([row['record_type'] for row in emitted_rows], ['keyframe', 'keyframe'])
+        self.assertEqual(new_state['last_keyframe'], self.now.isoformat())
+        self.assertEqual(new_state['trains']['a'], ['Belmont', '0', '0'])
+
+    def test_only_changed_rows_emitted(self):
+        """Tests unchanged trains are suppressed, changed and new trains are emitted and missing trains removed."""
+        rows = [make_row('a'), make_row('b', next_station='Addison', is_approaching_station='1'), make_row('c')]
+        self.state['trains']['d'] = ['Howard', '0', '0']
+
+        emitted_rows, new_state = apply_delta_encoding(
+            rows=rows, state=self.state, now=self.now, keyframe_interval_seconds=900
+        )
+
+        self.assertEqual(
+            [(row['train_id'], row['record_type']) for row in emitted_rows],
+            [('b', 'delta'), ('c', 'delta'), ('d', 'removed')]
+        )
+        self.assertEqual(new_state['last_keyframe'], self.state['last_keyframe'])
+        self.assertEqual(set(new_state['trains'].keys()), {'a', 'b', 'c'})
+
+    def test_keyframe_after_interval(self):
+        """Tests every row is emitted again once the keyframe interval has elapsed."""
+        rows = [make_row('a'), make_row('b', next_station='Addison')]
+
+        emitted_rows, new_state = apply_delta_encoding(
+            rows=rows, state=self.state, now=self.now, keyframe_interval_seconds=300
+        )
+
+        self.assertEqual([row['record_type'] for row in emitted_rows], ['keyframe', 'keyframe'])
+        self.assertEqual(new_state['last_keyframe'], self.now.isoformat())
+
+
+class TestStateStores(unittest.TestCase):
+    """Class for testing the delta state stores."""
+
+    def test_in_memory_state_store(self):
+        """Tests saving and loading state in memory."""
+        store = InMemoryStateStore()
+
+        store.save('Red', {'trains': {}})
+
+        self.assertEqual(store.load('Red'), {'trains': {}})
+        self.assertIsNone(store.load('Blue'))
+
+    @patch('lambdas.get_train_status.get_train_status.get_s3_client')
+    def test_s3_state_store_load(self, mock_get_s3_client):
+        """Tests loading state from S3 also populates the cache."""
+        mock_s3 = MagicMock()
+        mock_s3.get_object.return_value = {'Body': MagicMock(read=MagicMock(return_value=b'{"trains": {}}'))}
+        mock_get_s3_client.return_value = mock_s3
+        cache = InMemoryStateStore()
+        store = S3StateStore(bucket_name='test-bucket', prefix='state/delta/', cache=cache)
+
+        result = store.load('Red')
+
+        self.assertEqual(result, {'trains': {}})
+        self.assertEqual(cache.load('Red'), {'trains': {}})
+        mock_s3.get_object.assert_called_once_with(Bucket='test-bucket', Key='state/delta/Red.json')
+
+    @patch('lambdas.get_train_status.get_train_status.get_s3_client')
+    def test_s3_state_store_load_missing(self, mock_get_s3_client):
+        """Tests loading state that does not exist in S3 returns None."""
+        mock_s3 = MagicMock()
+        mock_s3.get_object.side_effect = botocore.exceptions.ClientError(
+            error_response={'Error': {'Code': 'NoSuchKey'}},
+            operation_name='GetObject'
+        )
+        mock_get_s3_client.return_value = mock_s3
+        store = S3StateStore(bucket_name='test-bucket', prefix='state/delta/')
+
+        self.assertIsNone(store.load('Red'))
+
+    @patch('lambdas.get_train_status.get_train_status.get_s3_client')
+    def test_s3_state_store_save(self, mock_get_s3_client):
+        """Tests saving state writes a JSON object to S3."""
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        store = S3StateStore(bucket_name='test-bucket', prefix='state/delta/')
+
+        store.save('Red', {'trains': {}})
+
+        mock_s3.put_object.assert_called_once_with(
+            Bucket='test-bucket',
+            Key='state/delta/Red.json',
+            Body=b'{"trains": {}}'
+        )
+
+    def test_get_delta_state_store(self):
+        """Tests the S3 store is only used when a state bucket is configured."""
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertIsInstance(get_delta_state_store(), InMemoryStateStore)
+        with patch.dict(os.environ, {'DELTA_STATE_BUCKET': 'test-bucket'}):
+            self.assertIsInstance(get_delta_state_store(), S3StateStore)
+
+
+class TestStateStoreUpdates(unittest.TestCase):
+    """Class for testing the atomic update method of the state stores."""
+
+    def test_in_memory_update_concurrent(self):
+        """Tests concurrent updates of the in-memory store are not lost."""
+        store = InMemoryStateStore()
+
+        def increment():
+            for _ in range(100):
+                store.update('count', lambda state: ({'count': (state or {'count': 0})['count'] + 1}, None))
+
+        threads = [threading.Thread(target=increment) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(store.load('count'), {'count': 400})
+
+    def test_file_store(self):
+        """Tests the file store saves, loads and updates state shared through the file."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'state.json')
+            store = FileStateStore(path=path)
+
+            self.assertIsNone(store.load('Purple'))
+            store.save('Purple', {'count': 1})
+            result = FileStateStore(path=path).update('Purple', lambda state: ({'count': state['count'] + 1}, 'done'))
+
+            self.assertEqual(result, 'done')
+            self.assertEqual(store.load('Purple'), {'count': 2})
+
+    @patch('lambdas.get_train_status.get_train_status.get_s3_client')
+    def test_s3_store_update_retries_on_conflict(self, mock_get_s3_client):
+        """Tests the S3 store writes conditionally and repeats the update when another writer got there first."""
+        mock_s3 = MagicMock()
+        mock_get_s3_client.return_value = mock_s3
+        mock_s3.get_object.side_effect = [
+            botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject'),
+            {'Body': io.BytesIO(b'{"count": 5}'), 'ETag': '"etag-1"'}
+        ]
+        mock_s3.put_object.side_effect = [
+            botocore.exceptions.ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject'),
+            {}
+        ]
+        store = S3StateStore(bucket_name='test-bucket', prefix='state/rate_limit/')
+
+        result = store.update('cta_api', lambda state: ({'count': (state or {'count': 0})['count'] + 1}, 'done'))
+
+        self.assertEqual(result, 'done')
+        self.assertEqual(mock_s3.put_object.call_args_list[0].kwargs['IfNoneMatch'], '*')
+        self.assertEqual(mock_s3.put_object.call_args_list[1].kwargs['IfMatch'], '"etag-1"')
+        self.assertEqual(mock_s3.put_object.call_args_list[1].kwargs['Body'], b'{"count": 6}')
+        self.assertEqual(store.cache.load('cta_api'), {'count': 6})
+
+
+class TestTokenBucketRateLimiter(unittest.TestCase):
+    """Class for testing TokenBucketRateLimiter class."""
+
+    def setUp(self):
+        """Set a common time for each test."""
+        self.now = datetime.datetime(2025, 6, 25, 10, 30, tzinfo=zoneinfo.ZoneInfo('America/Chicago'))
+
+    def test_per_second_budget(self):
+        """Tests requests beyond the per-second budget have to wait for the bucket to refill."""
+        limiter = TokenBucketRateLimiter(store=InMemoryStateStore(), requests_per_second=2, requests_per_day=100000)
+
+        state, first_wait = limiter.reserve(state=None, now=self.now)
+        state, second_wait = limiter.reserve(state=state, now=self.now)
+        state, third_wait = limiter.reserve(state=state, now=self.now)
+        state, later_wait = limiter.reserve(state=state, now=self.now + datetime.timedelta(seconds=0.5))
+
+        self.assertEqual([first_wait, second_wait, later_wait], [0, 0, 0])
+        self.assertAlmostEqual(third_wait, 0.5)
+        self.assertEqual(state['day_count'], 3)
+
+    def test_daily_budget_spread(self):
+        """Tests the daily bucket only allows burst_seconds worth of the daily budget at once."""
+        limiter = TokenBucketRateLimiter(
+            store=InMemoryStateStore(),
+            requests_per_second=100,
+            requests_per_day=86400,
+            burst_seconds=3
+        )
+        state = None
+        waits = []
+        for _ in range(4):
+            state, wait_seconds = limiter.reserve(state=state, now=self.now)
+            waits.append(wait_seconds)
+
+        self.assertEqual(waits[:3], [0, 0, 0])
+        self.assertAlmostEqual(waits[3], 1.0)
+
+    def test_daily_limit(self):
+        """Tests no requests are allowed once the day's budget is spent, until the next day."""
+        limiter = TokenBucketRateLimiter(store=InMemoryStateStore(), requests_per_day=2, burst_seconds=86400)
+        state, _ = limiter.reserve(state=None, now=self.now)
+        state, _ = limiter.reserve(state=state, now=self.now + datetime.timedelta(seconds=1))
+
+        _, spent_wait = limiter.reserve(state=state, now=self.now + datetime.timedelta(seconds=2))
+        _, next_day_wait = limiter.reserve(state=state, now=self.now + datetime.timedelta(days=1))
+
+        self.assertIsNone(spent_wait)
+        self.assertEqual(next_day_wait, 0)
+
+    @patch('lambdas.get_train_status.get_train_status.time.sleep', side_effect=time.sleep)
+    def test_acquire(self, mock_sleep):
+        """Tests acquire waits for short delays and raises once the budget is spent."""
+        limiter = TokenBucketRateLimiter(store=InMemoryStateStore(), requests_per_second=50, requests_per_day=51,
+                                         burst_seconds=86400, max_wait_seconds=1)
+
+        for _ in range(51):
+            limiter.acquire()
+        stats = limiter.get_stats()
+
+        mock_sleep.assert_called()
+        self.assertLess(mock_sleep.call_args.args[0], 0.1)
+        self.assertEqual(stats['requests_today'], 51)
+        self.assertEqual(stats['remaining_today'], 0)
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire()
+
+    def test_acquire_long_wait(self):
+        """Tests acquire raises rather than waiting longer than max_wait_seconds."""
+        limiter = TokenBucketRateLimiter(store=InMemoryStateStore(), requests_per_second=0.1, max_wait_seconds=1)
+
+        limiter.acquire()
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire()
+
+    def test_get_rate_limiter(self):
+        """Tests the budget store is selected with RATE_LIMIT_STORE."""
+        with patch.dict(os.environ, {'RATE_LIMIT_STORE': 's3', 'RATE_LIMIT_BUCKET': 'test-bucket'}):
+            self.assertEqual(get_rate_limiter().store.prefix, 'state/rate_limit/')
+        with patch.dict(os.environ, {'RATE_LIMIT_STORE': 'file', 'RATE_LIMIT_FILE': '/tmp/test.json'}):
+            self.assertEqual(get_rate_limiter().store.path, '/tmp/test.json')
+        with patch.dict(os.environ, {'RATE_LIMIT_STORE': 'redis'}):
+            with self.assertRaises(ValueError):
+                get_rate_limiter()
+
+
+class TestLineActivity(unittest.TestCase):
+    """Class for testing update_line_activity and record_line_activity methods."""
+
+    def setUp(self):
+        """Set a common poll time for each test."""
+        self.now = datetime.datetime(2025, 6, 25, 10, 30, tzinfo=zoneinfo.ZoneInfo('America/Chicago'))
+
+    def test_update_line_activity_first_poll(self):
+        """Tests a line without saved activity is always saved, whether or not trains are running."""
+        self.assertEqual(
+            update_line_activity(activity=None, trains_running=2, now=self.now),
+            {'last_active': self.now.isoformat()}
+        )
+        self.assertEqual(update_line_activity(activity=None, trains_running=0, now=self.now), {'last_active': None})
+
+    def test_update_line_activity_active(self):
+        """Tests trains running update the last active time once it is older than refresh_seconds."""
+        stale = {'last_active': (self.now - datetime.timedelta(minutes=6)).isoformat()}
+        fresh = {'last_active': (self.now - datetime.timedelta(minutes=4)).isoformat()}
+
+        self.assertEqual(
+            update_line_activity(activity=stale, trains_running=2, now=self.now, refresh_seconds=300),
+            {'last_active': self.now.isoformat()}
+        )
+        self.assertEqual(
+            update_line_activity(activity={'last_active': None}, trains_running=2, now=self.now),
+            {'last_active': self.now.isoformat()}
+        )
+        self.assertIsNone(update_line_activity(activity=fresh, trains_running=2, now=self.now, refresh_seconds=300))
+
+    def test_update_line_activity_empty(self):
+        """Tests an empty poll leaves the saved activity unchanged."""
+        previous = {'last_active': (self.now - datetime.timedelta(hours=1)).isoformat()}
+
+        self.assertIsNone(update_line_activity(activity=previous, trains_running=0, now=self.now))
+
+    def test_record_line_activity(self):
+        """Tests only the lines whose activity changed are saved, using the cached previous activity."""
+        store = MagicMock()
+        store.cache = InMemoryStateStore()
+        store.cache.save('Purple', {'last_active': '2025-06-25T10:00:00-05:00'})
+        store.cache.save('Blue', {'last_active': '2025-06-25T10:28:00-05:00'})
+        store.load.return_value = None
+
+        record_line_activity(store=store, trains_running={'Purple': 0, 'Blue': 3, 'Red': 4}, now=self.now)
+
+        store.load.assert_called_once_with('Red')
+        store.save.assert_called_once_with('Red', {'last_active': self.now.isoformat()})
+
+    def test_record_line_activity_error_logged(self):
+        """Tests a failure to save activity does not raise."""
+        store = MagicMock()
+        store.cache = InMemoryStateStore()
+        store.load.return_value = None
+        store.save.side_effect = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}},
+            'PutObject'
+        )
+
+        record_line_activity(store=store, trains_running={'Red': 4}, now=self.now)
+
+        store.save.assert_called_once()
+
+
+class TestGetPollTicks(unittest.TestCase):
+    """Class for testing get_poll_ticks method."""
+
+    def test_ticks_aligned_to_interval(self):
+        """Tests the ticks fall on multiples of the interval within the minute, starting with the current one."""
+        now = datetime.datetime(2025, 6, 25, 10, 30, 21, 500, tzinfo=zoneinfo.ZoneInfo('America/Chicago'))
+
+        ticks = get_poll_ticks(now=now, interval_seconds=15)
+
+        self.assertEqual(
+            [tick.strftime('%H:%M:%S') for tick in ticks],
+            ['10:30:15', '10:30:30', '10:30:45']
+        )
+        self.assertEqual(ticks[0].tzinfo, now.tzinfo)
+
+    def test_single_tick_per_minute(self):
+        """Tests a single tick is returned for a one-minute interval."""
+        now = datetime.datetime(2025, 6, 25, 10, 30, 0, 800000, tzinfo=zoneinfo.ZoneInfo('America/Chicago'))
+
+        ticks = get_poll_ticks(now=now, interval_seconds=60)
+
+        self.assertEqual([tick.strftime('%H:%M:%S') for tick in ticks], ['10:30:00'])
+
+    def test_invalid_interval(self):
+        """Tests a ValueError is raised for an interval that does not divide the minute."""
+        now = datetime.datetime(2025, 6, 25, 10, 30, 0, tzinfo=zoneinfo.ZoneInfo('America/Chicago'))
+
+        with self.assertRaises(ValueError):
+            get_poll_ticks(now=now, interval_seconds=25)
+
+
 class MockLambdaContext:
     """Mock class for AWS Lambda context."""
 
@@ -317,6 +1321,8 @@ class TestLambdaHandler(unittest.TestCase):
             ]
         }
         self.today_date = datetime.datetime.now(zoneinfo.ZoneInfo('America/Chicago')).date().strftime('%Y-%m-%d')
+        # Failures or delta state in one test must not carry over to the next
+        get_state_cache.cache_clear()
 
     @patch('lambdas.get_train_status.get_train_status.get_train_locations')
     @patch('lambdas.get_train_status.get_train_status.write_train_location_data')
@@ -348,7 +1354,12 @@ class TestLambdaHandler(unittest.TestCase):
                 'next_station': 'Belmont',
                 'next_station_arrival_time': '2025-06-20T12:43:56',
                 'is_approaching_station': '1',
-                'is_train_delayed': '0'
+                'is_train_delayed': '0',
+                'next_station_id': '40060',
+                'destination_station_id': '30077',
+                'latitude': '41.94644',
+                'longitude': '-87.71833',
+                'heading': '142'
             }
         ]
 
@@ -361,7 +1372,8 @@ class TestLambdaHandler(unittest.TestCase):
             response,
             {
                 'statusCode': 200,
-                'body': 'Execution successful'
+                'body': 'Execution successful',
+                'batchItemFailures': []
             }
         )
         mock_train_locations_write.assert_called_once_with(
@@ -370,7 +1382,7 @@ class TestLambdaHandler(unittest.TestCase):
         )
 
     def test_lambda_handler_missing_train_abbrev(self):
-        """Tests lambda handler invocation with missing train_abbrev parameter in SQS message body."""
+        """Tests a batch whose only message is missing the train_abbrev parameter raises so it is redelivered."""
         mock_event = {
             "Records": [
                 {
@@ -393,7 +1405,7 @@ class TestLambdaHandler(unittest.TestCase):
             ]
         }
 
-        with self.assertRaises(ValueError):
+        with self.assertRaises(BatchFailedError):
             lambda_handler(
                 event=mock_event,
                 context=MockLambdaContext()
@@ -413,17 +1425,322 @@ class TestLambdaHandler(unittest.TestCase):
             response,
             {
                 'statusCode': 204,
-                'body': 'No records written due to no trains running'
+                'body': 'No records written due to no trains running',
+                'batchItemFailures': []
             }
         )
 
     @patch('lambdas.get_train_status.get_train_status.get_train_locations')
     def test_lambda_handler_no_route_object(self, mock_train_locations):
-        """Tests lambda_handler invocation if no route object is found in the locations response."""
+        """Tests lambda_handler raises if no route object is found in the locations response, since the only message
+            in the batch failed."""
         mock_train_locations.return_value = MOCK_TRAIN_LOCATION_NO_ROUTE_OBJECT
 
-        with self.assertRaises(KeyError):
+        with self.assertRaises(BatchFailedError):
             lambda_handler(
                 event=self.mock_event,
                 context=MockLambdaContext()
             )
+
+    @patch('lambdas.get_train_status.get_train_status.get_train_locations')
+    @patch('lambdas.get_train_status.get_train_status.write_train_location_data')
+    def test_lambda_handler_batched_message(self, mock_train_locations_write, mock_train_locations):
+        """Tests a batched message fetches all train lines with a single multi-route API request."""
+        mock_event = {
+            "Records": [
+                {
+                    "messageId": "id123",
+                    "body": json.dumps(
+                        {
+                            'train_lines': [
+                                {'train_line_abbrev': 'Red', 'train_line': 'Red'},
+                                {'train_line_abbrev': 'P', 'train_line': 'Purple'},
+                                {'train_line_abbrev': 'Pink', 'train_line': 'Pink'}
+                            ]
+                        }
+                    ),
+                    "eventSource": "aws:sqs"
+                }
+            ]
+        }
+        mock_train_locations.return_value = MOCK_TRAIN_LOCATION_MULTIPLE_ROUTES_RESPONSE
+
+        response = lambda_handler(
+            event=mock_event,
+            context=MockLambdaContext()
+        )
+
+        self.assertEqual(
+            response,
+            {
+                'statusCode': 200,
+                'body': 'Execution successful',
+                'batchItemFailures': []
+            }
+        )
+        mock_train_locations.assert_called_once_with(train_line_abbrev='Red,P,Pink')
+        written_data = mock_train_locations_write.call_args.kwargs['data_to_write']
+        self.assertEqual(
+            [record['train_id'].split('#', 1)[1] for record in written_data],
+            ['Red#801#1', 'Purple#110#5']
+        )
+
+    @patch('lambdas.get_train_status.get_train_status.get_train_locations')
+    @patch('lambdas.get_train_status.get_train_status.write_train_location_data')
+    def test_lambda_handler_per_line_requests(self, mock_train_locations_write, mock_train_locations):
+        """Tests lines are fetched with separate requests and written with one combined Firehose write."""
+        mock_event = {
+            "Records": [
+                {
+                    "messageId": "id123",
+                    "body": json.dumps(
+                        {
+                            'train_lines': [
+                                {'train_line_abbrev': 'Red', 'train_line': 'Red'},
+                                {'train_line_abbrev': 'P', 'train_line': 'Purple'}
+                            ]
+                        }
+                    ),
+                    "eventSource": "aws:sqs"
+                }
+            ]
+        }
+        mock_train_locations.return_value = MOCK_TRAIN_LOCATION_MULTIPLE_ROUTES_RESPONSE
+
+        with patch.dict(os.environ, {'MAX_ROUTES_PER_REQUEST': '1'}):
+            response = lambda_handler(
+                event=mock_event,
+                context=MockLambdaContext()
+            )
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(mock_train_locations.call_count, 2)
+        mock_train_locations.assert_any_call(train_line_abbrev='Red')
+        mock_train_locations.assert_any_call(train_line_abbrev='P')
+        mock_train_locations_write.assert_called_once()
+        written_data = mock_train_locations_write.call_args.kwargs['data_to_write']
+        self.assertEqual(len(written_data), 2)
+
+    @patch('lambdas.get_train_status.get_train_status.get_train_locations')
+    @patch('lambdas.get_train_status.get_train_status.write_train_location_data')
+    def test_lambda_handler_sqs_batch(self, mock_train_locations_write, mock_train_locations):
+        """Tests every record in an SQS batch is fetched and written with one Firehose write."""
+        mock_event = {
+            "Records": [
+                {"messageId": "id1", "body": "{\"train_line_abbrev\": \"Red\", \"train_line\": \"Red\"}"},
+                {"messageId": "id2", "body": "{\"train_line_abbrev\": \"P\", \"train_line\": \"Purple\"}"},
+                {"messageId": "id3", "body": "{\"train_line_abbrev\": \"P\", \"train_line\": \"Purple\"}"}
+            ]
+        }
+        mock_train_locations.return_value = MOCK_TRAIN_LOCATION_MULTIPLE_ROUTES_RESPONSE
+
+        response = lambda_handler(
+            event=mock_event,
+            context=MockLambdaContext()
+        )
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(response['batchItemFailures'], [])
+        mock_train_locations.assert_called_once_with(train_line_abbrev='Red,P')
+        mock_train_locations_write.assert_called_once()
+        self.assertEqual(len(mock_train_locations_write.call_args.kwargs['data_to_write']), 2)
+
+    @patch('lambdas.get_train_status.get_train_status.get_train_locations')
+    @patch('lambdas.get_train_status.get_train_status.write_train_location_data')
+    def test_lambda_handler_sqs_batch_partial_failure(self, mock_train_locations_write, mock_train_locations):
+        """Tests only the messages for lines that failed to fetch are reported as batch item failures."""
+        mock_event = {
+            "Records": [
+                {"messageId": "id1", "body": "{\"train_line_abbrev\": \"Red\", \"train_line\": \"Red\"}"},
+                {"messageId": "id2", "body": "{\"train_line_abbrev\": \"P\", \"train_line\": \"Purple\"}"},
+                {"messageId": "id3", "body": "not valid json"}
+            ]
+        }
+        def mock_response(train_line_abbrev):
+            if train_line_abbrev == 'P':
+                raise requests.exceptions.HTTPError('500 Server Error')
+            return MOCK_TRAIN_LOCATION_MULTIPLE_ROUTES_RESPONSE
+        mock_train_locations.side_effect = mock_response
+
+        with patch.dict(os.environ, {'MAX_ROUTES_PER_REQUEST': '1'}):
+            response = lambda_handler(
+                event=mock_event,
+                context=MockLambdaContext()
+            )
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(response['batchItemFailures'], [{'itemIdentifier': 'id2'}, {'itemIdentifier': 'id3'}])
+        written_data = mock_train_locations_write.call_args.kwargs['data_to_write']
+        self.assertEqual([record['train_id'].split('#')[1] for record in written_data], ['Red'])
+
+    @patch('lambdas.get_train_status.get_train_status.get_train_locations')
+    @patch('lambdas.get_train_status.get_train_status.write_train_location_data')
+    def test_lambda_handler_delta_mode(self, mock_train_locations_write, mock_train_locations):
+        """Tests unchanged trains are not written again on the next poll in delta mode."""
+        mock_train_locations.return_value = MOCK_TRAIN_LOCATION_RESPONSE
+
+        with patch.dict(os.environ, {'DELTA_MODE': 'true'}):
+            first_response = lambda_handler(event=self.mock_event, context=MockLambdaContext())
+            second_response = lambda_handler(event=self.mock_event, context=MockLambdaContext())
+
+        self.assertEqual(first_response['statusCode'], 200)
+        written_data = mock_train_locations_write.call_args.kwargs['data_to_write']
+        self.assertEqual([record['record_type'] for record in written_data], ['keyframe'])
+        self.assertEqual(
+            second_response,
+            {
+                'statusCode': 204,
+                'body': 'No records written due to no train changes',
+                'batchItemFailures': []
+            }
+        )
+        mock_train_locations_write.assert_called_once()
+        self.assertIn('Purple', get_state_cache('delta').state)
+
+    @patch('lambdas.get_train_status.get_train_status.get_train_locations')
+    @patch('lambdas.get_train_status.get_train_status.write_train_location_data')
+    @patch('lambdas.get_train_status.get_train_status.get_poll_ticks')
+    @patch('lambdas.get_train_status.get_train_status.time.sleep')
+    def test_lambda_handler_sub_minute_polling(self, mock_sleep, mock_get_poll_ticks, mock_train_locations_write,
+                                               mock_train_locations):
+        """Tests the rows of every poll within the minute are buffered into a single write."""
+        now = datetime.datetime.now(zoneinfo.ZoneInfo('America/Chicago'))
+        mock_get_poll_ticks.return_value = [
+            now - datetime.timedelta(seconds=20),
+            now,
+            now + datetime.timedelta(hours=1)
+        ]
+        mock_train_locations.side_effect = [
+            MOCK_TRAIN_LOCATION_RESPONSE,
+            requests.exceptions.HTTPError('500 Server Error'),
+            MOCK_TRAIN_LOCATION_RESPONSE
+        ]
+
+        with patch.dict(os.environ, {'POLL_INTERVAL_SECONDS': '20'}):
+            response = lambda_handler(event=self.mock_event, context=MockLambdaContext())
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(response['batchItemFailures'], [])
+        self.assertEqual(mock_train_locations.call_count, 3)
+        mock_sleep.assert_called_once()
+        self.assertGreater(mock_sleep.call_args.args[0], 3500)
+        mock_get_poll_ticks.assert_called_once()
+        self.assertEqual(mock_get_poll_ticks.call_args.kwargs['interval_seconds'], 20)
+        mock_train_locations_write.assert_called_once()
+        self.assertEqual(len(mock_train_locations_write.call_args.kwargs['data_to_write']), 2)
+
+    @patch('lambdas.get_train_status.get_train_status.get_train_locations')
+    @patch('lambdas.get_train_status.get_train_status.write_train_location_data')
+    @patch('lambdas.get_train_status.get_train_status.get_poll_ticks')
+    @patch('lambdas.get_train_status.get_train_status.time.sleep')
+    def test_lambda_handler_polling_stops_before_timeout(self, mock_sleep, mock_get_poll_ticks,
+                                                         mock_train_locations_write, mock_train_locations):
+        """Tests the remaining polls are skipped when waiting for them would not leave time for the write."""
+        now = datetime.datetime.now(zoneinfo.ZoneInfo('America/Chicago'))
+        mock_get_poll_ticks.return_value = [now, now + datetime.timedelta(seconds=20)]
+        mock_train_locations.return_value = MOCK_TRAIN_LOCATION_RESPONSE
+        context = MockLambdaContext()
+        context.get_remaining_time_in_millis = lambda: 10000
+
+        response = lambda_handler(event=self.mock_event, context=context)
+
+        self.assertEqual(response['statusCode'], 200)
+        mock_train_locations.assert_called_once()
+        mock_sleep.assert_not_called()
+        self.assertEqual(len(mock_train_locations_write.call_args.kwargs['data_to_write']), 1)
+
+    @patch('lambdas.get_train_status.get_train_status.get_train_locations')
+    @patch('lambdas.get_train_status.get_train_status.write_train_location_data')
+    @patch('lambdas.get_train_status.get_train_status.get_poll_ticks')
+    def test_lambda_handler_all_polls_failed(self, mock_get_poll_ticks, mock_train_locations_write,
+                                             mock_train_locations):
+        """Tests lambda_handler raises when every poll of the batch's line failed."""
+        now = datetime.datetime.now(zoneinfo.ZoneInfo('America/Chicago'))
+        mock_get_poll_ticks.return_value = [now - datetime.timedelta(seconds=20), now]
+        mock_train_locations.side_effect = requests.exceptions.HTTPError('500 Server Error')
+
+        with self.assertRaises(BatchFailedError):
+            lambda_handler(event=self.mock_event, context=MockLambdaContext())
+
+        mock_train_locations_write.assert_not_called()
+
+    @patch('lambdas.get_train_status.get_train_status.get_train_locations')
+    @patch('lambdas.get_train_status.get_train_status.write_train_location_data')
+    def test_lambda_handler_batched_message_line_failed(self, mock_train_locations_write, mock_train_locations):
+        """Tests the rows of the lines that were retrieved are written before raising when a batched message covering
+            a failed line is the only message in the batch."""
+        mock_event = {
+            "Records": [
+                {
+                    "messageId": "id123",
+                    "body": json.dumps(
+                        {
+                            'train_lines': [
+                                {'train_line_abbrev': 'Red', 'train_line': 'Red'},
+                                {'train_line_abbrev': 'P', 'train_line': 'Purple'}
+                            ]
+                        }
+                    )
+                }
+            ]
+        }
+        def mock_response(train_line_abbrev):
+            if train_line_abbrev == 'P':
+                raise requests.exceptions.HTTPError('500 Server Error')
+            return MOCK_TRAIN_LOCATION_MULTIPLE_ROUTES_RESPONSE
+        mock_train_locations.side_effect = mock_response
+
+        with patch.dict(os.environ, {'MAX_ROUTES_PER_REQUEST': '1'}):
+            with self.assertRaises(BatchFailedError):
+                lambda_handler(event=mock_event, context=MockLambdaContext())
+
+        written_data = mock_train_locations_write.call_args.kwargs['data_to_write']
+        self.assertEqual([record['train_id'].split('#')[1] for record in written_data], ['Red'])
+
+    @patch('lambdas.get_train_status.get_train_status.get_train_locations')
+    @patch('lambdas.get_train_status.get_train_status.write_train_location_data')
+    def test_lambda_handler_failed_lines_not_reported_as_no_trains(self, mock_train_locations_write,
+                                                                    mock_train_locations):
+        """Tests a batch with a failed line and nothing to write reports the failure rather than no trains running."""
+        mock_event = {
+            "Records": [
+                {"messageId": "id1", "body": "{\"train_line_abbrev\": \"Red\", \"train_line\": \"Red\"}"},
+                {"messageId": "id2", "body": "{\"train_line_abbrev\": \"P\", \"train_line\": \"Purple\"}"}
+            ]
+        }
+        def mock_response(train_line_abbrev):
+            if train_line_abbrev == 'P':
+                raise requests.exceptions.HTTPError('500 Server Error')
+            return MOCK_TRAIN_LOCATION_NO_TRAINS_RESPONSE
+        mock_train_locations.side_effect = mock_response
+
+        with patch.dict(os.environ, {'MAX_ROUTES_PER_REQUEST': '1'}):
+            response = lambda_handler(event=mock_event, context=MockLambdaContext())
+
+        self.assertEqual(
+            response,
+            {
+                'statusCode': 204,
+                'body': 'No records written due to failed train lines',
+                'batchItemFailures': [{'itemIdentifier': 'id2'}]
+            }
+        )
+        mock_train_locations_write.assert_not_called()
+
+    @patch('lambdas.get_train_status.get_train_status.get_train_locations')
+    @patch('lambdas.get_train_status.get_train_status.write_train_location_data')
+    @patch('lambdas.get_train_status.get_train_status.record_line_activity')
+    def test_lambda_handler_records_line_activity(self, mock_record_line_activity, mock_train_locations_write,
+                                                  mock_train_locations):
+        """Tests the number of trains running on each line is recorded when LINE_ACTIVITY_BUCKET is set."""
+        mock_train_locations.return_value = MOCK_TRAIN_LOCATION_RESPONSE
+
+        lambda_handler(event=self.mock_event, context=MockLambdaContext())
+        mock_record_line_activity.assert_not_called()
+        with patch.dict(os.environ, {'LINE_ACTIVITY_BUCKET': 'test-bucket'}):
+            lambda_handler(event=self.mock_event, context=MockLambdaContext())
+
+        mock_record_line_activity.assert_called_once()
+        self.assertEqual(mock_record_line_activity.call_args.kwargs['trains_running'], {'Purple': 1})
+        self.assertEqual(mock_record_line_activity.call_args.kwargs['store'].prefix, 'state/line_activity/')
+
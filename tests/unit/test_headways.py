@@ -0,0 +1,97 @@
+"""Module for unit testing of the headway computation and rollup."""
+import unittest
+import datetime
+import zoneinfo
+
+import pyarrow as pa
+
+from analytics.headways import compute_headways, rollup_headways, get_headway_rollup_schema, HEADWAYS_SCHEMA
+from analytics.trip_events import TRIP_EVENTS_SCHEMA
+
+TIMEZONE = zoneinfo.ZoneInfo('America/Chicago')
+
+
+def event(run_number, station, hour, minute, direction='1', train_line='Red'):
+    """Returns a trip event row for a run arriving at a station at hour:minute on the test day."""
+    return {
+        'train_id': f'2025-06-20#{train_line}#{run_number}#{direction}',
+        'train_line': train_line,
+        'run_number': run_number,
+        'direction': direction,
+        'station': station,
+        'arrival_time': datetime.datetime(2025, 6, 20, hour, minute, tzinfo=TIMEZONE)
+    }
+
+
+def events_table(rows):
+    """Returns the rows as a TRIP_EVENTS_SCHEMA table."""
+    return pa.Table.from_pylist(rows, schema=TRIP_EVENTS_SCHEMA)
+
+
+class TestComputeHeadways(unittest.TestCase):
+    """Class for testing the compute_headways function."""
+
+    def test_headways_partitioned_by_station_line_and_direction(self):
+        """Test headways are the gaps between consecutive arrivals within each station, line and direction, and the
+            first arrival of each partition has no headway."""
+        rows = [
+            event('803', 'Belmont', 10, 9),
+            event('801', 'Belmont', 10, 0),
+            event('802', 'Belmont', 10, 1),
+            event('901', 'Belmont', 10, 2, direction='5'),
+            event('802', 'Addison', 10, 3),
+            event('401', 'Belmont', 10, 4, train_line='Brown')
+        ]
+
+        headways = compute_headways(events_table(rows), bunching_threshold_seconds=120, gap_threshold_seconds=300)
+
+        self.assertEqual(headways.schema, HEADWAYS_SCHEMA)
+        self.assertEqual(
+            [
+                (row['station'], row['previous_train_id'], row['train_id'], row['headway_seconds'],
+                 row['is_bunched'], row['is_gap'])
+                for row in headways.to_pylist()
+            ],
+            [
+                ('Belmont', '2025-06-20#Red#801#1', '2025-06-20#Red#802#1', 60.0, True, False),
+                ('Belmont', '2025-06-20#Red#802#1', '2025-06-20#Red#803#1', 480.0, False, True)
+            ]
+        )
+        self.assertEqual(headways['hour'][0].as_py(), datetime.datetime(2025, 6, 20, 10, tzinfo=TIMEZONE))
+
+    def test_events_without_arrival_ignored(self):
+        """Test events without an arrival time are ignored and too few events yield an empty table."""
+        rows = [event('801', 'Belmont', 10, 0), {**event('802', 'Belmont', 10, 5), 'arrival_time': None}]
+
+        self.assertEqual(compute_headways(events_table(rows)).num_rows, 0)
+        self.assertEqual(compute_headways(TRIP_EVENTS_SCHEMA.empty_table()), HEADWAYS_SCHEMA.empty_table())
+
+
+class TestRollupHeadways(unittest.TestCase):
+    """Class for testing the rollup_headways function."""
+
+    def test_hourly_percentiles(self):
+        """Test headways are aggregated per station, line, direction and hour with interpolated percentiles."""
+        rows = [event(str(800 + index), 'Belmont', 10, minute) for index, minute in enumerate([0, 1, 5, 15, 35])]
+        rows += [event('810', 'Belmont', 11, 5), event('811', 'Belmont', 11, 10)]
+        headways = compute_headways(events_table(rows), bunching_threshold_seconds=120, gap_threshold_seconds=900)
+
+        rollup = rollup_headways(headways, percentiles=(50, 90))
+
+        self.assertEqual(rollup.schema, get_headway_rollup_schema((50, 90)))
+        self.assertEqual(
+            [
+                (row['hour'].hour, row['headway_count'], row['bunched_count'], row['gap_count'],
+                 row['min_headway_seconds'], row['mean_headway_seconds'], row['max_headway_seconds'],
+                 round(row['p50_headway_seconds'], 6), round(row['p90_headway_seconds'], 6))
+                for row in rollup.to_pylist()
+            ],
+            [
+                (10, 4, 1, 1, 60.0, 525.0, 1200.0, 420.0, 1020.0),
+                (11, 2, 0, 1, 300.0, 1050.0, 1800.0, 1050.0, 1650.0)
+            ]
+        )
+
+    def test_empty_rollup(self):
+        """Test an empty headways table yields an empty rollup."""
+        self.assertEqual(rollup_headways(HEADWAYS_SCHEMA.empty_table()), get_headway_rollup_schema().empty_table())
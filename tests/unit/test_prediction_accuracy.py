@@ -0,0 +1,179 @@
+"""Module for unit testing of the prediction accuracy analysis."""
+import unittest
+import datetime
+import zoneinfo
+
+import pyarrow as pa
+
+from analytics.prediction_accuracy import get_predictions, match_predictions_to_arrivals, \
+    summarize_prediction_errors, get_prediction_accuracy_schema, PREDICTIONS_SCHEMA, PREDICTION_ERRORS_SCHEMA
+from analytics.trip_events import TRIP_EVENTS_SCHEMA
+from lambdas.bucket_raw_data.bucket_raw_data import PROCESSED_SCHEMA
+
+TIMEZONE = zoneinfo.ZoneInfo('America/Chicago')
+
+
+def timestamp(minute, second=0):
+    """Returns a timestamp on the test day at 10:minute:second Chicago time."""
+    return datetime.datetime(2025, 6, 20, 10, minute, second, tzinfo=TIMEZONE)
+
+
+def prediction(train_id, station, generated_minute, predicted_minute):
+    """Returns a PREDICTIONS_SCHEMA row."""
+    return {
+        'train_id': train_id,
+        'station': station,
+        'prediction_generated_time': timestamp(generated_minute),
+        'predicted_arrival_time': timestamp(predicted_minute)
+    }
+
+
+def arrival(train_id, station, minute, second=0):
+    """Returns a trip event row with only the columns used by the join."""
+    return {'train_id': train_id, 'station': station, 'arrival_time': timestamp(minute, second)}
+
+
+def match(predictions, arrivals, **kwargs):
+    """Returns the matched prediction errors as (train_id, station, generated minute, observed time, error) tuples."""
+    errors = match_predictions_to_arrivals(
+        predictions=pa.Table.from_pylist(predictions, schema=PREDICTIONS_SCHEMA),
+        events=pa.Table.from_pylist(arrivals, schema=TRIP_EVENTS_SCHEMA),
+        **kwargs
+    )
+    return [
+        (row['train_id'], row['station'], row['prediction_generated_time'].minute, row['observed_arrival_time'],
+         row['error_seconds'])
+        for row in errors.to_pylist()
+    ]
+
+
+class TestGetPredictions(unittest.TestCase):
+    """Class for testing the get_predictions function."""
+
+    def test_get_predictions(self):
+        """Test rows without a prediction and rows filled in from delta records are skipped."""
+        row = {
+            'train_id': 'd#Red#801#1',
+            'current_timestamp': timestamp(0),
+            'prediction_generated_timestamp': timestamp(0),
+            'next_station': 'Howard',
+            'next_station_arrival_time': timestamp(2)
+        }
+        snapshots = pa.Table.from_pylist(
+            [
+                row,
+                {**row, 'record_type': 'keyframe'},
+                {**row, 'record_type': 'filled'},
+                {**row, 'next_station_arrival_time': None},
+                {**row, 'next_station': None}
+            ],
+            schema=PROCESSED_SCHEMA
+        )
+
+        predictions = get_predictions(snapshots)
+
+        self.assertEqual(predictions.schema, PREDICTIONS_SCHEMA)
+        self.assertEqual(predictions.num_rows, 2)
+
+
+class TestMatchPredictionsToArrivals(unittest.TestCase):
+    """Class for testing the match_predictions_to_arrivals function."""
+
+    def test_as_of_match(self):
+        """Test each prediction is matched to the first arrival of the same train and station at or after it was
+            generated, including an arrival at the same time."""
+        predictions = [
+            prediction('d#Brown#401#1', 'Clark/Lake', 0, 3),
+            prediction('d#Brown#401#1', 'Clark/Lake', 10, 11),
+            prediction('d#Brown#401#1', 'State/Lake', 4, 5),
+            prediction('d#Brown#402#1', 'Clark/Lake', 12, 12)
+        ]
+        arrivals = [
+            arrival('d#Brown#401#1', 'Clark/Lake', 12),
+            arrival('d#Brown#401#1', 'Clark/Lake', 2, 30),
+            arrival('d#Brown#401#1', 'State/Lake', 6),
+            arrival('d#Brown#402#1', 'Clark/Lake', 12)
+        ]
+
+        self.assertEqual(
+            sorted(match(predictions, arrivals)),
+            [
+                ('d#Brown#401#1', 'Clark/Lake', 0, timestamp(2, 30), -30.0),
+                ('d#Brown#401#1', 'Clark/Lake', 10, timestamp(12), 60.0),
+                ('d#Brown#401#1', 'State/Lake', 4, timestamp(6), 60.0),
+                ('d#Brown#402#1', 'Clark/Lake', 12, timestamp(12), 0.0)
+            ]
+        )
+
+    def test_unmatched_predictions_dropped(self):
+        """Test predictions without a later arrival of the same train and station, or whose arrival is outside the
+            match window, are dropped."""
+        predictions = [
+            prediction('d#Red#801#1', 'Howard', 5, 6),
+            prediction('d#Red#801#1', 'Jarvis', 0, 1),
+            prediction('d#Red#802#1', 'Morse', 0, 1)
+        ]
+        arrivals = [
+            arrival('d#Red#801#1', 'Howard', 4),
+            arrival('d#Red#801#1', 'Jarvis', 30),
+            arrival('d#Red#803#1', 'Morse', 1)
+        ]
+
+        self.assertEqual(match(predictions, arrivals, max_match_seconds=600), [])
+        self.assertEqual(len(match(predictions, arrivals, max_match_seconds=3600)), 1)
+
+    def test_empty_inputs(self):
+        """Test empty predictions or arrivals yield an empty table."""
+        self.assertEqual(match([], [arrival('d#Red#801#1', 'Howard', 4)]), [])
+        self.assertEqual(
+            match_predictions_to_arrivals(PREDICTIONS_SCHEMA.empty_table(), TRIP_EVENTS_SCHEMA.empty_table()),
+            PREDICTION_ERRORS_SCHEMA.empty_table()
+        )
+
+
+class TestSummarizePredictionErrors(unittest.TestCase):
+    """Class for testing the summarize_prediction_errors function."""
+
+    def test_summary_by_line_station_and_horizon(self):
+        """Test errors are grouped by train line, station and horizon bucket."""
+        predictions = [
+            prediction('d#Red#801#1', 'Howard', 0, 1),
+            prediction('d#Red#802#1', 'Howard', 10, 11),
+            prediction('d#Red#803#1', 'Howard', 20, 21),
+            prediction('d#Red#804#1', 'Howard', 30, 38),
+            prediction('d#Blue#101#1', 'Howard', 0, 1)
+        ]
+        arrivals = [
+            arrival('d#Red#801#1', 'Howard', 2),
+            arrival('d#Red#802#1', 'Howard', 10, 30),
+            arrival('d#Red#803#1', 'Howard', 22),
+            arrival('d#Red#804#1', 'Howard', 38),
+            arrival('d#Blue#101#1', 'Howard', 1)
+        ]
+        errors = match_predictions_to_arrivals(
+            predictions=pa.Table.from_pylist(predictions, schema=PREDICTIONS_SCHEMA),
+            events=pa.Table.from_pylist(arrivals, schema=TRIP_EVENTS_SCHEMA)
+        )
+
+        summary = summarize_prediction_errors(errors, percentiles=(50,))
+
+        self.assertEqual(summary.schema, get_prediction_accuracy_schema((50,)))
+        self.assertEqual(
+            sorted(
+                (row['train_line'], row['horizon_bucket'], row['prediction_count'], row['mean_error_seconds'],
+                 row['mean_absolute_error_seconds'], row['p50_error_seconds'])
+                for row in summary.to_pylist()
+            ),
+            [
+                ('Blue', '1-2m', 1, 0.0, 0.0, 0.0),
+                ('Red', '1-2m', 3, 30.0, 50.0, 60.0),
+                ('Red', '5-10m', 1, 0.0, 0.0, 0.0)
+            ]
+        )
+
+    def test_empty_summary(self):
+        """Test an empty errors table yields an empty summary."""
+        self.assertEqual(
+            summarize_prediction_errors(PREDICTION_ERRORS_SCHEMA.empty_table()),
+            get_prediction_accuracy_schema().empty_table()
+        )
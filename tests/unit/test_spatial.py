@@ -0,0 +1,223 @@
+"""Module for unit testing of the spatial index and segment speeds."""
+import unittest
+import datetime
+import zoneinfo
+
+import numpy as np
+import pyarrow as pa
+
+from analytics.spatial import get_positions, estimate_station_locations, derive_segments, SegmentGridIndex, \
+    compute_segment_observations, summarize_segment_speeds, get_segment_speeds_schema, SEGMENTS_SCHEMA, \
+    SEGMENT_OBSERVATIONS_SCHEMA
+from lambdas.bucket_raw_data.bucket_raw_data import PROCESSED_SCHEMA
+
+TIMEZONE = zoneinfo.ZoneInfo('America/Chicago')
+# Roughly 1 km of latitude, so stations along the test track are 1 km apart
+KILOMETER_LATITUDE = 0.009
+
+
+def position(train_id, minute, kilometers, next_station_id, longitude=-87.63, record_type=None):
+    """Returns a processed snapshot of a train on a north-south track, kilometers north of the first station."""
+    return {
+        'train_id': train_id,
+        'current_timestamp': datetime.datetime(2025, 6, 20, 10, minute, tzinfo=TIMEZONE),
+        'next_station': f'Station {next_station_id}',
+        'next_station_id': next_station_id,
+        'latitude': 41.8 + kilometers * KILOMETER_LATITUDE,
+        'longitude': longitude,
+        'record_type': record_type
+    }
+
+
+def positions_table(rows):
+    """Returns the rows as a PROCESSED_SCHEMA table sorted as get_positions returns it."""
+    return get_positions(pa.Table.from_pylist(rows, schema=PROCESSED_SCHEMA))
+
+
+def run_rows(train_id, kilometers_per_minute, minutes, start_kilometers=0.0):
+    """Returns the positions of a northbound run through stations every kilometer, reported every minute."""
+    rows = []
+    for minute in range(minutes):
+        kilometers = start_kilometers + minute * kilometers_per_minute
+        rows.append(position(train_id, minute, kilometers, str(40000 + int(np.floor(kilometers)) + 1)))
+    return rows
+
+
+def segments_table(rows):
+    """Returns SEGMENTS_SCHEMA rows of (from kilometers, to kilometers) along the test track."""
+    return pa.Table.from_pylist(
+        [
+            {
+                'segment_id': segment_id,
+                'from_station_id': str(40000 + int(start)),
+                'to_station_id': str(40000 + int(end)),
+                'from_latitude': 41.8 + start * KILOMETER_LATITUDE,
+                'from_longitude': -87.63,
+                'to_latitude': 41.8 + end * KILOMETER_LATITUDE,
+                'to_longitude': -87.63
+            }
+            for segment_id, (start, end) in enumerate(rows)
+        ],
+        schema=SEGMENTS_SCHEMA
+    )
+
+
+class TestGetPositions(unittest.TestCase):
+    """Class for testing the get_positions function."""
+
+    def test_get_positions(self):
+        """Test rows without a position and rows filled in from delta records are dropped, and rows are sorted."""
+        rows = [
+            position('d#Red#802#1', 0, 0.0, '40001'),
+            position('d#Red#801#1', 1, 0.5, '40001'),
+            position('d#Red#801#1', 0, 0.0, '40001'),
+            position('d#Red#801#1', 2, 0.5, '40001', record_type='filled'),
+            {**position('d#Red#801#1', 3, 0.5, '40001'), 'latitude': None}
+        ]
+
+        positions = positions_table(rows)
+
+        self.assertEqual(
+            [(row['train_id'], row['current_timestamp'].minute) for row in positions.to_pylist()],
+            [('d#Red#801#1', 0), ('d#Red#801#1', 1), ('d#Red#802#1', 0)]
+        )
+
+
+class TestStationsAndSegments(unittest.TestCase):
+    """Class for testing the estimate_station_locations and derive_segments functions."""
+
+    def test_stations_and_segments(self):
+        """Test stations are located where runs passed them and segments join consecutive stations, shared by both
+            directions."""
+        rows = run_rows('d#Red#801#1', kilometers_per_minute=0.4, minutes=8, start_kilometers=0.2)
+        # A southbound run between the same stations adds no new segment
+        rows += [
+            position('d#Red#901#5', 0, 2.2, '40002'),
+            position('d#Red#901#5', 1, 1.8, '40001')
+        ]
+        positions = positions_table(rows)
+
+        stations = estimate_station_locations(positions)
+        segments = derive_segments(positions, stations)
+
+        self.assertEqual(stations.column('station_id').to_pylist(), ['40001', '40002', '40003'])
+        self.assertEqual(stations.column('observation_count').to_pylist(), [1, 2, 1])
+        # Each pass is placed midway between the positions reported before and after it
+        np.testing.assert_allclose(
+            stations.column('latitude').to_numpy(),
+            [41.8 + kilometers * KILOMETER_LATITUDE for kilometers in (0.8, 2.0, 2.8)]
+        )
+        self.assertEqual(
+            [(row['from_station_id'], row['to_station_id']) for row in segments.to_pylist()],
+            [('40001', '40002'), ('40002', '40003')]
+        )
+        self.assertEqual(segments.column('segment_id').to_pylist(), [0, 1])
+        np.testing.assert_allclose(segments.column('length_meters').to_numpy(), [1200.9, 800.6], rtol=1e-3)
+
+    def test_no_station_passes(self):
+        """Test positions without a station pass yield no stations or segments."""
+        positions = positions_table([position('d#Red#801#1', 0, 0.0, '40001')])
+
+        stations = estimate_station_locations(positions)
+
+        self.assertEqual(stations.num_rows, 0)
+        self.assertEqual(derive_segments(positions, stations), SEGMENTS_SCHEMA.empty_table())
+
+
+class TestSegmentGridIndex(unittest.TestCase):
+    """Class for testing the SegmentGridIndex class."""
+
+    def test_snap(self):
+        """Test positions snap to the nearest segment within the snapping distance, with the fraction along it."""
+        index = SegmentGridIndex(segments_table([(0, 1), (1, 2), (5, 6)]), cell_meters=250, max_distance_meters=100)
+        latitude = np.array([41.8 + 0.25 * KILOMETER_LATITUDE, 41.8 + 1.5 * KILOMETER_LATITUDE, 41.8 + 3.5 *
+                             KILOMETER_LATITUDE, 41.8 + 5.5 * KILOMETER_LATITUDE, np.nan])
+        longitude = np.array([-87.63, -87.6305, -87.63, -87.64, -87.63])
+
+        segment_ids, distances, fractions = index.snap(latitude, longitude)
+
+        self.assertEqual(segment_ids.tolist(), [0, 1, -1, -1, -1])
+        np.testing.assert_allclose(distances[:2], [0.0, 41.5], atol=0.1)
+        np.testing.assert_allclose(fractions[:2], [0.25, 0.5], atol=1e-3)
+
+    def test_snap_matches_brute_force(self):
+        """Test snapping random positions with the grid gives the same segments as checking every segment."""
+        rng = np.random.default_rng(0)
+        segments = segments_table([(start, start + 1) for start in range(10)])
+        index = SegmentGridIndex(segments, cell_meters=200, max_distance_meters=300)
+        latitude = 41.8 + rng.uniform(-1, 11, 2000) * KILOMETER_LATITUDE
+        longitude = -87.63 + rng.uniform(-0.005, 0.005, 2000)
+
+        segment_ids, distances, _ = index.snap(latitude, longitude)
+
+        x, y = index.to_local_meters(latitude, longitude)
+        fraction = np.clip(
+            ((x[:, None] - index.from_x) * index.delta_x + (y[:, None] - index.from_y) * index.delta_y) /
+            index.length_squared,
+            0,
+            1
+        )
+        all_distances = np.hypot(
+            x[:, None] - index.from_x - fraction * index.delta_x,
+            y[:, None] - index.from_y - fraction * index.delta_y
+        )
+        expected = np.where(all_distances.min(axis=1) <= 300, all_distances.argmin(axis=1), -1)
+        self.assertEqual(segment_ids.tolist(), expected.tolist())
+        np.testing.assert_allclose(distances[expected >= 0], all_distances.min(axis=1)[expected >= 0])
+
+    def test_empty_index(self):
+        """Test an index without segments snaps nothing."""
+        index = SegmentGridIndex(SEGMENTS_SCHEMA.empty_table())
+
+        segment_ids, _, _ = index.snap(np.array([41.8]), np.array([-87.63]))
+
+        self.assertEqual(segment_ids.tolist(), [-1])
+
+
+class TestSegmentSpeeds(unittest.TestCase):
+    """Class for testing the compute_segment_observations and summarize_segment_speeds functions."""
+
+    def test_segment_speeds(self):
+        """Test consecutive positions of a run give speeds attributed to the segment of their midpoint, skipping
+            pairs of different runs, pairs too far apart in time and pairs off the track."""
+        index = SegmentGridIndex(segments_table([(0, 1), (1, 2)]), max_distance_meters=100)
+        rows = [
+            position('d#Red#801#1', 0, 0.1, '40001'),
+            position('d#Red#801#1', 1, 0.4, '40001'),
+            position('d#Red#801#1', 2, 1.0, '40002'),
+            position('d#Red#801#1', 3, 1.6, '40002'),
+            position('d#Red#801#1', 9, 1.9, '40002'),
+            position('d#Red#802#1', 0, 0.2, '40001'),
+            position('d#Red#802#1', 1, 0.2, '40001', longitude=-87.6),
+            position('d#Red#802#1', 2, 0.2, '40001', longitude=-87.6)
+        ]
+
+        observations = compute_segment_observations(positions_table(rows), index, max_gap_seconds=180)
+        summary = summarize_segment_speeds(observations, percentiles=(50,))
+
+        self.assertEqual(observations.schema, SEGMENT_OBSERVATIONS_SCHEMA)
+        self.assertEqual(
+            [
+                (row['train_id'], row['segment_id'], row['start_time'].minute, round(row['distance_meters']))
+                for row in observations.to_pylist()
+            ],
+            [('d#Red#801#1', 0, 0, 300), ('d#Red#801#1', 0, 1, 600), ('d#Red#801#1', 1, 2, 600)]
+        )
+        self.assertEqual(summary.schema, get_segment_speeds_schema((50,)))
+        self.assertEqual(
+            [
+                (row['segment_id'], row['train_line'], row['direction'], row['observation_count'],
+                 round(row['mean_speed_meters_per_second'], 1), round(row['p50_speed_meters_per_second'], 1))
+                for row in summary.to_pylist()
+            ],
+            [(0, 'Red', '1', 2, 7.5, 7.5), (1, 'Red', '1', 1, 10.0, 10.0)]
+        )
+
+    def test_empty_observations(self):
+        """Test too few positions yield no observations and an empty summary."""
+        index = SegmentGridIndex(segments_table([(0, 1)]))
+
+        observations = compute_segment_observations(positions_table([position('d#Red#801#1', 0, 0.1, '40001')]), index)
+
+        self.assertEqual(observations, SEGMENT_OBSERVATIONS_SCHEMA.empty_table())
+        self.assertEqual(summarize_segment_speeds(observations), get_segment_speeds_schema().empty_table())
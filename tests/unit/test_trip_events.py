@@ -0,0 +1,150 @@
+"""Module for unit testing of the trip event reconstruction over processed snapshots."""
+import unittest
+import datetime
+import zoneinfo
+
+import pyarrow as pa
+
+from analytics.trip_events import derive_trip_events, split_train_ids, TRIP_EVENTS_SCHEMA
+from lambdas.bucket_raw_data.bucket_raw_data import PROCESSED_SCHEMA
+
+TIMEZONE = zoneinfo.ZoneInfo('America/Chicago')
+
+
+def timestamp(minute, second=0):
+    """Returns a timestamp on the test day at 10:minute:second Chicago time."""
+    return datetime.datetime(2025, 6, 20, 10, minute, second, tzinfo=TIMEZONE)
+
+
+def snapshot(train_id, minute, next_station, arrival_time=None, is_approaching_station=False):
+    """Returns a processed snapshot row for a train at 10:minute."""
+    return {
+        'train_id': train_id,
+        'current_timestamp': timestamp(minute),
+        'prediction_generated_timestamp': timestamp(minute),
+        'destination_station': 'Forest Park',
+        'next_station': next_station,
+        'next_station_arrival_time': arrival_time,
+        'is_approaching_station': is_approaching_station,
+        'is_train_delayed': False,
+        'record_type': None
+    }
+
+
+def snapshots_table(rows):
+    """Returns the rows as a PROCESSED_SCHEMA table."""
+    return pa.Table.from_pylist(rows, schema=PROCESSED_SCHEMA)
+
+
+class TestDeriveTripEvents(unittest.TestCase):
+    """Class for testing the derive_trip_events function."""
+
+    def test_events_from_station_transitions(self):
+        """Test each station passed by a run becomes an event with its arrival, approach and departure times."""
+        rows = [
+            snapshot('d#Blue#101#1', 0, 'Clark/Lake', timestamp(1, 30)),
+            snapshot('d#Blue#101#1', 1, 'Clark/Lake', timestamp(1, 30), is_approaching_station=True),
+            snapshot('d#Blue#101#1', 2, 'Washington', timestamp(4)),
+            snapshot('d#Blue#101#1', 3, 'Washington', timestamp(5)),
+            snapshot('d#Blue#101#1', 4, 'Monroe')
+        ]
+
+        events = derive_trip_events(snapshots_table(rows)).to_pylist()
+
+        self.assertEqual(
+            [(event['station'], event['following_station']) for event in events],
+            [('Clark/Lake', 'Washington'), ('Washington', 'Monroe')]
+        )
+        self.assertEqual(events[0]['train_line'], 'Blue')
+        self.assertEqual(events[0]['run_number'], '101')
+        self.assertEqual(events[0]['direction'], '1')
+        self.assertEqual(events[0]['first_seen_time'], timestamp(0))
+        self.assertEqual(events[0]['approach_time'], timestamp(1))
+        self.assertEqual(events[0]['arrival_time'], timestamp(1, 30))
+        self.assertEqual(events[0]['departure_time'], timestamp(2))
+        self.assertEqual(events[0]['observation_gap_seconds'], 60.0)
+        self.assertIsNone(events[1]['approach_time'])
+        self.assertEqual(events[1]['arrival_time'], timestamp(4))
+
+    def test_arrival_time_clamped_to_observation_window(self):
+        """Test a prediction outside the window between the last and next snapshots is clamped to the window, and a
+            missing prediction falls back to the end of the window."""
+        rows = [
+            snapshot('d#Red#801#5', 1, 'Howard', timestamp(0, 30)),
+            snapshot('d#Red#801#5', 2, 'Jarvis', timestamp(9)),
+            snapshot('d#Red#801#5', 3, 'Morse'),
+            snapshot('d#Red#801#5', 4, 'Loyola')
+        ]
+
+        events = derive_trip_events(snapshots_table(rows)).to_pylist()
+
+        self.assertEqual(
+            [event['arrival_time'] for event in events],
+            [timestamp(1), timestamp(3), timestamp(4)]
+        )
+
+    def test_runs_are_not_joined(self):
+        """Test the last station of one run is not turned into an event by the first snapshot of another run, and
+            unsorted input is ordered by run and time."""
+        rows = [
+            snapshot('d#Red#802#1', 1, 'Belmont'),
+            snapshot('d#Red#801#1', 1, 'Addison'),
+            snapshot('d#Red#802#1', 0, 'Fullerton'),
+            snapshot('d#Red#801#1', 0, 'Sheridan')
+        ]
+
+        events = derive_trip_events(snapshots_table(rows)).to_pylist()
+
+        self.assertEqual(
+            [(event['train_id'], event['station']) for event in events],
+            [('d#Red#801#1', 'Sheridan'), ('d#Red#802#1', 'Fullerton')]
+        )
+
+    def test_revisited_station_is_separate_event(self):
+        """Test a run heading to the same station twice, such as around the Loop, yields an event for each visit."""
+        rows = [
+            snapshot('d#Brown#401#1', 0, 'Clark/Lake'),
+            snapshot('d#Brown#401#1', 1, 'State/Lake'),
+            snapshot('d#Brown#401#1', 2, 'Clark/Lake'),
+            snapshot('d#Brown#401#1', 3, 'Merchandise Mart')
+        ]
+
+        events = derive_trip_events(snapshots_table(rows)).to_pylist()
+
+        self.assertEqual(
+            [event['station'] for event in events],
+            ['Clark/Lake', 'State/Lake', 'Clark/Lake']
+        )
+
+    def test_rows_without_next_station_ignored(self):
+        """Test snapshots without a next station neither create nor split events."""
+        rows = [
+            snapshot('d#Pink#301#1', 0, 'Damen'),
+            snapshot('d#Pink#301#1', 1, None),
+            snapshot('d#Pink#301#1', 2, 'Damen'),
+            snapshot('d#Pink#301#1', 3, '18th')
+        ]
+
+        events = derive_trip_events(snapshots_table(rows)).to_pylist()
+
+        self.assertEqual([event['station'] for event in events], ['Damen'])
+        self.assertEqual(events[0]['first_seen_time'], timestamp(0))
+
+    def test_empty_table(self):
+        """Test an empty table or one with a single snapshot per run yields an empty events table."""
+        self.assertEqual(derive_trip_events(PROCESSED_SCHEMA.empty_table()), TRIP_EVENTS_SCHEMA.empty_table())
+        events = derive_trip_events(snapshots_table([snapshot('d#Red#801#1', 0, 'Howard')]))
+        self.assertEqual(events.num_rows, 0)
+        self.assertEqual(events.schema, TRIP_EVENTS_SCHEMA)
+
+
+class TestSplitTrainIds(unittest.TestCase):
+    """Class for testing the split_train_ids function."""
+
+    def test_split_train_ids(self):
+        """Test train IDs are split into their line, run number and direction."""
+        parts = split_train_ids(pa.array(['2025-06-20#Red#801#1', '2025-06-20#Green#002#5']))
+
+        self.assertEqual(parts['train_line'].to_pylist(), ['Red', 'Green'])
+        self.assertEqual(parts['run_number'].to_pylist(), ['801', '002'])
+        self.assertEqual(parts['direction'].to_pylist(), ['1', '5'])
@@ -1,13 +1,18 @@
 """Module for unit testing of the write_train_lines lambda handler function."""
 import unittest
 from unittest.mock import patch, MagicMock
+import datetime
+import io
 import json
 import os
+import zoneinfo
 
 import botocore
 import botocore.exceptions
 
-from lambdas.write_train_lines.write_train_lines import get_sqs_queue_url, send_message_to_sqs, lambda_handler
+from lambdas.write_train_lines.write_train_lines import get_sqs_queue_url, send_messages_to_sqs, get_sqs_client, \
+    get_cached_sqs_queue_url, lambda_handler, get_line_activity, should_poll_line, get_train_lines_to_poll, \
+    is_in_service_hours
 
 
 class TestGetQueueUrl(unittest.TestCase):
@@ -61,63 +66,256 @@ class TestGetQueueUrl(unittest.TestCase):
             self.assertEqual(mock_sqs_client.get_queue_url.call_count, 2)
 
 
-class TestSendMessageToSqs(unittest.TestCase):
-    """Unit tests for the send_message_to_sqs method."""
-    
-    def test_send_message_to_sqs_success(self):
-        """Test successful sending of message to SQS."""
-        with patch('boto3.client') as mock_boto_client:
-            mock_sqs_client = MagicMock()
-            mock_boto_client.return_value = mock_sqs_client
-            queue_url = 'https://sqs.us-east-2.amazonaws.com/123456789012/test-sqs-queue'
-            message_body = {'key': 'value'}
+class TestGetCachedSqsQueueUrl(unittest.TestCase):
+    """Unit tests for the get_sqs_client and get_cached_sqs_queue_url methods."""
+
+    def setUp(self):
+        """Start each test from a cold container."""
+        get_sqs_client.cache_clear()
+        get_cached_sqs_queue_url.cache_clear()
+
+    def test_queue_url_cached(self):
+        """Test the queue URL is only retrieved once."""
+        mock_sqs_client = MagicMock()
+        mock_sqs_client.get_queue_url.return_value = {'QueueUrl': 'test-queue-url'}
+
+        first_url = get_cached_sqs_queue_url(mock_sqs_client, 'test-sqs-queue')
+        second_url = get_cached_sqs_queue_url(mock_sqs_client, 'test-sqs-queue')
+
+        self.assertEqual(first_url, 'test-queue-url')
+        self.assertEqual(second_url, 'test-queue-url')
+        mock_sqs_client.get_queue_url.assert_called_once_with(QueueName='test-sqs-queue')
+
+    @patch('lambdas.write_train_lines.write_train_lines.boto3.client')
+    def test_sqs_client_cached(self, mock_boto_client):
+        """Test the SQS client is only created once."""
+        first_client = get_sqs_client(region_name='us-east-2')
+        second_client = get_sqs_client(region_name='us-east-2')
+
+        self.assertIs(first_client, second_client)
+        mock_boto_client.assert_called_once_with('sqs', region_name='us-east-2')
+
+
+class TestSendMessagesToSqs(unittest.TestCase):
+    """Unit tests for the send_messages_to_sqs method."""
+
+    def setUp(self):
+        """Patch the backoff sleep before each test."""
+        self.sleep_patcher = patch('lambdas.write_train_lines.write_train_lines.time.sleep')
+        self.mock_sleep = self.sleep_patcher.start()
+        self.queue_url = 'https://sqs.us-east-2.amazonaws.com/123456789012/test-sqs-queue'
 
-            send_message_to_sqs(
+    def tearDown(self):
+        """Stop all patches after each test."""
+        self.sleep_patcher.stop()
+
+    def test_send_messages_to_sqs_success(self):
+        """Test messages are sent in batches of up to 10 entries."""
+        mock_sqs_client = MagicMock()
+        mock_sqs_client.send_message_batch.return_value = {'Successful': [], 'Failed': []}
+        message_bodies = [{'key': i} for i in range(12)]
+
+        send_messages_to_sqs(
+            sqs_client=mock_sqs_client,
+            queue_url=self.queue_url,
+            message_bodies=message_bodies
+        )
+
+        self.assertEqual(mock_sqs_client.send_message_batch.call_count, 2)
+        first_entries = mock_sqs_client.send_message_batch.call_args_list[0].kwargs['Entries']
+        second_entries = mock_sqs_client.send_message_batch.call_args_list[1].kwargs['Entries']
+        self.assertEqual(len(first_entries), 10)
+        self.assertEqual(second_entries, [
+            {'Id': '10', 'MessageBody': json.dumps({'key': 10})},
+            {'Id': '11', 'MessageBody': json.dumps({'key': 11})}
+        ])
+        self.mock_sleep.assert_not_called()
+
+    def test_no_messages(self):
+        """Test nothing is sent when there are no messages."""
+        mock_sqs_client = MagicMock()
+
+        send_messages_to_sqs(sqs_client=mock_sqs_client, queue_url=self.queue_url, message_bodies=[])
+
+        mock_sqs_client.send_message_batch.assert_not_called()
+
+    def test_failed_entries_retried(self):
+        """Test only the failed entries are resent."""
+        mock_sqs_client = MagicMock()
+        mock_sqs_client.send_message_batch.side_effect = [
+            {'Successful': [{'Id': '0'}], 'Failed': [{'Id': '1', 'SenderFault': False, 'Code': 'InternalError'}]},
+            {'Successful': [{'Id': '1'}], 'Failed': []}
+        ]
+
+        send_messages_to_sqs(
+            sqs_client=mock_sqs_client,
+            queue_url=self.queue_url,
+            message_bodies=[{'key': 0}, {'key': 1}]
+        )
+
+        self.assertEqual(
+            mock_sqs_client.send_message_batch.call_args_list[1].kwargs['Entries'],
+            [{'Id': '1', 'MessageBody': json.dumps({'key': 1})}]
+        )
+        self.mock_sleep.assert_called_once()
+
+    def test_failed_entries_exhaust_retries(self):
+        """Test an exception is raised if entries still fail after max_retries attempts."""
+        mock_sqs_client = MagicMock()
+        mock_sqs_client.send_message_batch.return_value = {
+            'Successful': [],
+            'Failed': [{'Id': '0', 'SenderFault': False, 'Code': 'InternalError'}]
+        }
+
+        with self.assertRaises(Exception):
+            send_messages_to_sqs(
                 sqs_client=mock_sqs_client,
-                queue_url=queue_url,
-                message_body=message_body
+                queue_url=self.queue_url,
+                message_bodies=[{'key': 0}],
+                max_retries=3
             )
 
-            mock_sqs_client.send_message.assert_called_once_with(
-                QueueUrl=queue_url,
-                MessageBody=json.dumps(message_body)
-            )
+        self.assertEqual(mock_sqs_client.send_message_batch.call_count, 3)
+        self.assertEqual(self.mock_sleep.call_count, 2)
 
-    def test_send_message_to_sqs_client_error(self):
-        """Test handling of ClientError when sending message to SQS."""
-        with patch('boto3.client') as mock_boto_client:
-            mock_sqs_client = MagicMock()
-            mock_sqs_client.send_message.side_effect = botocore.exceptions.ClientError(
-                {'Error': {'Code': 'KmsAccessDenied', 'Message': 'KmsAccessDenied'}},
-                'SendMessage'
-            )
-            mock_boto_client.return_value = mock_sqs_client
+    def test_sender_fault_not_retried(self):
+        """Test entries rejected due to a sender fault are not retried."""
+        mock_sqs_client = MagicMock()
+        mock_sqs_client.send_message_batch.return_value = {
+            'Successful': [],
+            'Failed': [{'Id': '0', 'SenderFault': True, 'Code': 'InvalidMessageContents'}]
+        }
 
-            queue_url = 'https://sqs.us-east-2.amazonaws.com/123456789012/test-sqs-queue'
-            message_body = {'key': 'value'}
+        with self.assertRaises(Exception):
+            send_messages_to_sqs(sqs_client=mock_sqs_client, queue_url=self.queue_url, message_bodies=[{'key': 0}])
 
-            with self.assertRaises(botocore.exceptions.ClientError):
-                send_message_to_sqs(mock_sqs_client, queue_url, message_body)
-    
-    def test_retry_send_message_to_sqs(self):
-        """Test retry logic for send_message_to_sqs on ClientError."""
-        with patch('boto3.client') as mock_boto_client:
-            mock_sqs_client = MagicMock()
-            mock_sqs_client.send_message.side_effect = [
-                botocore.exceptions.ClientError(
-                    {'Error': {'Code': 'RequestThrottled', 'Message': 'Request was throttled'}},
-                    'SendMessage'
-                ),
-                None
-            ]
-            mock_boto_client.return_value = mock_sqs_client
+        mock_sqs_client.send_message_batch.assert_called_once()
+
+    def test_send_messages_to_sqs_client_error(self):
+        """Test handling of ClientError when sending messages to SQS."""
+        mock_sqs_client = MagicMock()
+        mock_sqs_client.send_message_batch.side_effect = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'KmsAccessDenied', 'Message': 'KmsAccessDenied'}},
+            'SendMessageBatch'
+        )
+
+        with self.assertRaises(botocore.exceptions.ClientError):
+            send_messages_to_sqs(mock_sqs_client, self.queue_url, [{'key': 'value'}])
+
+    def test_retry_send_messages_to_sqs(self):
+        """Test retry logic for send_messages_to_sqs on ClientError."""
+        mock_sqs_client = MagicMock()
+        mock_sqs_client.send_message_batch.side_effect = [
+            botocore.exceptions.ClientError(
+                {'Error': {'Code': 'RequestThrottled', 'Message': 'Request was throttled'}},
+                'SendMessageBatch'
+            ),
+            {'Successful': [{'Id': '0'}], 'Failed': []}
+        ]
+
+        send_messages_to_sqs(mock_sqs_client, self.queue_url, [{'key': 'value'}])
+
+        self.assertEqual(mock_sqs_client.send_message_batch.call_count, 2)
+
+
+class TestAdaptiveScheduling(unittest.TestCase):
+    """Unit tests for the adaptive poll scheduling methods."""
+
+    def setUp(self):
+        """Set a common local time for each test."""
+        self.now = datetime.datetime(2025, 6, 25, 3, 13, tzinfo=zoneinfo.ZoneInfo('America/Chicago'))
+
+    def test_is_in_service_hours(self):
+        """Test service hours with and without service past midnight."""
+        self.assertTrue(is_in_service_hours(service_hours=None, now=self.now))
+        self.assertTrue(is_in_service_hours(service_hours=(1, 5), now=self.now))
+        self.assertFalse(is_in_service_hours(service_hours=(4, 2), now=self.now))
+        self.assertTrue(is_in_service_hours(service_hours=(4, 2), now=self.now.replace(hour=1)))
+        self.assertTrue(is_in_service_hours(service_hours=(4, 2), now=self.now.replace(hour=23)))
+
+    def test_poll_without_activity_within_service_hours(self):
+        """Test a line without recorded activity is polled every minute within its service hours."""
+        self.assertTrue(should_poll_line('Red', None, self.now))
+        self.assertTrue(should_poll_line('Purple', None, self.now.replace(hour=12)))
+
+    def test_poll_without_activity_outside_service_hours(self):
+        """Test a line without recorded activity is only polled every interval outside its service hours."""
+        on_interval = self.now.replace(minute=10)
+
+        self.assertFalse(should_poll_line('Purple', None, self.now, inactive_poll_interval_minutes=10))
+        self.assertTrue(should_poll_line('Purple', None, on_interval, inactive_poll_interval_minutes=10))
+
+    def test_poll_without_activity_or_service_hours(self):
+        """Test a line without recorded activity is polled when the service hours table is not used."""
+        self.assertTrue(should_poll_line('Purple', None, self.now, use_service_hours=False))
+
+    def test_poll_recently_active_line(self):
+        """Test a line is polled every minute while trains were seen recently, even outside its service hours."""
+        activity = {'last_active': (self.now - datetime.timedelta(minutes=5)).isoformat()}
+
+        self.assertTrue(should_poll_line('Purple', activity, self.now))
+
+    def test_inactive_line_polled_less_often(self):
+        """Test an inactive line is only polled every inactive_poll_interval_minutes."""
+        activity = {'last_active': (self.now - datetime.timedelta(hours=2)).isoformat()}
+
+        on_interval = self.now.replace(minute=10)
+
+        self.assertFalse(should_poll_line('Purple', activity, self.now, inactive_poll_interval_minutes=10))
+        self.assertTrue(should_poll_line('Purple', activity, on_interval, inactive_poll_interval_minutes=10))
+
+    def test_activity_decides_before_service_hours(self):
+        """Test a line without trains is polled less often even within its service hours."""
+        never_active = {'last_active': None}
+        inactive = {'last_active': (self.now - datetime.timedelta(hours=2)).isoformat()}
+
+        self.assertFalse(should_poll_line('Red', never_active, self.now))
+        self.assertFalse(should_poll_line('Purple', inactive, self.now.replace(hour=12)))
+
+    @patch('lambdas.write_train_lines.write_train_lines.line_activity_cache', {})
+    def test_get_line_activity_cached(self):
+        """Test the line activity is only read from S3 again once the cached copy expires."""
+        mock_s3_client = MagicMock()
+        mock_s3_client.get_object.side_effect = lambda **kwargs: {
+            'Body': io.BytesIO(json.dumps({'last_active': None}).encode('utf-8'))
+        }
+
+        first_activity = get_line_activity(mock_s3_client, 'test-bucket', 'Purple', cache_seconds=60)
+        second_activity = get_line_activity(mock_s3_client, 'test-bucket', 'Purple', cache_seconds=60)
+        get_line_activity(mock_s3_client, 'test-bucket', 'Purple', cache_seconds=0)
+
+        self.assertEqual(first_activity, {'last_active': None})
+        self.assertEqual(second_activity, first_activity)
+        self.assertEqual(mock_s3_client.get_object.call_count, 2)
+        mock_s3_client.get_object.assert_called_with(Bucket='test-bucket', Key='state/line_activity/Purple.json')
+
+    @patch('lambdas.write_train_lines.write_train_lines.line_activity_cache', {})
+    def test_get_line_activity_missing(self):
+        """Test a line without recorded activity returns None."""
+        mock_s3_client = MagicMock()
+        mock_s3_client.get_object.side_effect = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'NoSuchKey', 'Message': 'Not Found'}},
+            'GetObject'
+        )
+
+        self.assertIsNone(get_line_activity(mock_s3_client, 'test-bucket', 'Purple'))
 
-            queue_url = 'https://sqs.us-east-2.amazonaws.com/123456789012/test-sqs-queue'
-            message_body = {'key': 'value'}
+    @patch('lambdas.write_train_lines.write_train_lines.get_line_activity')
+    @patch('lambdas.write_train_lines.write_train_lines.get_s3_client')
+    def test_get_train_lines_to_poll(self, mock_get_s3_client, mock_get_line_activity):
+        """Test inactive lines are skipped when adaptive scheduling is enabled."""
+        activity = {
+            'Red': {'last_active': (self.now - datetime.timedelta(minutes=5)).isoformat()},
+            'Purple': {'last_active': (self.now - datetime.timedelta(hours=2)).isoformat()}
+        }
+        mock_get_line_activity.side_effect = lambda **kwargs: activity[kwargs['train_line']]
+        train_lines = {'Red': 'Red', 'P': 'Purple'}
 
-            send_message_to_sqs(mock_sqs_client, queue_url, message_body)
+        with patch.dict(os.environ, {'ADAPTIVE_SCHEDULING': 'true', 'LINE_ACTIVITY_BUCKET': 'test-bucket'}):
+            lines_to_poll = get_train_lines_to_poll(train_lines=train_lines, now=self.now)
 
-            self.assertEqual(mock_sqs_client.send_message.call_count, 2)
+        self.assertEqual(lines_to_poll, {'Red': 'Red'})
+        self.assertEqual(get_train_lines_to_poll(train_lines=train_lines, now=self.now), train_lines)
 
 
 class MockLambdaContext:
@@ -149,9 +347,9 @@ class TestLambdaHandler(unittest.TestCase):
         """Stop all patches after each test."""
         self.env_patcher.stop()
 
-    @patch('lambdas.write_train_lines.write_train_lines.get_sqs_queue_url')
-    @patch('lambdas.write_train_lines.write_train_lines.send_message_to_sqs')
-    @patch('lambdas.get_train_status.get_train_status.boto3.client')
+    @patch('lambdas.write_train_lines.write_train_lines.get_cached_sqs_queue_url')
+    @patch('lambdas.write_train_lines.write_train_lines.send_messages_to_sqs')
+    @patch('lambdas.write_train_lines.write_train_lines.get_sqs_client')
     def test_lambda_handler_success(self, mock_boto_client, mock_send_message, mock_get_queue_url):
         """Tests successful (happy path) lambda_handler invocation."""
         mock_sqs = MagicMock()
@@ -168,7 +366,35 @@ class TestLambdaHandler(unittest.TestCase):
                 'body': 'Processed all train lines'
             }
         )
-        self.assertEqual(mock_send_message.call_count, 7)
+        mock_send_message.assert_called_once()
+        self.assertEqual(len(mock_send_message.call_args.kwargs['message_bodies']), 7)
+
+    @patch('lambdas.write_train_lines.write_train_lines.get_cached_sqs_queue_url')
+    @patch('lambdas.write_train_lines.write_train_lines.send_messages_to_sqs')
+    @patch('lambdas.write_train_lines.write_train_lines.get_sqs_client')
+    def test_lambda_handler_batched_poll_mode(self, mock_boto_client, mock_send_message, mock_get_queue_url):
+        """Tests a single message containing all train lines is sent in batched poll mode."""
+        mock_sqs = MagicMock()
+        mock_boto_client.return_value = mock_sqs
+        mock_send_message.return_value = None
+        mock_get_queue_url.return_value = 'test-queue-url'
+
+        with patch.dict(os.environ, {'POLL_MODE': 'batched'}):
+            response = lambda_handler(event=self.mock_event, context=MockLambdaContext())
+
+        self.assertEqual(
+            response,
+            {
+                'statusCode': 200,
+                'body': 'Processed all train lines'
+            }
+        )
+        mock_send_message.assert_called_once()
+        message_bodies = mock_send_message.call_args.kwargs['message_bodies']
+        self.assertEqual(len(message_bodies), 1)
+        message_body = message_bodies[0]
+        self.assertEqual(len(message_body['train_lines']), 7)
+        self.assertIn({'train_line_abbrev': 'P', 'train_line': 'Purple'}, message_body['train_lines'])
 
     def test_missing_queue_name_env_variable(self):
         """Tests KeyError is raised if SQS_QUEUE_NAME env variable is missing."""
@@ -184,11 +410,13 @@ class TestLambdaHandler(unittest.TestCase):
         with self.assertRaises(KeyError):
             lambda_handler(event=self.mock_event, context=MockLambdaContext())
 
-    @patch('lambdas.write_train_lines.write_train_lines.get_sqs_queue_url')
-    @patch('lambdas.write_train_lines.write_train_lines.send_message_to_sqs')
-    @patch('lambdas.write_train_lines.write_train_lines.boto3.client')
+    @patch('lambdas.write_train_lines.write_train_lines.get_cached_sqs_queue_url')
+    @patch('lambdas.write_train_lines.write_train_lines.send_messages_to_sqs')
+    @patch('lambdas.write_train_lines.write_train_lines.get_sqs_client')
     @patch('lambdas.write_train_lines.write_train_lines.cta_train_lines')
-    def test_lambda_handler_no_train_lines(self, mock_train_lines, mock_boto_client, mock_send_message, mock_get_queue_url):
+    def test_lambda_handler_no_train_lines(
+        self, mock_train_lines, mock_boto_client, mock_send_message, mock_get_queue_url
+    ):
         """Tests lambda_handler if no train lines to write."""
         mock_sqs = MagicMock()
         mock_boto_client.return_value = mock_sqs
@@ -205,4 +433,4 @@ class TestLambdaHandler(unittest.TestCase):
                 'body': 'Processed all train lines'
             }
         )
-        self.assertEqual(mock_send_message.call_count, 0)
\ No newline at end of file
+        self.assertEqual(mock_send_message.call_args.kwargs['message_bodies'], [])
\ No newline at end of file